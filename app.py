@@ -1,43 +1,74 @@
 import os
 from flask import Flask
 from extensions import db
+import db_config
+import migrations
+import cli
+import instrumentation
+import response_formats
+import request_guards
 
 
-def create_app() -> Flask:
-    app = Flask(__name__)
+def init_db(app: Flask) -> None:
+    """Create missing tables, then apply pending migrations (indexes, columns)."""
+    with app.app_context():
+        db.create_all()
+        migrations.upgrade()
 
-    # Database configuration from environment (Render)
-    database_url = os.environ.get("DATABASE_URL")
 
-    # Render often provides postgres:// but SQLAlchemy expects postgresql://
-    if database_url and database_url.startswith("postgres://"):
-        database_url = database_url.replace("postgres://", "postgresql://", 1)
+def create_app() -> Flask:
+    app = Flask(__name__)
 
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    # Database configuration from environment (Render): pool sizing,
+    # statement caching and optional read replica
+    db_config.configure(app)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
     # Initialize SQLAlchemy extension
     db.init_app(app)
 
-    with app.app_context():
-        # Import models so SQLAlchemy knows about them
-        from models import Bin, MLPrediction, Route, RouteStop  # noqa: F401
+    # Per-request timings, SQL counters and cProfile dumps (see /api/metrics)
+    instrumentation.init_app(app)
 
-        # Create tables if they do not exist yet (good enough for prototype)
-        db.create_all()
+    # orjson encoder, gzip/brotli compression for large responses
+    response_formats.init_app(app)
+
+    # Work budgets for heavy endpoints: X-Degraded header (see request_guards.py)
+    request_guards.init_app(app)
+
+    # Import models so SQLAlchemy knows about them
+    from models import (  # noqa: F401
+        Bin, MLPrediction, MLPredictionRollup, Route, RouteStop, ActiveRoute, RouteJob,
+        BinChange, Depot,
+    )
+
+    # Creating/upgrading the schema costs several database round trips, so
+    # workers skip it; run `flask --app app init-db` once per deploy instead
+    # (or set DB_INIT_ON_STARTUP=1)
+    if os.environ.get("DB_INIT_ON_STARTUP", "0").lower() in ("1", "true", "yes"):
+        init_db(app)
+
+    # Register blueprints
+    from routes.logs import logs_bp
+    from routes.api import api_bp
+    from routes.bins import bins_bp
+    from routes.dashboard import dashboard_bp
+    from routes.vehicles import vehicles_bp
+    from routes.depots import depots_bp
+    # Upload and route generation views are imported on first use
+    from routes.lazy import upload_bp, upload_route_bp, route_jobs_bp
 
-        # Register blueprints
-        from routes.logs import logs_bp
-        from routes.api import api_bp
-        from routes.dashboard import dashboard_bp
-        from routes.upload import upload_bp
-        from routes.upload_route import upload_route_bp
+    app.register_blueprint(logs_bp)
+    app.register_blueprint(api_bp)
+    app.register_blueprint(bins_bp)
+    app.register_blueprint(dashboard_bp)
+    app.register_blueprint(vehicles_bp)
+    app.register_blueprint(depots_bp)
+    app.register_blueprint(upload_bp)
+    app.register_blueprint(upload_route_bp)
+    app.register_blueprint(route_jobs_bp)
 
-        app.register_blueprint(logs_bp)
-        app.register_blueprint(api_bp)
-        app.register_blueprint(dashboard_bp)
-        app.register_blueprint(upload_bp)
-        app.register_blueprint(upload_route_bp)
+    cli.register(app)
 
     return app
 
@@ -48,5 +79,6 @@ app = create_app()
 
 if __name__ == "__main__":
     # Local development entrypoint
+    init_db(app)
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
     
@@ -0,0 +1,299 @@
+"""
+Async (ASGI) serving mode.
+
+The sensor ingest endpoint and the read endpoints that dashboards poll
+(/api/prototype/submit, /api/predictions, /api/route, /api/health) are
+served natively with an async database driver and connection pool, so a
+slow commit no longer ties up a whole worker. Every other URL is passed
+through to the regular Flask app, which keeps working unchanged.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+or under gunicorn:
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+
+`gunicorn app:app` (the Procfile default) is unaffected.
+"""
+import contextlib
+import os
+from datetime import datetime
+
+from a2wsgi import WSGIMiddleware
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from werkzeug.http import parse_etags
+from starlette.routing import Mount, Route as HTTPRoute
+
+from app import app as flask_app
+import change_feed
+import db_config
+import request_guards
+from idempotency import insert_prediction, recent_submissions, submission_key
+from models import Bin, Route
+import route_store
+from response_formats import (
+    compress_body,
+    format_route,
+    negotiate_format,
+    representation_etag,
+    requested_fields,
+    to_columnar,
+)
+from routes.api import (
+    PREDICTION_FIELDS,
+    STOP_FIELDS,
+    parse_submission,
+    predictions_statement,
+    serialize_prediction,
+    submission_body,
+)
+
+try:  # optional, faster JSON rendering
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+PREDICTIONS_ENDPOINT = "api.api_predictions"
+
+# ---------- Async database ----------
+
+def async_database_url(url: str) -> str:
+    """Map the sync DATABASE_URL onto the matching async driver."""
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url
+
+
+def _engine_options(url: str) -> dict:
+    options = db_config.engine_options(url)
+    if not url.startswith("sqlite"):
+        # Coroutines are cheap, so the async pool is larger than the sync one.
+        # asyncpg also keeps its own per-connection prepared statement cache.
+        options.update(
+            pool_size=int(os.environ.get("ASYNC_DB_POOL_SIZE", "20")),
+            max_overflow=int(os.environ.get("ASYNC_DB_MAX_OVERFLOW", "40")),
+        )
+    return options
+
+
+def _create_engine(url: str):
+    url = async_database_url(url)
+    return create_async_engine(url, **_engine_options(url))
+
+
+async_engine = _create_engine(flask_app.config["SQLALCHEMY_DATABASE_URI"])
+AsyncSession = async_sessionmaker(async_engine, expire_on_commit=False)
+
+# Read-only endpoints go to the replica when one is configured
+_replica_url = db_config.database_url_from_env("DATABASE_REPLICA_URL")
+async_read_engine = _create_engine(_replica_url) if _replica_url else async_engine
+AsyncReadSession = async_sessionmaker(async_read_engine, expire_on_commit=False)
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return super().render(content)
+
+
+def _respond(request: Request, content, status_code: int = 200, headers=None) -> Response:
+    """JSON response compressed like the Flask app's (see response_formats.compress_response)."""
+    headers = dict(headers or {})
+    headers.setdefault("Vary", "Accept-Encoding")
+    body, encoding = compress_body(
+        FastJSONResponse(content).body, request.headers.get("Accept-Encoding", "")
+    )
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(body, status_code, headers=headers, media_type="application/json")
+
+
+# ---------- Endpoints ----------
+# Same behaviour as the Flask views in routes/api.py, which they replace
+
+async def api_predictions(request: Request):
+    source = request.query_params.get("source", "test")
+    degraded = set()
+
+    async with request_guards.async_slot("read") as acquired:
+        if not acquired:
+            request_guards.exceeded("concurrency", endpoint=PREDICTIONS_ENDPOINT)
+            degraded.add("concurrency")
+        limit = request_guards.row_limit(acquired)
+        async with AsyncReadSession() as session:
+            rows = (await session.execute(predictions_statement(source).limit(limit + 1))).all()
+        rows, truncated = request_guards.truncate(rows, limit, endpoint=PREDICTIONS_ENDPOINT)
+        if truncated:
+            degraded.add("rows")
+        results = [serialize_prediction(p, bin_obj) for p, bin_obj in rows]
+
+        if negotiate_format(args=request.query_params, headers=request.headers) == "columnar":
+            results = to_columnar(results, requested_fields(PREDICTION_FIELDS, request.query_params))
+
+    headers = {"X-Degraded": ",".join(sorted(degraded))} if degraded else None
+    return _respond(request, results, headers=headers)
+
+
+async def api_route(request: Request):
+    source = request.query_params.get("source", "test")
+    try:
+        version = int(request.query_params["version"])
+    except (KeyError, ValueError):
+        # Like request.args.get("version", type=int): serve the active route
+        version = None
+    fmt = negotiate_format(args=request.query_params, headers=request.headers)
+    fields = requested_fields(STOP_FIELDS, request.query_params)
+
+    async with AsyncReadSession() as session:
+        route_id = version
+        if route_id is None:
+            route_id = (await session.execute(route_store.active_route_statement(source))).scalar()
+        if route_id is None:
+            route_id = (await session.execute(route_store.latest_route_statement(source))).scalar()
+
+        payload = route_store.cached_route_payload(route_id) if route_id else None
+        if payload is None and route_id:
+            route = await session.get(Route, route_id)
+            if route is not None:
+                stop_rows = (await session.execute(route_store.route_stops_statement(route_id))).all()
+                payload = route_store.build_route_payload(route, stop_rows)
+                route_store.cache_route_payload(route_id, payload)
+
+    if payload is None:
+        if version is not None:
+            return _respond(request, {"error": f"Route version {version} not found"}, 404)
+        return _respond(
+            request, {"route_id": None, "version": None, "name": None, "source": source, "stops": []}
+        )
+
+    headers = {}
+    if version is not None:
+        # A version never changes, so clients and proxies may keep it forever
+        etag = representation_etag(f"route-{version}", fmt, fields)
+        headers = {
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "Vary": "Accept, Accept-Encoding",
+            "ETag": f'W/"{etag}"',
+        }
+        if parse_etags(request.headers.get("If-None-Match")).contains_weak(etag):
+            return Response(status_code=304, headers=headers)
+    return _respond(request, format_route(payload, fmt, fields), headers=headers)
+
+
+async def submit_prototype_data(request: Request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data:
+        return FastJSONResponse({"error": "No JSON data provided"}, 400)
+
+    try:
+        fields = parse_submission(data, request.headers.get("Idempotency-Key"))
+    except (TypeError, ValueError) as e:
+        return FastJSONResponse({"error": str(e)}, 400)
+
+    key = submission_key("prototype", fields)
+    if recent_submissions.seen(key):
+        return FastJSONResponse(*submission_body(fields, duplicate=True))
+
+    try:
+        async with AsyncSession() as session, session.begin():
+            bin_obj = (
+                await session.execute(
+                    Bin.__table__.select().where(Bin.trash_can_id == fields["bin_id"])
+                )
+            ).first()
+            changes = []
+
+            if bin_obj is None:
+                result = await session.execute(
+                    Bin.__table__.insert().values(
+                        trash_can_id=fields["bin_id"],
+                        latitude=fields["latitude"],
+                        longitude=fields["longitude"],
+                        location_name=fields["location_name"],
+                        capacity_litres=fields["capacity_litres"],
+                        is_active=True,
+                    )
+                )
+                bin_pk = result.inserted_primary_key[0]
+                changes.append(change_feed.bin_change(
+                    "insert", bin_pk, fields["bin_id"], "prototype",
+                    {f: fields[f] for f in change_feed.BIN_FIELDS},
+                ))
+            else:
+                bin_pk = bin_obj.id
+                updates = change_feed.changed_fields(
+                    {f: getattr(bin_obj, f) for f in change_feed.BIN_FIELDS},
+                    {
+                        "latitude": fields["latitude"],
+                        "longitude": fields["longitude"],
+                        "location_name": fields["location_name"] or None,
+                    },
+                )
+                if updates:
+                    await session.execute(
+                        Bin.__table__.update().where(Bin.id == bin_pk).values(**updates)
+                    )
+                    changes.append(change_feed.bin_change(
+                        "update", bin_pk, fields["bin_id"], "prototype", updates,
+                    ))
+
+            result = await session.execute(
+                insert_prediction(
+                    db_config.dialect_insert(dialect=async_engine.dialect.name),
+                    bin_id=bin_pk,
+                    source="prototype",
+                    predicted_fill_percent=fields["fill_percent"],
+                    predicted_full_at=fields["predicted_full_at"],
+                    idempotency_key=fields["idempotency_key"],
+                    device_timestamp=fields["device_timestamp"],
+                    created_at=datetime.utcnow(),
+                )
+            )
+            if result.rowcount:
+                changes.append(change_feed.prediction_change(
+                    result.inserted_primary_key[0], fields["bin_id"], "prototype",
+                    fields["fill_percent"], fields["predicted_full_at"],
+                ))
+            if changes:
+                await session.execute(change_feed.insert_statement(), changes)
+    except Exception as e:
+        return FastJSONResponse({"error": str(e)}, 500)
+
+    recent_submissions.add(key)
+    return FastJSONResponse(*submission_body(fields, duplicate=result.rowcount == 0))
+
+
+async def health_check(request: Request):
+    return FastJSONResponse({"status": "ok", "timestamp": datetime.utcnow().isoformat()})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    await async_engine.dispose()
+    if async_read_engine is not async_engine:
+        await async_read_engine.dispose()
+
+
+app = Starlette(
+    routes=[
+        HTTPRoute("/api/prototype/submit", submit_prototype_data, methods=["POST"]),
+        HTTPRoute("/api/predictions", api_predictions, methods=["GET"]),
+        HTTPRoute("/api/route", api_route, methods=["GET"]),
+        HTTPRoute("/api/health", health_check, methods=["GET"]),
+        # Everything else (dashboard, uploads, route generation) stays on Flask
+        Mount("/", app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
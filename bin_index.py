@@ -0,0 +1,411 @@
+"""
+In-memory, per-worker index of bins for map clustering.
+
+Each bin is kept with its coordinates and latest fill level per source.
+For every zoom level up to MAX_CLUSTER_ZOOM the bins are pre-aggregated
+into a grid of web-mercator cells (CELLS_PER_TILE x CELLS_PER_TILE per
+map tile), so a cluster request only touches the cells inside the
+viewport instead of every bin.
+
+The same index answers geospatial queries (radius, bounding box and
+k-nearest, with fill filters): every bin is also bucketed into a fine
+QUERY_ZOOM grid, so a query only visits the few cells around its area.
+
+The index is seeded with the latest prediction of every bin and then
+refreshes from the change feed (see change_feed.py): at most every
+BIN_INDEX_REFRESH_SECONDS it reads the changes after the last ``seq`` it
+applied, reloads the latest prediction of the bins they name and moves
+those bins between cells. The feed only hands out settled changes, so a
+prediction that commits out of id order is picked up, not skipped.
+"""
+import bisect
+import math
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import change_feed
+from extensions import db
+from models import Bin, MLPrediction
+
+
+MAX_CLUSTER_ZOOM = 16
+CELLS_PER_TILE = 4  # roughly one cluster per 64px on a 256px tile
+URGENT_FILL_PERCENT = 80.0
+REFRESH_SECONDS = float(os.environ.get("BIN_INDEX_REFRESH_SECONDS", "5"))
+
+# Grid used for radius/bbox/knn queries: 2**16 cells per axis, i.e. cells
+# of ~600 m x cos(latitude) (~350 m at 55 deg N)
+QUERY_ZOOM = 14
+EARTH_RADIUS_M = 6371000.0
+
+# Bins per IN (...) when reloading changed bins
+LOOKUP_CHUNK = 500
+
+
+def _mercator(lat: float, lon: float) -> Tuple[float, float]:
+    """Project to normalised web-mercator coordinates in [0, 1)."""
+    lat = max(min(lat, 85.05112878), -85.05112878)
+    x = (lon + 180.0) / 360.0
+    rad = math.radians(lat)
+    y = (1.0 - math.log(math.tan(rad) + 1.0 / math.cos(rad)) / math.pi) / 2.0
+    return x, y
+
+
+def _cell(x: float, y: float, zoom: int) -> Tuple[int, int]:
+    n = (1 << zoom) * CELLS_PER_TILE
+    return min(int(x * n), n - 1), min(int(y * n), n - 1)
+
+
+def _distance_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Haversine distance in metres."""
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = (math.sin(dlat / 2) ** 2 +
+         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+         math.sin(dlon / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _cell_size_m(lat: float) -> float:
+    """Ground size of one QUERY_ZOOM cell at ``lat`` (mercator is conformal)."""
+    n = (1 << QUERY_ZOOM) * CELLS_PER_TILE
+    return 2 * math.pi * EARTH_RADIUS_M * math.cos(math.radians(lat)) / n
+
+
+def _latest_rows(session, trash_can_ids: Optional[List[str]] = None) -> list:
+    """Latest prediction of every (source, bin), with the bin's coordinates."""
+    latest_ids = db.select(db.func.max(MLPrediction.id)).group_by(
+        MLPrediction.source, MLPrediction.bin_id
+    )
+    if trash_can_ids is not None:
+        latest_ids = latest_ids.join(Bin, MLPrediction.bin_id == Bin.id).where(
+            Bin.trash_can_id.in_(trash_can_ids)
+        )
+    return session.execute(
+        db.select(
+            MLPrediction.source,
+            MLPrediction.bin_id,
+            MLPrediction.predicted_fill_percent,
+            Bin.trash_can_id,
+            Bin.latitude,
+            Bin.longitude,
+            Bin.location_name,
+        )
+        .join(Bin, MLPrediction.bin_id == Bin.id)
+        .where(MLPrediction.id.in_(latest_ids))
+    ).all()
+
+
+class BinIndex:
+    """Grid-clustered bins for every source and zoom level."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Serialises refreshes; queries only wait for _lock while one is applied
+        self._refresh_lock = threading.Lock()
+        # (source, bin pk) -> (trash_can_id, lat, lon, location_name, fill, x, y)
+        self._bins: Dict[Tuple[str, int], tuple] = {}
+        # (source, zoom) -> {(cx, cy): [count, sum_lat, sum_lon, sum_fill, urgent]}
+        self._cells: Dict[Tuple[str, int], Dict[Tuple[int, int], list]] = {}
+        # source -> {(cx, cy) at QUERY_ZOOM: {bin pk, ...}}
+        self._members: Dict[str, Dict[Tuple[int, int], set]] = {}
+        # Last change feed seq applied; None until seeded
+        self._seq: Optional[int] = None
+        self._checked_at = 0.0
+        self.version = 0
+
+    # ---------- Maintenance ----------
+
+    def _apply(self, source: str, bin_pk: int, entry: Optional[tuple]) -> None:
+        """Replace one bin's contribution to every zoom level."""
+        key = (source, bin_pk)
+        old = self._bins.pop(key, None)
+        if old is not None:
+            for zoom in range(MAX_CLUSTER_ZOOM + 1):
+                cells = self._cells[(source, zoom)]
+                cell_key = _cell(old[5], old[6], zoom)
+                agg = cells[cell_key]
+                agg[0] -= 1
+                if agg[0] == 0:
+                    del cells[cell_key]
+                    continue
+                agg[1] -= old[1]
+                agg[2] -= old[2]
+                agg[3] -= old[4]
+                agg[4] -= old[4] >= URGENT_FILL_PERCENT
+
+            members = self._members[source]
+            cell_key = _cell(old[5], old[6], QUERY_ZOOM)
+            members[cell_key].discard(bin_pk)
+            if not members[cell_key]:
+                del members[cell_key]
+
+        if entry is None:
+            return
+
+        self._bins[key] = entry
+        _, lat, lon, _, fill, x, y = entry
+        for zoom in range(MAX_CLUSTER_ZOOM + 1):
+            cells = self._cells.setdefault((source, zoom), {})
+            agg = cells.setdefault(_cell(x, y, zoom), [0, 0.0, 0.0, 0.0, 0])
+            agg[0] += 1
+            agg[1] += lat
+            agg[2] += lon
+            agg[3] += fill
+            agg[4] += fill >= URGENT_FILL_PERCENT
+
+        self._members.setdefault(source, {}).setdefault(_cell(x, y, QUERY_ZOOM), set()).add(bin_pk)
+
+    def _changed_bins(self, session) -> Tuple[List[str], int]:
+        """trash_can_ids named by changes after ``_seq``, and the new position."""
+        after = self._seq
+        codes = set()
+        while True:
+            batch = change_feed.read(after, change_feed.MAX_BATCH, session=session)
+            codes.update(c["bin_id"] for c in batch["changes"])
+            after = batch["next_after"]
+            if not batch["has_more"]:
+                break
+        return sorted(codes), after
+
+    def refresh(self, force: bool = False) -> None:
+        """Seed the index, or apply the change feed since the last refresh (throttled)."""
+        if not force and time.monotonic() - self._checked_at < REFRESH_SECONDS:
+            return
+        with self._refresh_lock:
+            now = time.monotonic()
+            if not force and now - self._checked_at < REFRESH_SECONDS:
+                # Refreshed by another thread while this one waited
+                return
+            self._checked_at = now
+
+            # The feed is read on the primary (see change_feed.py)
+            session = db.session
+            if self._seq is None:
+                seq = change_feed.settled_seq(session)
+                rows = _latest_rows(session)
+            else:
+                codes, seq = self._changed_bins(session)
+                if seq == self._seq:
+                    return
+                rows = []
+                for i in range(0, len(codes), LOOKUP_CHUNK):
+                    rows.extend(_latest_rows(session, codes[i:i + LOOKUP_CHUNK]))
+
+            with self._lock:
+                for row in rows:
+                    entry = None
+                    if row.latitude is not None and row.longitude is not None:
+                        x, y = _mercator(row.latitude, row.longitude)
+                        entry = (
+                            row.trash_can_id, row.latitude, row.longitude,
+                            row.location_name, row.predicted_fill_percent or 0.0, x, y,
+                        )
+                    self._apply(row.source, row.bin_id, entry)
+                self._seq = seq
+                self.version += 1
+
+    def reset(self) -> None:
+        with self._refresh_lock, self._lock:
+            self._bins.clear()
+            self._cells.clear()
+            self._members.clear()
+            self._seq = None
+            self._checked_at = 0.0
+            self.version += 1
+
+    # ---------- Queries ----------
+
+    def clusters(self, source: str, zoom: int,
+                 bbox: Optional[Tuple[float, float, float, float]] = None) -> Dict:
+        """
+        Return clusters for a viewport.
+
+        ``bbox`` is (min_lon, min_lat, max_lon, max_lat). Above
+        MAX_CLUSTER_ZOOM individual bins are returned instead.
+        """
+        zoom = max(0, int(zoom))
+        with self._lock:
+            if zoom > MAX_CLUSTER_ZOOM:
+                return {"zoom": zoom, "clusters": [], "bins": self._bins_in(source, bbox)}
+
+            cells = self._cells.get((source, zoom), {})
+            if bbox is not None:
+                min_lon, min_lat, max_lon, max_lat = bbox
+                x0, y0 = _cell(*_mercator(max_lat, min_lon), zoom)
+                x1, y1 = _cell(*_mercator(min_lat, max_lon), zoom)
+                if (x1 - x0 + 1) * (y1 - y0 + 1) < len(cells):
+                    keys = (
+                        (cx, cy)
+                        for cx in range(x0, x1 + 1)
+                        for cy in range(y0, y1 + 1)
+                    )
+                    selected = [(k, cells[k]) for k in keys if k in cells]
+                else:
+                    selected = [
+                        (k, agg) for k, agg in cells.items()
+                        if x0 <= k[0] <= x1 and y0 <= k[1] <= y1
+                    ]
+            else:
+                selected = list(cells.items())
+
+            clusters = []
+            for _, (count, sum_lat, sum_lon, sum_fill, urgent) in selected:
+                clusters.append({
+                    "lat": sum_lat / count,
+                    "lon": sum_lon / count,
+                    "count": count,
+                    "avg_fill": round(sum_fill / count, 1),
+                    "urgent": urgent,
+                })
+            return {"zoom": zoom, "clusters": clusters, "bins": []}
+
+    # ---------- Geospatial queries ----------
+
+    def _candidates(self, source: str, x0: int, y0: int, x1: int, y1: int):
+        """(bin pk, entry) for bins in QUERY_ZOOM cells x0..x1, y0..y1."""
+        members = self._members.get(source, {})
+        if (x1 - x0 + 1) * (y1 - y0 + 1) < len(members):
+            cells = (
+                members.get((cx, cy))
+                for cx in range(x0, x1 + 1)
+                for cy in range(y0, y1 + 1)
+            )
+        else:
+            cells = (
+                pks for (cx, cy), pks in members.items()
+                if x0 <= cx <= x1 and y0 <= cy <= y1
+            )
+        for pks in cells:
+            if pks:
+                for pk in pks:
+                    yield pk, self._bins[(source, pk)]
+
+    @staticmethod
+    def _bin_dict(entry: tuple, distance_m: Optional[float] = None) -> Dict:
+        code, lat, lon, name, fill, _, _ = entry
+        result = {
+            "bin_id": code,
+            "location_name": name,
+            "lat": lat,
+            "lon": lon,
+            "predicted_fill_percent": fill,
+        }
+        if distance_m is not None:
+            result["distance_m"] = round(distance_m, 1)
+        return result
+
+    def within_radius(self, source: str, lat: float, lon: float, radius_m: float,
+                      min_fill: float = 0.0, max_fill: float = 100.0,
+                      limit: Optional[int] = None) -> List[Dict]:
+        """Bins within ``radius_m`` metres of (lat, lon), nearest first."""
+        dlat = math.degrees(radius_m / EARTH_RADIUS_M)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        x0, y0 = _cell(*_mercator(lat + dlat, lon - dlon), QUERY_ZOOM)
+        x1, y1 = _cell(*_mercator(lat - dlat, lon + dlon), QUERY_ZOOM)
+
+        with self._lock:
+            hits = []
+            for _, entry in self._candidates(source, x0, y0, x1, y1):
+                if not min_fill <= entry[4] <= max_fill:
+                    continue
+                d = _distance_m(lat, lon, entry[1], entry[2])
+                if d <= radius_m:
+                    hits.append((d, entry))
+        hits.sort(key=lambda h: h[0])
+        return [self._bin_dict(e, d) for d, e in hits[:limit]]
+
+    def within_bbox(self, source: str, bbox: Tuple[float, float, float, float],
+                    min_fill: float = 0.0, max_fill: float = 100.0,
+                    limit: Optional[int] = None) -> List[Dict]:
+        """Bins inside ``bbox`` = (min_lon, min_lat, max_lon, max_lat)."""
+        min_lon, min_lat, max_lon, max_lat = bbox
+        x0, y0 = _cell(*_mercator(max_lat, min_lon), QUERY_ZOOM)
+        x1, y1 = _cell(*_mercator(min_lat, max_lon), QUERY_ZOOM)
+
+        result = []
+        with self._lock:
+            for _, entry in self._candidates(source, x0, y0, x1, y1):
+                if (min_fill <= entry[4] <= max_fill
+                        and min_lat <= entry[1] <= max_lat
+                        and min_lon <= entry[2] <= max_lon):
+                    result.append(self._bin_dict(entry))
+                    if limit is not None and len(result) >= limit:
+                        break
+        return result
+
+    def nearest(self, source: str, lat: float, lon: float, k: int,
+                min_fill: float = 0.0, max_fill: float = 100.0) -> List[Dict]:
+        """
+        The ``k`` bins nearest to (lat, lon), nearest first.
+
+        Searches rings of QUERY_ZOOM cells outwards from the query cell and
+        stops once the k-th best distance is closer than anything an
+        unvisited ring could contain.
+        """
+        cx, cy = _cell(*_mercator(lat, lon), QUERY_ZOOM)
+        n = (1 << QUERY_ZOOM) * CELLS_PER_TILE
+        cell_m = _cell_size_m(lat)
+
+        best = []  # (distance, bin pk, entry), sorted, at most k
+        with self._lock:
+            members = self._members.get(source, {})
+            total = sum(len(pks) for pks in members.values())
+            seen = 0
+            ring = 0
+            while seen < total and ring < n:
+                if 8 * ring > len(members):
+                    # Sparse area: scanning the occupied cells is cheaper
+                    # than walking more empty rings
+                    cells = [
+                        cell for cell in members
+                        if max(abs(cell[0] - cx), abs(cell[1] - cy)) >= ring
+                    ]
+                    ring = n
+                elif ring == 0:
+                    cells = [(cx, cy)]
+                else:
+                    x0, x1, y0, y1 = cx - ring, cx + ring, cy - ring, cy + ring
+                    cells = [(x, y0) for x in range(x0, x1 + 1)]
+                    cells += [(x, y1) for x in range(x0, x1 + 1)]
+                    cells += [(x0, y) for y in range(y0 + 1, y1)]
+                    cells += [(x1, y) for y in range(y0 + 1, y1)]
+                for cell in cells:
+                    for pk in members.get(cell, ()):
+                        seen += 1
+                        entry = self._bins[(source, pk)]
+                        if not min_fill <= entry[4] <= max_fill:
+                            continue
+                        d = _distance_m(lat, lon, entry[1], entry[2])
+                        if len(best) < k or d < best[-1][0]:
+                            bisect.insort(best, (d, pk, entry))
+                            del best[k:]
+                # Anything outside this ring is at least ring * cell size away
+                if len(best) >= k and best[-1][0] <= ring * cell_m:
+                    break
+                ring += 1
+        return [self._bin_dict(e, d) for d, _, e in best]
+
+    def _bins_in(self, source: str, bbox) -> List[Dict]:
+        result = []
+        for (src, _), (code, lat, lon, name, fill, _, _) in self._bins.items():
+            if src != source:
+                continue
+            if bbox is not None and not (
+                bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]
+            ):
+                continue
+            result.append({
+                "bin_id": code,
+                "location_name": name,
+                "lat": lat,
+                "lon": lon,
+                "predicted_fill_percent": fill,
+            })
+        return result
+
+
+# One index per worker process
+bin_index = BinIndex()
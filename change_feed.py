@@ -0,0 +1,193 @@
+"""
+Change feed of bin state for downstream consumers.
+
+Every bin upsert and prediction insert made by the sensor ingest
+(/api/prototype/submit, Flask and ASGI) and the prediction CSV upload
+appends a row to ``bin_changes`` in the same transaction. Rows get a
+monotonically increasing ``seq``, so a consumer keeps the last sequence
+number it has seen and asks for ``/api/changes?after=<seq>`` instead of
+reloading and diffing all predictions.
+
+Sequence numbers are assigned at insert time but become visible at
+commit, so on PostgreSQL a slow transaction (e.g. a large CSV upload)
+can commit a lower ``seq`` after a higher one was already read. Every
+row therefore records its ``horizon``: the first transaction id not yet
+assigned when it was inserted. Any transaction that could still commit
+a lower ``seq`` had an id below that, so once the oldest running
+transaction (the snapshot ``xmin``) has reached the horizon, everything
+in front of the row is final. :func:`read` stops a batch at the first
+row that is not settled yet, however long the transaction in front of
+it takes. Feed rows are written after the rows they describe, so the
+writing transaction already has an id. SQLite has a single writer and
+commits in ``seq`` order, so every visible row is settled there.
+
+/api/changes reads from the primary: a replica's snapshot lags it.
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import BigInteger
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from extensions import db
+from models import BinChange
+
+
+MAX_BATCH = 1000
+
+BIN_FIELDS = ("latitude", "longitude", "location_name", "capacity_litres")
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def bin_change(op: str, bin_pk: int, trash_can_id: str, source: str, data: Dict) -> Dict:
+    """Feed row for an inserted or updated bin; ``data`` holds the new values."""
+    return {
+        "entity": "bin",
+        "op": op,
+        "entity_id": bin_pk,
+        "source": source,
+        "trash_can_id": trash_can_id,
+        "data": {k: _json_value(v) for k, v in data.items()},
+        "created_at": datetime.utcnow(),
+    }
+
+
+def prediction_change(prediction_pk: int, trash_can_id: str, source: str,
+                      fill_percent: float, predicted_full_at: Optional[datetime]) -> Dict:
+    """Feed row for an inserted prediction."""
+    return {
+        "entity": "prediction",
+        "op": "insert",
+        "entity_id": prediction_pk,
+        "source": source,
+        "trash_can_id": trash_can_id,
+        "data": {
+            "predicted_fill_percent": fill_percent,
+            "predicted_full_at": _json_value(predicted_full_at),
+        },
+        "created_at": datetime.utcnow(),
+    }
+
+
+def changed_fields(current: Dict, updates: Dict) -> Dict:
+    """The entries of ``updates`` that differ from ``current``."""
+    return {k: v for k, v in updates.items() if v is not None and current.get(k) != v}
+
+
+# ---------- Commit horizon ----------
+
+class snapshot_xmax(FunctionElement):
+    """First transaction id not yet assigned (PostgreSQL; NULL elsewhere)."""
+    type = BigInteger()
+    inherit_cache = True
+
+
+class snapshot_xmin(FunctionElement):
+    """Oldest transaction id still running (PostgreSQL; NULL elsewhere)."""
+    type = BigInteger()
+    inherit_cache = True
+
+
+@compiles(snapshot_xmax)
+@compiles(snapshot_xmin)
+def _no_snapshot(element, compiler, **kw):
+    return "NULL"
+
+
+@compiles(snapshot_xmax, "postgresql")
+def _pg_snapshot_xmax(element, compiler, **kw):
+    return "pg_snapshot_xmax(pg_current_snapshot())::text::bigint"
+
+
+@compiles(snapshot_xmin, "postgresql")
+def _pg_snapshot_xmin(element, compiler, **kw):
+    return "pg_snapshot_xmin(pg_current_snapshot())::text::bigint"
+
+
+def insert_statement():
+    """INSERT for a list of feed rows; works on sync and async sessions."""
+    return BinChange.__table__.insert().values(horizon=snapshot_xmax())
+
+
+def record(changes: List[Dict], session=None) -> None:
+    """Append feed rows in the caller's transaction (no commit)."""
+    if changes:
+        session = session or db.session
+        # Pending ORM writes first, so the transaction has an id (see above)
+        session.flush()
+        session.execute(insert_statement(), changes)
+
+
+def serialize_change(change: BinChange) -> Dict:
+    return {
+        "seq": change.seq,
+        "entity": change.entity,
+        "op": change.op,
+        "entity_id": change.entity_id,
+        "source": change.source,
+        "bin_id": change.trash_can_id,
+        "data": change.data,
+        "recorded_at": change.created_at.isoformat(),
+    }
+
+
+def changes_statement(after: int, source: Optional[str] = None):
+    """SELECT changes with ``seq > after``, oldest first."""
+    stmt = db.select(BinChange).where(BinChange.seq > after)
+    if source:
+        stmt = stmt.where(BinChange.source == source)
+    return stmt.order_by(BinChange.seq)
+
+
+def read(after: int = 0, limit: int = 500, source: Optional[str] = None,
+         session=None) -> Dict:
+    """
+    Up to ``limit`` settled changes with ``seq > after``, oldest first.
+
+    Returns ``{"changes", "next_after", "has_more"}``; pass ``next_after``
+    as ``after`` on the next call. ``session`` must be on the primary.
+    """
+    session = session or db.session
+    limit = max(1, min(limit, MAX_BATCH))
+
+    # Taken before the rows, so it is never newer than what they show
+    xmin = session.execute(db.select(snapshot_xmin())).scalar()
+    rows = session.execute(changes_statement(after, source).limit(limit + 1)).scalars().all()
+
+    changes = []
+    for row in rows[:limit]:
+        if xmin is not None and row.horizon is not None and row.horizon > xmin:
+            # A transaction that was running when this row was written may
+            # still commit a lower seq
+            break
+        changes.append(row)
+
+    return {
+        "changes": [serialize_change(c) for c in changes],
+        "next_after": changes[-1].seq if changes else after,
+        # Only a full batch means the consumer should read again right away
+        "has_more": len(changes) == limit and len(rows) > limit,
+    }
+
+
+def settled_seq(session=None) -> int:
+    """
+    Feed position for a consumer that is about to load a full snapshot.
+
+    Every change up to the returned ``seq`` is committed, so reading on
+    from it after the snapshot misses nothing (changes already in the
+    snapshot may be read again). ``session`` must be on the primary.
+    """
+    session = session or db.session
+    xmin = session.execute(db.select(snapshot_xmin())).scalar()
+    if xmin is not None:
+        first_unsettled = session.execute(
+            db.select(db.func.min(BinChange.seq)).where(BinChange.horizon > xmin)
+        ).scalar()
+        if first_unsettled is not None:
+            return first_unsettled - 1
+    return session.execute(db.select(db.func.max(BinChange.seq))).scalar() or 0
@@ -0,0 +1,123 @@
+"""
+Flask CLI commands for operating the service.
+
+    flask --app app init-db             create tables and apply migrations
+    flask --app app db-upgrade          apply pending schema migrations
+    flask --app app check-query-plans   fail if a hot query needs a seq scan
+    flask --app app prune-predictions   roll up and delete expired predictions
+    flask --app app build-travel-tables refresh every depot's travel table
+    flask --app app simulate            replay history against route strategies
+"""
+import click
+
+
+def register(app) -> None:
+    """Attach all commands to ``app.cli``."""
+
+    @app.cli.command("init-db")
+    def init_db():
+        """Create missing tables and apply pending migrations."""
+        from app import init_db
+
+        init_db(app)
+        click.echo("database schema is up to date")
+
+    @app.cli.command("db-upgrade")
+    def db_upgrade():
+        """Apply pending schema migrations."""
+        import migrations
+
+        applied = migrations.upgrade()
+        if applied:
+            for name in applied:
+                click.echo(f"applied: {name}")
+        else:
+            click.echo("schema is up to date")
+
+    @app.cli.command("check-query-plans")
+    def check_query_plans():
+        """EXPLAIN every hot query and fail on sequential scans."""
+        import query_plans
+
+        failures = 0
+        for name, scans in query_plans.check_hot_queries().items():
+            if scans:
+                failures += 1
+                click.echo(f"FAIL {name}: sequential scan on {', '.join(scans)}")
+            else:
+                click.echo(f"ok   {name}")
+        if failures:
+            raise SystemExit(1)
+
+    @app.cli.command("prune-predictions")
+    def prune_predictions():
+        """Roll predictions past the retention period into aggregates."""
+        import retention
+
+        result = retention.rollup_and_prune()
+        click.echo(f"deleted {result['deleted']} predictions older than {result['cutoff']}")
+
+    @app.cli.command("build-travel-tables")
+    @click.option("--rebuild", is_flag=True, help="Recompute every bin, not just changed ones.")
+    def build_travel_tables(rebuild):
+        """Bring the depot-to-bin travel tables up to date."""
+        import depots
+
+        for depot in depots.list_depots():
+            table = depots.TravelTable(depot.id, depot.latitude, depot.longitude)
+            updated = table.refresh(force=True, rebuild=rebuild)
+            click.echo(f"{depot.name}: {updated} bins updated, {table.stats()['bins']} in table")
+
+    @app.cli.command("simulate")
+    @click.option("--source", default="prototype", show_default=True)
+    @click.option("--start", type=click.DateTime(["%Y-%m-%d"]), required=True, help="First day (UTC).")
+    @click.option("--end", type=click.DateTime(["%Y-%m-%d"]), required=True, help="Day after the last one.")
+    @click.option("--mode", "modes", multiple=True, default=["nearest"], show_default=True,
+                  help="Optimizer mode; repeat to compare several.")
+    @click.option("--threshold", "thresholds", multiple=True, type=float, default=[70.0], show_default=True,
+                  help="Fill threshold; repeat to compare several.")
+    @click.option("--budget-min", "budgets", multiple=True, type=float,
+                  help="Priority mode duration budget; repeat to compare several.")
+    @click.option("--depot", help="Registered depot name or id.")
+    @click.option("--depot-lat", type=float, default=55.6761, show_default=True)
+    @click.option("--depot-lon", type=float, default=12.5683, show_default=True)
+    @click.option("--workers", type=int, help="Scenario processes (default SIMULATION_WORKERS).")
+    @click.option("--json", "as_json", is_flag=True, help="Print full results, including per-day rows, as JSON.")
+    def simulate(source, start, end, modes, thresholds, budgets, depot, depot_lat, depot_lon,
+                 workers, as_json):
+        """Replay stored fill history with each route strategy and compare them."""
+        import json
+
+        import depots
+        import simulation
+        from route_optimizer import ROUTE_MODES
+
+        for mode in modes:
+            if mode not in ROUTE_MODES:
+                raise click.BadParameter(f"must be one of {', '.join(ROUTE_MODES)}", param_hint="--mode")
+        if end <= start:
+            raise click.BadParameter("must be after --start", param_hint="--end")
+        try:
+            depot_lat, depot_lon, depot_obj = depots.depot_from_params(
+                {"depot": depot, "depot_lat": depot_lat, "depot_lon": depot_lon}, depot_lat, depot_lon
+            )
+        except LookupError as e:
+            raise click.BadParameter(str(e), param_hint="--depot")
+
+        history = simulation.load_history(source, start.date(), end.date())
+        if depot_obj is not None:
+            depots.attach_depot_distances(history["bins"], depot_obj)
+        results = simulation.run(
+            history, simulation.scenarios(modes, thresholds, budgets), depot_lat, depot_lon, workers
+        )
+
+        if as_json:
+            click.echo(json.dumps(results, indent=2))
+            return
+        click.echo(f"{len(history['bins'])} bins, {len(history['days'])} days of {source} history")
+        click.echo(f"{'mode':<12} {'threshold':>9} {'budget':>7} {'routes':>6} {'stops':>6} "
+                   f"{'km':>9} {'truck h':>8} {'overflows':>9}")
+        for r in results:
+            budget = "-" if r["budget_min"] is None else f"{r['budget_min']:g}"
+            click.echo(f"{r['mode']:<12} {r['threshold']:>9g} {budget:>7} {r['routes']:>6} {r['stops']:>6} "
+                       f"{r['total_distance_km']:>9.1f} {r['truck_hours']:>8.1f} {r['overflow_events']:>9}")
@@ -0,0 +1,320 @@
+"""
+Typed, streaming CSV parsing shared by the upload handlers.
+
+Uploads are read as a generator of batches, so memory is bounded by the
+batch size and not by the file. Each batch is parsed column by column:
+one ``map`` of the column's parser over all of its values (missing
+values become the default either way), and a per-value pass (to find
+which rows are bad) only when that fails. Timestamps remember the format
+that last matched and the values already seen, since upload columns tend
+to repeat a handful of formats and times.
+
+Rows with a missing required value or a value that does not parse are
+left out and recorded in an :class:`IngestReport` with their line
+number, instead of silently becoming 0.0 or None.
+
+    report = csv_ingest.IngestReport()
+    for rows in csv_ingest.read_batches(file.stream, csv_ingest.prediction_columns(), report):
+        ...
+    report.summary()
+"""
+import csv
+import io
+import math
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+BATCH_SIZE = 500
+MAX_REPORTED_ERRORS = 50
+
+# Spellings of "no value" besides the empty string
+MISSING = {"", "nan", "null", "none", "n/a", "-"}
+
+
+class CSVSchemaError(ValueError):
+    """The header is missing a required column."""
+
+
+class Column:
+    """
+    One CSV column: header name (or ``aliases``), parser and default.
+
+    ``parse`` receives the raw string and raises ValueError if it is not
+    valid. A missing value is an error for ``required`` columns and
+    ``default`` otherwise.
+    """
+    __slots__ = ("name", "parse", "required", "default", "aliases")
+
+    def __init__(self, name: str, parse: Callable[[str], object], required: bool = False,
+                 default=None, aliases: Sequence[str] = ()):
+        self.name = name
+        self.parse = parse
+        self.required = required
+        self.default = default
+        self.aliases = tuple(aliases)
+
+
+# ---------- Parsers ----------
+
+def number(min_value: float = -math.inf, max_value: float = math.inf) -> Callable[[str], float]:
+    """Parser for finite floats within [min_value, max_value]."""
+    def parse(value: str) -> float:
+        result = float(value)
+        if not min_value <= result <= max_value:
+            # Also rejects NaN, which compares false with everything
+            raise ValueError(f"{value.strip()} is not between {min_value:g} and {max_value:g}")
+        return result
+    return parse
+
+
+def integer(value: str) -> int:
+    return int(value)
+
+
+def text(value: str) -> str:
+    value = value.strip()
+    if not value:
+        raise ValueError("empty")
+    return value
+
+
+class TimestampParser:
+    """
+    Naive UTC datetimes from ISO 8601 or one of FORMATS.
+
+    The format that matched last is tried first, and parsed values are
+    memoized (bounded), so a column in one format costs one strptime per
+    distinct value.
+    """
+    FORMATS = (
+        "%Y-%m-%d %H:%M:%S",
+        "%Y-%m-%dT%H:%M:%S",
+        "%Y-%m-%d %H:%M",
+        "%d/%m/%Y %H:%M:%S",
+        "%d/%m/%Y %H:%M",
+        "%d.%m.%Y %H:%M",
+        "%m/%d/%Y %H:%M:%S",
+    )
+    MEMO_SIZE = 4096
+
+    def __init__(self):
+        self._format = None
+        self._memo: Dict[str, datetime] = {}
+
+    def __call__(self, value: str) -> datetime:
+        parsed = self._memo.get(value)
+        if parsed is None:
+            parsed = self._parse(value.strip())
+            if len(self._memo) >= self.MEMO_SIZE:
+                self._memo.clear()
+            self._memo[value] = parsed
+        return parsed
+
+    def _parse(self, value: str) -> datetime:
+        if self._format is None:
+            try:
+                parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            except ValueError:
+                pass
+            else:
+                if parsed.tzinfo is not None:
+                    parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+                return parsed
+            formats = self.FORMATS
+        else:
+            formats = (self._format,) + self.FORMATS
+        for fmt in formats:
+            try:
+                parsed = datetime.strptime(value, fmt)
+            except ValueError:
+                continue
+            self._format = fmt
+            return parsed
+        if self._format is not None:
+            # The column may switch back to ISO 8601
+            self._format = None
+            return self._parse(value)
+        raise ValueError(f"unrecognised date/time {value!r}")
+
+
+# ---------- Schemas ----------
+
+def prediction_columns() -> List[Column]:
+    """predictions_test.csv (see README)."""
+    return [
+        Column("bin_id", text, required=True),
+        Column("current_fill_pct", number(0.0), required=True),
+        Column("predicted_full_at", TimestampParser()),
+        Column("lat", number(-90.0, 90.0)),
+        Column("lon", number(-180.0, 180.0)),
+        Column("location_name", text),
+    ]
+
+
+def route_columns() -> List[Column]:
+    """route_test_for_dashboard.csv (see README); order_index defaults to the row number."""
+    return [
+        Column("order_index", integer, aliases=("stop_order",)),
+        Column("bin_id", text),
+        Column("lat", number(-90.0, 90.0), required=True),
+        Column("lon", number(-180.0, 180.0), required=True),
+        Column("distance_from_prev_km", number(0.0), default=0.0),
+        Column("est_travel_time_min", number(0.0), default=0.0),
+        Column("label", text),
+        Column("route_name", text),
+    ]
+
+
+# ---------- Reading ----------
+
+class IngestReport:
+    """Row counts and the first MAX_REPORTED_ERRORS problems of an upload."""
+
+    def __init__(self):
+        self.rows = 0
+        self.accepted = 0
+        self.error_count = 0
+        self.errors: List[Dict] = []
+        self.truncated = False
+
+    @property
+    def rejected(self) -> int:
+        return self.rows - self.accepted
+
+    def error(self, line: int, column: str, value, message: str) -> None:
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "column": column, "value": value, "error": message})
+
+    def summary(self) -> str:
+        text = f"{self.accepted} of {self.rows} rows accepted"
+        if self.rejected:
+            text += f", {self.rejected} rejected ({self.error_count} error{'s' if self.error_count != 1 else ''})"
+        if self.truncated:
+            text += "; stopped at the row limit"
+        return text
+
+    def to_dict(self) -> Dict:
+        return {
+            "rows": self.rows,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "error_count": self.error_count,
+            "errors": self.errors,
+            "truncated": self.truncated,
+        }
+
+
+def _is_missing(value: Optional[str]) -> bool:
+    return value is None or value.strip().lower() in MISSING
+
+
+def _value_parser(column: Column) -> Callable[[Optional[str]], object]:
+    """``column.parse`` with the same missing-value handling as the slow path."""
+    parse, default, required = column.parse, column.default, column.required
+
+    def parse_value(value: Optional[str]):
+        if _is_missing(value):
+            if required:
+                raise ValueError("missing value")
+            return default
+        return parse(value)
+    return parse_value
+
+
+def _parse_column(column: Column, values: List[Optional[str]], lines: List[int],
+                  valid: List[bool], report: IngestReport) -> List:
+    try:
+        # Fast path: no required value missing and every present value valid
+        return list(map(_value_parser(column), values))
+    except (TypeError, ValueError):
+        pass
+
+    parsed = []
+    for i, value in enumerate(values):
+        if _is_missing(value):
+            if column.required:
+                report.error(lines[i], column.name, value, "missing value")
+                valid[i] = False
+            parsed.append(column.default)
+            continue
+        try:
+            parsed.append(column.parse(value))
+        except (TypeError, ValueError) as e:
+            report.error(lines[i], column.name, value, str(e))
+            valid[i] = False
+            parsed.append(None)
+    return parsed
+
+
+def _header_index(header: List[str], columns: List[Column]) -> Dict[str, Optional[int]]:
+    positions = {name.strip(): i for i, name in enumerate(header)}
+    index = {}
+    missing = []
+    for column in columns:
+        pos = next((positions[n] for n in (column.name,) + column.aliases if n in positions), None)
+        if pos is None and column.required:
+            missing.append(column.name)
+        index[column.name] = pos
+    if missing:
+        raise CSVSchemaError(f"Missing columns: {', '.join(missing)}")
+    return index
+
+
+def _parse_batch(raw: List[List[str]], lines: List[int], columns: List[Column],
+                 index: Dict[str, Optional[int]], report: IngestReport) -> List[Dict]:
+    valid = [True] * len(raw)
+    parsed = {}
+    for column in columns:
+        pos = index[column.name]
+        if pos is None:
+            parsed[column.name] = [column.default] * len(raw)
+            continue
+        values = [row[pos] if pos < len(row) else None for row in raw]
+        parsed[column.name] = _parse_column(column, values, lines, valid, report)
+
+    names = list(parsed)
+    rows = [
+        dict(zip(names, values), line=line)
+        for ok, line, values in zip(valid, lines, zip(*parsed.values()))
+        if ok
+    ]
+    report.accepted += len(rows)
+    return rows
+
+
+def read_batches(stream, columns: List[Column], report: IngestReport,
+                 batch_size: int = BATCH_SIZE, max_rows: Optional[int] = None,
+                 encoding: str = "utf-8-sig") -> Iterator[List[Dict]]:
+    """
+    Parse a binary upload stream into batches of valid row dicts.
+
+    Every row dict has one key per column plus ``line`` (the 1-based CSV
+    line it started on). Blank lines are skipped; rows past ``max_rows``
+    are not read. Raises CSVSchemaError before the first batch if a
+    required column is missing from the header.
+    """
+    text_stream = io.TextIOWrapper(stream, encoding=encoding, newline="")
+    reader = csv.reader(text_stream)
+    header = next(reader, None)
+    if header is None:
+        return
+    index = _header_index(header, columns)
+
+    raw, lines = [], []
+    line = reader.line_num
+    for row in reader:
+        start, line = line + 1, reader.line_num
+        if not any(cell.strip() for cell in row):
+            continue
+        if max_rows is not None and report.rows >= max_rows:
+            report.truncated = True
+            break
+        report.rows += 1
+        raw.append(row)
+        lines.append(start)
+        if len(raw) >= batch_size:
+            yield _parse_batch(raw, lines, columns, index, report)
+            raw, lines = [], []
+    if raw:
+        yield _parse_batch(raw, lines, columns, index, report)
@@ -0,0 +1,157 @@
+"""
+Consolidated data for the dashboard.
+
+One call returns everything a dashboard tab shows for a source: summary
+stats, the latest prediction per bin and the active route with its
+totals. It is built with three queries (an aggregate over the latest
+prediction per bin, the latest rows themselves and the active route id;
+route versions are cached by route_store) and cached per worker.
+
+Only the threshold-independent part is cached, once per source (there
+are just SOURCES); the count of bins over the requested threshold is
+taken from the cached predictions on every request. A cached payload is
+reused while its version is unchanged. Every prediction and bin write
+appends to the change feed (see change_feed.py), so the version is the
+feed's settled position and newest sequence number plus the active
+route id. The newest number alone misses a slow transaction that
+commits a lower number after a higher one was read; the settled
+position only moves past it once it has committed. Writes that bypass
+the feed (retention pruning) show up after at most
+DASHBOARD_CACHE_SECONDS.
+
+Environment variables:
+    DASHBOARD_CACHE_SECONDS   maximum age of a cached payload (default 30)
+"""
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from extensions import db
+from models import Bin, BinChange, MLPrediction
+import change_feed
+import route_store
+
+
+DASHBOARD_CACHE_SECONDS = float(os.environ.get("DASHBOARD_CACHE_SECONDS", "30"))
+URGENT_FILL_PERCENT = 80.0
+SOURCES = ("test", "prototype")
+
+_cache: Dict[str, tuple] = {}
+_cache_lock = threading.Lock()
+
+
+def latest_ids(source: str):
+    """Id of the latest prediction of every bin of a source."""
+    return (
+        db.select(db.func.max(MLPrediction.id))
+        .where(MLPrediction.source == source)
+        .where(MLPrediction.bin_id.isnot(None))
+        .group_by(MLPrediction.bin_id)
+    )
+
+
+def latest_predictions_statement(source: str):
+    """SELECT (MLPrediction, Bin) for the latest prediction per bin, fullest first."""
+    return (
+        db.select(MLPrediction, Bin)
+        .join(Bin, MLPrediction.bin_id == Bin.id)
+        .where(MLPrediction.id.in_(latest_ids(source)))
+        .order_by(MLPrediction.predicted_fill_percent.desc())
+    )
+
+
+def summary_statement(source: str):
+    """Bin count, average fill and urgent bins."""
+    fill = MLPrediction.predicted_fill_percent
+    return (
+        db.select(
+            db.func.count(),
+            db.func.avg(fill),
+            db.func.sum(db.case((fill >= URGENT_FILL_PERCENT, 1), else_=0)),
+            db.func.max(MLPrediction.created_at),
+        )
+        .where(MLPrediction.id.in_(latest_ids(source)))
+    )
+
+
+def data_version(source: str, session) -> Tuple[int, int, int]:
+    """
+    ``(settled seq, newest seq, active route id)``, read on the session
+    that builds the payload so they match what it sees.
+    """
+    settled = change_feed.settled_seq(session)
+    newest = session.execute(db.select(db.func.max(BinChange.seq))).scalar() or 0
+    return settled, newest, route_store.get_active_route_id(source, session) or 0
+
+
+def _route_section(route_id, session) -> Dict:
+    payload = route_store.get_route_payload(route_id, session) if route_id else None
+    if not payload:
+        return {"route_id": None, "name": None, "stops": [], "stats": None}
+    stops = payload["stops"]
+    total_km = sum(s["distance_from_prev_km"] or 0 for s in stops)
+    total_min = sum(s["est_travel_time_min"] or 0 for s in stops)
+    return {
+        "route_id": payload["route_id"],
+        "name": payload.get("name"),
+        "created_at": payload.get("created_at"),
+        "stops": stops,
+        "stats": {
+            "total_stops": sum(1 for s in stops if s["bin_id"]),
+            "total_distance_km": round(total_km, 2),
+            "total_time_min": round(total_min, 1),
+            "total_time_hours": round(total_min / 60, 2),
+        },
+    }
+
+
+def build(source: str, session, version: Tuple[int, int]) -> Dict:
+    """The threshold-independent payload; see :func:`get`."""
+    from routes.api import serialize_prediction
+
+    count, avg_fill, urgent, last_recorded = session.execute(summary_statement(source)).one()
+    predictions = [
+        serialize_prediction(p, bin_obj)
+        for p, bin_obj in session.execute(latest_predictions_statement(source)).all()
+    ]
+    return {
+        "source": source,
+        "version": "-".join(map(str, version)),
+        "summary": {
+            "bins": count,
+            "avg_fill_percent": round(avg_fill, 1) if avg_fill is not None else None,
+            "bins_urgent": urgent or 0,
+            "last_recorded_at": last_recorded.isoformat() if last_recorded else None,
+        },
+        "predictions": predictions,
+        "route": _route_section(version[2], session),
+    }
+
+
+def get(source: str, threshold: float, session) -> Optional[Dict]:
+    """
+    The dashboard payload for a source, from cache when unchanged, or
+    None for a source not in SOURCES.
+    """
+    if source not in SOURCES:
+        return None
+    version = data_version(source, session)
+    now = time.monotonic()
+    with _cache_lock:
+        cached = _cache.get(source)
+    if cached is not None and cached[0] == version and now - cached[1] < DASHBOARD_CACHE_SECONDS:
+        payload = cached[2]
+    else:
+        payload = build(source, session, version)
+        with _cache_lock:
+            _cache[source] = (version, now, payload)
+
+    over = sum(1 for p in payload["predictions"] if (p["predicted_fill_percent"] or 0) >= threshold)
+    summary = dict(payload["summary"], threshold=threshold, bins_over_threshold=over)
+    return dict(payload, summary=summary)
+
+
+def clear() -> None:
+    with _cache_lock:
+        _cache.clear()
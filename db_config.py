@@ -0,0 +1,119 @@
+"""
+Database configuration: connection pooling, statement caching and
+read-replica routing.
+
+Environment variables:
+    DATABASE_URL           primary (read/write) database
+    DATABASE_REPLICA_URL   optional read-only replica
+    DB_POOL_SIZE           connections kept open per worker (default 5)
+    DB_MAX_OVERFLOW        extra connections allowed under load (default 10)
+    DB_POOL_TIMEOUT        seconds to wait for a free connection (default 30)
+    DB_POOL_RECYCLE        seconds before a connection is replaced (default 1800)
+    DB_QUERY_CACHE_SIZE    compiled-statement cache entries per engine (default 1200)
+    DB_PREPARE_THRESHOLD   executions before psycopg 3 prepares a statement
+                           server-side (default 5; psycopg2 cannot prepare)
+
+Read-only endpoints call :func:`read_session`, which returns a session on
+the replica when one is configured and the primary session otherwise.
+"""
+import os
+from typing import Optional
+
+from flask import current_app, g
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from extensions import db
+
+
+REPLICA_BIND = "replica"
+
+
+def database_url_from_env(name: str = "DATABASE_URL") -> Optional[str]:
+    """Read a database URL, fixing Render's postgres:// scheme."""
+    url = os.environ.get(name)
+
+    # Render often provides postgres:// but SQLAlchemy expects postgresql://
+    if url and url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+
+def engine_options(url: Optional[str]) -> dict:
+    """Pool and statement-cache options for an engine on ``url``."""
+    options = {
+        "pool_pre_ping": True,
+        "query_cache_size": int(os.environ.get("DB_QUERY_CACHE_SIZE", "1200")),
+    }
+    if not url or url.startswith("sqlite"):
+        # SQLite uses a single-connection / per-thread pool
+        return options
+
+    options.update(
+        pool_size=int(os.environ.get("DB_POOL_SIZE", "5")),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "10")),
+        pool_timeout=int(os.environ.get("DB_POOL_TIMEOUT", "30")),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+    )
+    if url.startswith("postgresql+psycopg://"):
+        # psycopg 3 prepares hot statements on the server after N executions
+        options["connect_args"] = {
+            "prepare_threshold": int(os.environ.get("DB_PREPARE_THRESHOLD", "5")),
+        }
+    return options
+
+
+def configure(app) -> None:
+    """Populate SQLAlchemy config on ``app`` from the environment."""
+    database_url = database_url_from_env("DATABASE_URL")
+    replica_url = database_url_from_env("DATABASE_REPLICA_URL")
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_url)
+    if replica_url:
+        app.config["SQLALCHEMY_BINDS"] = {
+            REPLICA_BIND: {"url": replica_url, **engine_options(replica_url)},
+        }
+
+    @app.teardown_appcontext
+    def _close_read_session(exc):
+        session = g.pop("_read_session", None)
+        if session is not None:
+            session.close()
+
+
+def dialect_insert(session=None, dialect: Optional[str] = None):
+    """
+    Dialect-specific ``insert`` construct for the session's database
+    (or for the ``dialect`` name, e.g. from an async engine).
+
+    PostgreSQL and SQLite both support ``ON CONFLICT`` upserts through
+    these constructs; other databases get the generic insert.
+    """
+    dialect = dialect or (session or db.session).get_bind().dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert
+    if dialect == "sqlite":
+        return sqlite.insert
+    return db.insert
+
+
+def has_replica() -> bool:
+    return REPLICA_BIND in current_app.config.get("SQLALCHEMY_BINDS", {})
+
+
+def read_session():
+    """
+    Session for read-only queries.
+
+    Uses the replica when DATABASE_REPLICA_URL is set (one session per
+    app context), otherwise the normal read/write session.
+    """
+    if not has_replica():
+        return db.session
+
+    session = g.get("_read_session")
+    if session is None:
+        session = Session(bind=db.engines[REPLICA_BIND])
+        g._read_session = session
+    return session
@@ -0,0 +1,521 @@
+"""
+Registered depots and their precomputed travel tables.
+
+Depots are fixed, so the distance and travel time from each depot to
+every bin is computed once and kept in a table on disk, one file per
+depot in TRAVEL_TABLE_DIR. The file is a flat array of float64 slots
+indexed by bin primary key (latitude, longitude, km, minutes), so every
+worker memory-maps the same file and looks a bin up in O(1) without
+loading the table into its own memory.
+
+Tables refresh incrementally: the sidecar ``.json`` file records the
+last change feed sequence number applied (see change_feed.py), and a
+refresh only recomputes the bins that were added or moved since then.
+A table is rebuilt from scratch when its depot moves.
+
+Each slot also holds the bin's TRAVEL_TABLE_NEIGHBORS nearest bins
+(primary key and km). The nearest neighbor tour spends nearly all of
+its time scanning every remaining bin for the closest one; with the
+lists it usually takes the first unvisited entry instead and only falls
+back to a scan once all of them are visited. An all-pairs table would
+be quadratic in the number of bins; the lists are linear. The depot
+legs cost no more to compute than to look up, but they come with the
+same slot, so route solves attach both: ``depot_km`` for the first and
+last legs and ``neighbors`` for the tour.
+
+Environment variables:
+    TRAVEL_TABLE_DIR                directory for the tables (default travel_tables/)
+    TRAVEL_TABLE_REFRESH_SECONDS    minimum interval between refreshes per
+                                    worker (default 5)
+    TRAVEL_TABLE_NEIGHBORS          nearest bins kept per bin (default 8)
+"""
+import fcntl
+import json
+import math
+import mmap
+import os
+import tempfile
+import threading
+import time
+import uuid
+from array import array
+from contextlib import contextmanager
+from itertools import chain
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import change_feed
+from extensions import db
+from models import Bin, Depot
+
+
+TRAVEL_TABLE_DIR = os.environ.get("TRAVEL_TABLE_DIR", "travel_tables")
+REFRESH_SECONDS = float(os.environ.get("TRAVEL_TABLE_REFRESH_SECONDS", "5"))
+
+NEIGHBORS = int(os.environ.get("TRAVEL_TABLE_NEIGHBORS", "8"))
+
+# float64 values per bin slot: latitude, longitude, km, minutes, then
+# NEIGHBORS (bin pk, km) pairs, nearest first and NaN-padded
+DEPOT_PART = 4
+SLOT = DEPOT_PART + 2 * NEIGHBORS
+LOOKUP_CHUNK = 500
+
+# Nearest-bin search: rings of grid cells searched before comparing the
+# remaining bins directly (sparse outliers), and km per degree of latitude
+MAX_RINGS = 16
+KM_PER_DEGREE = 111.195
+
+
+# ---------- Registry ----------
+
+def get_depot(ref, session=None) -> Optional[Depot]:
+    """A depot by id or name."""
+    session = session or db.session
+    if isinstance(ref, int) or str(ref).isdigit():
+        return session.get(Depot, int(ref))
+    return session.execute(db.select(Depot).where(Depot.name == str(ref))).scalar()
+
+
+def list_depots(session=None) -> List[Depot]:
+    session = session or db.session
+    return session.execute(db.select(Depot).order_by(Depot.name)).scalars().all()
+
+
+def register_depot(name: str, lat: float, lon: float) -> Tuple[Depot, bool]:
+    """Create or move a depot (no commit). Returns ``(depot, created)``."""
+    depot = db.session.execute(db.select(Depot).where(Depot.name == name)).scalar()
+    if depot is None:
+        depot = Depot(name=name, latitude=lat, longitude=lon)
+        db.session.add(depot)
+        db.session.flush()
+        return depot, True
+    depot.latitude, depot.longitude = lat, lon
+    return depot, False
+
+
+def depot_from_params(data: Dict, default_lat: float, default_lon: float):
+    """
+    ``(lat, lon, depot)`` for a route request: the registered depot named
+    by ``depot`` (name or id), else ``depot_lat`` / ``depot_lon`` and None.
+
+    Raises LookupError for an unknown depot and ValueError for bad
+    coordinates.
+    """
+    ref = data.get("depot")
+    if ref is not None and ref != "":
+        depot = get_depot(ref)
+        if depot is None:
+            raise LookupError(f"Unknown depot {ref}")
+        return depot.latitude, depot.longitude, depot
+    return float(data.get("depot_lat", default_lat)), float(data.get("depot_lon", default_lon)), None
+
+
+def depot_to_dict(depot: Depot) -> Dict:
+    return {
+        "id": depot.id,
+        "name": depot.name,
+        "lat": depot.latitude,
+        "lon": depot.longitude,
+        "created_at": depot.created_at.isoformat() if depot.created_at else None,
+    }
+
+
+# ---------- Nearest bins ----------
+
+class _NeighborGrid:
+    """
+    Bins bucketed into square lat/lon cells for nearest-bin searches.
+
+    The cell size follows the density of the occupied areas (about
+    NEIGHBORS bins per cell), so a search usually reads a few rings of
+    cells around the bin. Bins more than MAX_RINGS rings away are
+    compared directly.
+    """
+
+    def __init__(self, points: Dict[int, Tuple[float, float]], distance):
+        self.points = points
+        self.distance = distance
+        coarse = {}
+        for lat, lon in points.values():
+            key = (math.floor(lat * 100), math.floor(lon * 100))
+            coarse[key] = coarse.get(key, 0) + 1
+        per_cell = len(points) / len(coarse) if coarse else 1.0
+        self.cell_deg = min(max(0.01 * math.sqrt(NEIGHBORS / per_cell), 0.0005), 0.05)
+        self.cells: Dict[Tuple[int, int], List[int]] = {}
+        for pk, (lat, lon) in points.items():
+            self.cells.setdefault(self._cell(lat, lon), []).append(pk)
+        # Cells are narrowest (east-west) at the highest latitude searched;
+        # slightly under the true width so the bound stays conservative
+        top = min(max((abs(lat) for lat, _ in points.values()), default=0.0)
+                  + (MAX_RINGS + 1) * self.cell_deg, 89.0)
+        self._cell_km = self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(top)) * 0.999
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def _ring(self, cell: Tuple[int, int], r: int) -> Iterator[int]:
+        ci, cj = cell
+        if r == 0:
+            keys = [cell]
+        else:
+            keys = [(ci - r, j) for j in range(cj - r, cj + r + 1)]
+            keys += [(ci + r, j) for j in range(cj - r, cj + r + 1)]
+            keys += [(i, cj - r) for i in range(ci - r + 1, ci + r)]
+            keys += [(i, cj + r) for i in range(ci - r + 1, ci + r)]
+        for key in keys:
+            yield from self.cells.get(key, ())
+
+    def _beyond(self, cell: Tuple[int, int]) -> Iterator[int]:
+        """Bins more than MAX_RINGS rings from ``cell``."""
+        for pk, (lat, lon) in self.points.items():
+            ci, cj = self._cell(lat, lon)
+            if max(abs(ci - cell[0]), abs(cj - cell[1])) > MAX_RINGS:
+                yield pk
+
+    def ring_km(self, r: int) -> float:
+        """No bin in ring ``r`` is closer than this to a point in ring 0."""
+        return max(r - 1, 0) * self._cell_km
+
+    def within(self, lat: float, lon: float, km: float) -> Iterator[int]:
+        """Bins in the rings (up to MAX_RINGS) that may lie within ``km``."""
+        cell = self._cell(lat, lon)
+        for r in range(MAX_RINGS + 1):
+            if self.ring_km(r) > km:
+                return
+            yield from self._ring(cell, r)
+
+    def nearest(self, pk: int, k: int) -> List[Tuple[float, int]]:
+        """The ``k`` nearest other bins of ``pk`` as ``(km, pk)``, nearest first."""
+        lat, lon = self.points[pk]
+        cell = self._cell(lat, lon)
+        found: List[Tuple[float, int]] = []
+        for r in range(MAX_RINGS + 1):
+            if len(found) >= k and found[-1][0] < self.ring_km(r):
+                return found
+            for q in self._ring(cell, r):
+                if q != pk:
+                    found.append((self.distance(lat, lon, *self.points[q]), q))
+            found.sort()
+            del found[k:]
+        for q in self._beyond(cell):
+            found.append((self.distance(lat, lon, *self.points[q]), q))
+        found.sort()
+        return found[:k]
+
+
+def _neighbor_values(found: List[Tuple[float, int]]) -> array:
+    values = array("d", [math.nan]) * (SLOT - DEPOT_PART)
+    for n, (km, pk) in enumerate(found):
+        values[2 * n] = pk
+        values[2 * n + 1] = km
+    return values
+
+
+# ---------- Travel tables ----------
+
+class TravelTable:
+    """
+    Memory-mapped depot-to-bin distances and travel times of one depot,
+    with each bin's nearest bins.
+    """
+
+    def __init__(self, depot_id: int, lat: float, lon: float):
+        self.depot_id = depot_id
+        self.lat = lat
+        self.lon = lon
+        self.path = os.path.join(TRAVEL_TABLE_DIR, f"depot_{depot_id}.f64")
+        self.meta_path = os.path.join(TRAVEL_TABLE_DIR, f"depot_{depot_id}.json")
+        # Not at module level: app.py imports this module at worker start,
+        # and the optimizer (process pools, k-means) loads lazily
+        from route_optimizer import RouteOptimizer
+        self._optimizer = RouteOptimizer(lat, lon)
+        # _lock serializes refreshes; _map_lock guards the mapping, which
+        # readers on other threads use while a refresh runs
+        self._lock = threading.Lock()
+        self._map_lock = threading.RLock()
+        self._file = None
+        self._mmap = None
+        self._values = None
+        self._generation = None
+        self._checked_at = 0.0
+
+    # ---------- Files ----------
+
+    def _read_meta(self) -> Optional[Dict]:
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta: Dict) -> None:
+        fd, tmp = tempfile.mkstemp(dir=TRAVEL_TABLE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.meta_path)
+
+    @contextmanager
+    def _file_lock(self):
+        """Serialize refreshes across the workers sharing the directory."""
+        os.makedirs(TRAVEL_TABLE_DIR, exist_ok=True)
+        with open(self.path + ".lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _unmap(self) -> None:
+        with self._map_lock:
+            if self._values is not None:
+                self._values.release()
+                self._mmap.close()
+                self._file.close()
+            self._file = self._mmap = self._values = None
+
+    def _map(self) -> None:
+        """(Re)map the data file if it was replaced or has grown."""
+        with self._map_lock:
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                self._unmap()
+                return
+            if self._values is not None and len(self._values) * 8 == size:
+                return
+            self._unmap()
+            if size == 0:
+                return
+            self._file = open(self.path, "r+b")
+            self._mmap = mmap.mmap(self._file.fileno(), 0)
+            self._values = memoryview(self._mmap).cast("d")
+
+    def _depot_values(self, lat: float, lon: float) -> Tuple[float, float, float, float]:
+        km = self._optimizer.haversine_distance(self.lat, self.lon, lat, lon)
+        return lat, lon, km, km / self._optimizer.avg_speed_kmh * 60
+
+    def _write(self, rows) -> Tuple[int, int]:
+        """
+        Store the depot part of ``(bin pk, lat, lon)`` rows in place,
+        growing the file as needed. Returns the number of rows written and
+        of those that filled an empty slot.
+        """
+        rows = [r for r in rows if r[1] is not None and r[2] is not None]
+        if not rows:
+            return 0, 0
+        slots = max(r[0] for r in rows) + 1
+        current = os.path.getsize(self.path) // (8 * SLOT) if os.path.exists(self.path) else 0
+        if slots > current:
+            # Empty slots hold NaN (a latitude of 0.0 is valid)
+            with open(self.path, "ab") as f:
+                (array("d", [math.nan]) * (SLOT * (slots - current))).tofile(f)
+        slot_values = [(pk, array("d", self._depot_values(lat, lon))) for pk, lat, lon in rows]
+        added = 0
+        with self._map_lock:
+            self._map()
+            values = self._values
+            for pk, slot in slot_values:
+                base = pk * SLOT
+                added += values[base] != values[base]  # NaN: empty until now
+                values[base:base + DEPOT_PART] = slot
+            self._mmap.flush()
+        return len(rows), added
+
+    def _update_neighbors(self, moved: set) -> int:
+        """
+        Recompute the nearest-bin lists that ``moved`` bins (already
+        written) can change: their own, those listing one of them, and
+        those of bins they moved closer to than the bin's farthest entry.
+        Returns the number of lists recomputed.
+        """
+        points, lists = {}, {}
+        with self._map_lock:
+            self._map()
+            values = self._values
+            for pk in range(len(values) // SLOT if values is not None else 0):
+                base = pk * SLOT
+                if values[base] == values[base]:
+                    points[pk] = (values[base], values[base + 1])
+                    lists[pk] = values[base + DEPOT_PART:base + SLOT].tolist()
+        moved = moved & points.keys()
+        if not moved:
+            return 0
+        grid = _NeighborGrid(points, self._optimizer.haversine_distance)
+
+        if len(moved) * 4 >= len(points):
+            affected = set(points)
+        else:
+            affected = set(moved)
+            kth = {}
+            for pk, entries in lists.items():
+                if any(int(q) in moved for q in entries[0::2] if q == q):
+                    affected.add(pk)
+                last = entries[-1]
+                # A list that is not full takes any bin
+                kth[pk] = last if last == last else math.inf
+            reach = max(kth.values(), default=0.0)
+            # Bins beyond MAX_RINGS rings of a moved bin only matter when
+            # their lists reach that far
+            far = [pk for pk, km in kth.items() if km >= grid.ring_km(MAX_RINGS + 1)]
+            distance = self._optimizer.haversine_distance
+            for m in moved:
+                lat, lon = points[m]
+                for pk in chain(grid.within(lat, lon, reach), far):
+                    if pk != m and pk not in affected and distance(lat, lon, *points[pk]) < kth[pk]:
+                        affected.add(pk)
+
+        found = {pk: _neighbor_values(grid.nearest(pk, NEIGHBORS)) for pk in affected}
+        with self._map_lock:
+            self._map()
+            values = self._values
+            for pk, part in found.items():
+                values[pk * SLOT + DEPOT_PART:(pk + 1) * SLOT] = part
+            self._mmap.flush()
+        return len(found)
+
+    # ---------- Refresh ----------
+
+    def _rebuild(self, session) -> int:
+        # Changes still in flight, or recorded while scanning, are
+        # re-applied by the next refresh
+        seq = change_feed.settled_seq(session)
+        rows = session.execute(
+            db.select(Bin.id, Bin.latitude, Bin.longitude)
+            .where(Bin.latitude.isnot(None), Bin.longitude.isnot(None))
+        ).all()
+
+        os.makedirs(TRAVEL_TABLE_DIR, exist_ok=True)
+        values = array("d", [math.nan]) * (SLOT * (max((r[0] for r in rows), default=0) + 1))
+        grid = _NeighborGrid({pk: (lat, lon) for pk, lat, lon in rows},
+                             self._optimizer.haversine_distance)
+        for pk, lat, lon in rows:
+            base = pk * SLOT
+            values[base:base + DEPOT_PART] = array("d", self._depot_values(lat, lon))
+            values[base + DEPOT_PART:base + SLOT] = _neighbor_values(grid.nearest(pk, NEIGHBORS))
+        # Write then rename, so workers never map a partial file
+        fd, tmp = tempfile.mkstemp(dir=TRAVEL_TABLE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            values.tofile(f)
+        os.replace(tmp, self.path)
+
+        self._generation = uuid.uuid4().hex
+        self._write_meta({
+            "lat": self.lat, "lon": self.lon, "seq": seq,
+            "generation": self._generation, "bins": len(rows), "slot": SLOT,
+        })
+        with self._map_lock:
+            self._unmap()
+            self._map()
+        return len(rows)
+
+    def _apply_changes(self, meta: Dict, session) -> int:
+        after = meta["seq"]
+        moved = set()
+        while True:
+            batch = change_feed.read(after, change_feed.MAX_BATCH, session=session)
+            moved.update(
+                c["entity_id"] for c in batch["changes"]
+                if c["entity"] == "bin" and ("latitude" in c["data"] or "longitude" in c["data"])
+            )
+            after = batch["next_after"]
+            if not batch["has_more"]:
+                break
+        if after == meta["seq"]:
+            return 0
+
+        ids = sorted(moved)
+        updated = added = 0
+        for i in range(0, len(ids), LOOKUP_CHUNK):
+            written, filled = self._write(session.execute(
+                db.select(Bin.id, Bin.latitude, Bin.longitude)
+                .where(Bin.id.in_(ids[i:i + LOOKUP_CHUNK]))
+            ).all())
+            updated += written
+            added += filled
+        if updated:
+            self._update_neighbors(moved)
+        self._write_meta({**meta, "seq": after, "bins": meta["bins"] + added})
+        return updated
+
+    def refresh(self, force: bool = False, session=None, rebuild: bool = False) -> int:
+        """
+        Bring the table up to date (throttled per worker unless ``force``);
+        ``rebuild`` recomputes every bin.
+
+        Returns the number of bin slots recomputed.
+        """
+        now = time.monotonic()
+        if not force and now - self._checked_at < REFRESH_SECONDS:
+            return 0
+        self._checked_at = now
+        session = session or db.session
+
+        with self._lock, self._file_lock():
+            meta = self._read_meta()
+            if (rebuild or meta is None or not os.path.exists(self.path)
+                    or meta.get("slot") != SLOT  # older layout or other NEIGHBORS
+                    or (meta["lat"], meta["lon"]) != (self.lat, self.lon)):
+                return self._rebuild(session)
+            with self._map_lock:
+                if meta.get("generation") != self._generation:
+                    # Rebuilt by another worker: map the new file
+                    self._generation = meta.get("generation")
+                    self._unmap()
+                self._map()
+            return self._apply_changes(meta, session)
+
+    # ---------- Lookups ----------
+
+    def lookup(self, bin_pk: int, lat: float, lon: float) -> Optional[Tuple[float, float, List[int]]]:
+        """
+        ``(km, minutes, nearest bin pks)`` of a bin, or None when the table
+        has no entry for the bin at these coordinates (not refreshed yet).
+        """
+        with self._map_lock:
+            values = self._values
+            if values is None or (bin_pk + 1) * SLOT > len(values):
+                self._map()
+                values = self._values
+                if values is None or (bin_pk + 1) * SLOT > len(values):
+                    return None
+            base = bin_pk * SLOT
+            if values[base] != lat or values[base + 1] != lon:
+                return None
+            nearest = values[base + DEPOT_PART:base + SLOT].tolist()[0::2]
+            return values[base + 2], values[base + 3], [int(q) for q in nearest if q == q]
+
+    def stats(self) -> Dict:
+        """Bins covered and change feed position, from the sidecar meta."""
+        meta = self._read_meta() or {}
+        return {"bins": meta.get("bins", 0), "seq": meta.get("seq")}
+
+
+_tables: Dict[int, TravelTable] = {}
+_tables_lock = threading.Lock()
+
+
+def travel_table(depot: Depot, refresh: bool = True) -> TravelTable:
+    """This worker's table for a depot, refreshed if due (and ``refresh``)."""
+    with _tables_lock:
+        table = _tables.get(depot.id)
+        if table is None or (table.lat, table.lon) != (depot.latitude, depot.longitude):
+            table = _tables[depot.id] = TravelTable(depot.id, depot.latitude, depot.longitude)
+    if refresh:
+        table.refresh()
+    return table
+
+
+def attach_depot_distances(bins: List[Dict], depot: Depot) -> int:
+    """
+    Set ``depot_km`` and ``neighbors`` (nearest bin pks) on candidate
+    bins (from load_route_candidates) that the depot's table covers.
+    Returns how many were found.
+    """
+    table = travel_table(depot)
+    found = 0
+    for b in bins:
+        hit = table.lookup(b["bin_pk"], b["lat"], b["lon"])
+        if hit is not None:
+            b["depot_km"] = hit[0]
+            b["neighbors"] = hit[2]
+            found += 1
+    return found
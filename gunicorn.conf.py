@@ -0,0 +1,32 @@
+"""
+Gunicorn settings (picked up automatically from the working directory).
+
+The app is preloaded in the master process, so `create_app()` and all
+imports run once and workers start as cheap forks. Connections must not
+be shared across a fork, so each worker discards the engine pools it
+inherited in ``post_fork`` and opens its own connections on first use.
+
+Environment variables:
+    WEB_CONCURRENCY      number of workers (default 2)
+    GUNICORN_PRELOAD     set to 0 to import the app in every worker
+    GUNICORN_TIMEOUT     worker timeout in seconds (default 30)
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "30"))
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1").lower() in ("1", "true", "yes")
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+
+    from app import app
+    from extensions import db
+
+    with app.app_context():
+        for engine in db.engines.values():
+            # close=False: leave the parent's sockets alone, just forget them
+            engine.dispose(close=False)
@@ -0,0 +1,86 @@
+"""
+Deduplication of sensor submissions.
+
+Raspberry Pi clients retry on network errors, so the same reading can
+arrive several times. A submission is identified by its idempotency key
+(``Idempotency-Key`` header or ``idempotency_key`` field) or, failing
+that, by its bin and device timestamp (``timestamp`` field). Unique
+indexes on ml_predictions enforce this, and the insert uses
+``ON CONFLICT DO NOTHING``, so a retry never adds a second row.
+
+Keys that were stored recently are also remembered per worker, so most
+retries are answered without touching the database at all.
+
+Submissions with neither a key nor a device timestamp are not
+deduplicated.
+
+Environment variables:
+    IDEMPOTENCY_CACHE_SIZE   recent submission keys kept per worker (default 10000)
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from models import MLPrediction
+
+
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get("IDEMPOTENCY_CACHE_SIZE", "10000"))
+MAX_KEY_LENGTH = 64
+
+
+class RecentKeys:
+    """Bounded, thread-safe LRU set of submission keys."""
+
+    def __init__(self, size: int = IDEMPOTENCY_CACHE_SIZE):
+        self.size = size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, key: Optional[str]) -> bool:
+        if key is None:
+            return False
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return True
+        return False
+
+    def add(self, key: Optional[str]) -> None:
+        if key is None or self.size <= 0:
+            return
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            while len(self._keys) > self.size:
+                self._keys.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._keys.clear()
+
+
+# One cache per worker process
+recent_submissions = RecentKeys()
+
+
+def submission_key(source: str, fields: Dict) -> Optional[str]:
+    """Cache key of a parsed submission, or None if it cannot be deduplicated."""
+    if fields.get("idempotency_key"):
+        return f"{source}:key:{fields['idempotency_key']}"
+    if fields.get("device_timestamp"):
+        return f"{source}:bin:{fields['bin_id']}:{fields['device_timestamp'].isoformat()}"
+    return None
+
+
+def insert_prediction(insert, **values):
+    """
+    INSERT of one ml_predictions row that is skipped when it conflicts
+    with a stored one. ``insert`` comes from :func:`db_config.dialect_insert`.
+
+    A rowcount of 0 on the result means the row was a duplicate.
+    """
+    stmt = insert(MLPrediction.__table__).values(**values)
+    if hasattr(stmt, "on_conflict_do_nothing"):
+        stmt = stmt.on_conflict_do_nothing()
+    return stmt
@@ -0,0 +1,285 @@
+"""
+Per-request instrumentation for the Flask app.
+
+Records wall-clock timings per named phase, SQL statement counts and
+durations (via SQLAlchemy engine events) and optional cProfile dumps.
+Everything is aggregated in a small in-process registry that is rendered
+in Prometheus text format by /api/metrics.
+
+Instrumentation is off by default. Enable it for every request with
+INSTRUMENTATION_ENABLED=1, or for a single request with the
+``X-Instrument: 1`` header. PROFILE_ALL=1 also writes a cProfile dump of
+every request into PROFILE_DIR. The ``X-Profile`` header does so for one
+request, but only when PROFILE_ENABLED=1 (``X-Profile: 1``) or when its
+value is PROFILE_TOKEN; anyone else's header is ignored. PROFILE_DIR keeps
+the newest PROFILE_MAX_FILES dumps (default 100).
+"""
+import cProfile
+import glob
+import hmac
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# ---------- Metric registry ----------
+
+_lock = threading.Lock()
+_counters = {}   # (name, labels) -> value
+_summaries = {}  # (name, labels) -> [count, sum]
+_help = {}       # name -> (type, help text)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1.0, help_text="", **labels):
+    """Increment a counter."""
+    with _lock:
+        _help.setdefault(name, ("counter", help_text))
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0.0) + value
+
+
+def observe(name, value, help_text="", **labels):
+    """Record one observation of a summary (exposed as _count/_sum)."""
+    with _lock:
+        _help.setdefault(name, ("summary", help_text))
+        key = _key(name, labels)
+        entry = _summaries.setdefault(key, [0, 0.0])
+        entry[0] += 1
+        entry[1] += value
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def render_prometheus() -> str:
+    """Render the registry in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        summaries = sorted(_summaries.items())
+        help_items = dict(_help)
+
+    lines = []
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            seen.add(name)
+            mtype, text = help_items.get(name, ("counter", ""))
+            if text:
+                lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {mtype}")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for (name, labels), (count, total) in summaries:
+        if name not in seen:
+            seen.add(name)
+            mtype, text = help_items.get(name, ("summary", ""))
+            if text:
+                lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {mtype}")
+        label_str = _format_labels(labels)
+        lines.append(f"{name}_count{label_str} {count}")
+        lines.append(f"{name}_sum{label_str} {total:.6f}")
+
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """Clear all recorded metrics."""
+    with _lock:
+        _counters.clear()
+        _summaries.clear()
+        _help.clear()
+
+
+# ---------- Request-scoped helpers ----------
+
+def _instrumented() -> bool:
+    return has_request_context() and getattr(g, "_instr", None) is not None
+
+
+def _endpoint() -> str:
+    return request.endpoint or "unknown"
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Time a named phase of the current request.
+
+    A no-op when the request is not instrumented, so it is safe to leave
+    in hot code paths.
+    """
+    if not _instrumented():
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        g._instr["phases"].append((name, elapsed))
+        observe(
+            "app_phase_duration_seconds", elapsed,
+            "Time spent in named request phases",
+            endpoint=_endpoint(), phase=name,
+        )
+
+
+# ---------- SQLAlchemy events ----------
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _instrumented():
+        conn.info.setdefault("_instr_start", []).append(time.perf_counter())
+
+
+def _statement_done(conn, statement) -> None:
+    # Popped even when the request is no longer instrumented, so the
+    # stack on the pooled connection never keeps stale entries
+    starts = conn.info.get("_instr_start")
+    if not starts:
+        return
+    elapsed = time.perf_counter() - starts.pop()
+    if not _instrumented():
+        return
+
+    g._instr["sql_count"] += 1
+    g._instr["sql_time"] += elapsed
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement and statement.strip() else "OTHER"
+    observe(
+        "app_sql_statement_duration_seconds", elapsed,
+        "SQL statements executed while serving requests",
+        endpoint=_endpoint(), verb=verb,
+    )
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _statement_done(conn, statement)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # A statement that raised never reaches after_cursor_execute; errors
+    # outside a statement (e.g. on connect) never pushed a start
+    if context.connection is not None and context.execution_context is not None:
+        _statement_done(context.connection, context.statement)
+
+
+# ---------- Flask wiring ----------
+
+def _flag(value) -> bool:
+    return str(value).lower() in ("1", "true", "yes", "on")
+
+
+def _prune_profiles(directory: str, keep: int) -> None:
+    """Delete all but the newest ``keep`` dumps in ``directory``."""
+    dumps = []
+    for path in glob.glob(os.path.join(directory, "*.prof")):
+        try:
+            dumps.append((os.path.getmtime(path), path))
+        except OSError:  # pruned concurrently by another worker
+            pass
+    dumps.sort()
+    for _, path in dumps[:max(len(dumps) - keep, 0)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def init_app(app):
+    """Register request hooks on the given Flask app."""
+    app.config.setdefault(
+        "INSTRUMENTATION_ENABLED", _flag(os.environ.get("INSTRUMENTATION_ENABLED"))
+    )
+    app.config.setdefault("PROFILE_ALL", _flag(os.environ.get("PROFILE_ALL")))
+    app.config.setdefault("PROFILE_ENABLED", _flag(os.environ.get("PROFILE_ENABLED")))
+    app.config.setdefault("PROFILE_TOKEN", os.environ.get("PROFILE_TOKEN"))
+    app.config.setdefault("PROFILE_DIR", os.environ.get("PROFILE_DIR", "profiles"))
+    app.config.setdefault("PROFILE_MAX_FILES", int(os.environ.get("PROFILE_MAX_FILES", "100")))
+
+    def _profile_requested() -> bool:
+        header = request.headers.get("X-Profile")
+        if not header:
+            return False
+        if app.config["PROFILE_ENABLED"] and _flag(header):
+            return True
+        token = app.config["PROFILE_TOKEN"]
+        return bool(token) and hmac.compare_digest(header.encode(), token.encode())
+
+    @app.before_request
+    def _start_instrumentation():
+        profile = app.config["PROFILE_ALL"] or _profile_requested()
+        enabled = (
+            app.config["INSTRUMENTATION_ENABLED"]
+            or profile
+            or _flag(request.headers.get("X-Instrument"))
+        )
+        if not enabled:
+            return
+
+        g._instr = {
+            "start": time.perf_counter(),
+            "phases": [],
+            "sql_count": 0,
+            "sql_time": 0.0,
+            "profiler": None,
+        }
+        if profile:
+            profiler = cProfile.Profile()
+            g._instr["profiler"] = profiler
+            profiler.enable()
+
+    @app.after_request
+    def _finish_instrumentation(response):
+        instr = getattr(g, "_instr", None)
+        if instr is None:
+            return response
+
+        profiler = instr["profiler"]
+        if profiler is not None:
+            profiler.disable()
+            os.makedirs(app.config["PROFILE_DIR"], exist_ok=True)
+            filename = f"{_endpoint()}-{int(time.time() * 1000)}.prof"
+            path = os.path.join(app.config["PROFILE_DIR"], filename)
+            profiler.dump_stats(path)
+            _prune_profiles(app.config["PROFILE_DIR"], app.config["PROFILE_MAX_FILES"])
+            response.headers["X-Profile-Dump"] = filename
+
+        elapsed = time.perf_counter() - instr["start"]
+        endpoint = _endpoint()
+        observe(
+            "app_request_duration_seconds", elapsed,
+            "Wall-clock time of instrumented requests",
+            endpoint=endpoint, status=response.status_code,
+        )
+        inc(
+            "app_sql_statements_total", instr["sql_count"],
+            "SQL statements issued by instrumented requests",
+            endpoint=endpoint,
+        )
+
+        # Server-Timing shows up directly in the browser dev tools
+        timings = [f"{name};dur={secs * 1000:.1f}" for name, secs in instr["phases"]]
+        timings.append(f"sql;desc=\"{instr['sql_count']} queries\";dur={instr['sql_time'] * 1000:.1f}")
+        timings.append(f"total;dur={elapsed * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(timings)
+        return response
@@ -0,0 +1,199 @@
+"""
+Minimal schema migration runner.
+
+``db.create_all()`` only creates missing tables; it never touches
+tables that already exist. Changes to existing tables (new indexes,
+new columns) are written here as numbered migrations and recorded in
+the ``schema_migrations`` table, so every database is brought to the
+same schema no matter when it was created.
+
+Migrations must be idempotent (use ``checkfirst`` / ``IF NOT EXISTS``),
+because on a fresh database ``create_all`` has already built the latest
+schema from models.py before they run.
+
+On PostgreSQL ``upgrade`` holds an advisory lock, so workers starting
+at the same time apply the pending migrations one after the other.
+
+Run pending migrations with:
+    flask --app app db-upgrade
+"""
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+
+from extensions import db
+
+
+# pg_advisory_lock key of the migration runner (arbitrary, app-wide)
+MIGRATION_LOCK_ID = 7_246_551_001
+
+
+schema_migrations = db.Table(
+    "schema_migrations",
+    db.Column("version", db.Integer, primary_key=True),
+    db.Column("name", db.String(200), nullable=False),
+    db.Column("applied_at", db.DateTime, nullable=False),
+)
+
+
+def _create_indexes(conn, *index_names):
+    """Create the named indexes declared on the models if they are missing."""
+    wanted = set(index_names)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in wanted:
+                index.create(bind=conn, checkfirst=True)
+
+
+def _add_columns(conn, table, *column_names):
+    """Add the named columns declared on ``table`` if they are missing."""
+    existing = {c["name"] for c in inspect(conn).get_columns(table.name)}
+    for name in column_names:
+        if name in existing:
+            continue
+        column_type = table.c[name].type.compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {name} {column_type}"))
+
+
+def _0001_hot_path_indexes(conn):
+    _create_indexes(
+        conn,
+        "ix_ml_predictions_source_created_at",
+        "ix_ml_predictions_source_bin_id",
+        "ix_ml_predictions_source_fill",
+        "ix_ml_predictions_bin_id_created_at",
+        "ix_routes_source_created_at",
+        "ix_route_stops_route_id_order",
+    )
+
+
+def _0002_prediction_dedup(conn):
+    _add_columns(conn, db.metadata.tables["ml_predictions"], "idempotency_key", "device_timestamp")
+    _create_indexes(
+        conn,
+        "uq_ml_predictions_source_idempotency_key",
+        "uq_ml_predictions_bin_id_device_timestamp",
+    )
+
+
+def _0003_unique_running_route_job(conn):
+    # Jobs started twice before the index existed: keep one per input
+    conn.execute(text(
+        "UPDATE route_jobs SET status = 'failed', error = 'Duplicate job' "
+        "WHERE status = 'running' AND id NOT IN ("
+        "SELECT MIN(id) FROM route_jobs WHERE status = 'running' GROUP BY input_key)"
+    ))
+    _create_indexes(conn, "uq_route_jobs_running_input_key")
+
+
+def _0004_change_feed_horizon(conn):
+    _add_columns(conn, db.metadata.tables["bin_changes"], "horizon")
+
+
+def _0005_route_job_route_set_null(conn):
+    # SQLite cannot alter a foreign key, and does not enforce them here
+    # (no PRAGMA foreign_keys), so only PostgreSQL needs this
+    if conn.dialect.name != "postgresql":
+        return
+    for fk in inspect(conn).get_foreign_keys("route_jobs"):
+        if fk["referred_table"] != "routes" or fk["options"].get("ondelete", "").upper() == "SET NULL":
+            continue
+        conn.execute(text(f'ALTER TABLE route_jobs DROP CONSTRAINT "{fk["name"]}"'))
+        conn.execute(text(
+            "ALTER TABLE route_jobs ADD CONSTRAINT route_jobs_route_id_fkey "
+            "FOREIGN KEY (route_id) REFERENCES routes (id) ON DELETE SET NULL"
+        ))
+
+
+# (version, name, function) in the order they must be applied
+MIGRATIONS = [
+    (1, "hot path indexes", _0001_hot_path_indexes),
+    (2, "prediction dedup keys", _0002_prediction_dedup),
+    (3, "unique running route job", _0003_unique_running_route_job),
+    (4, "change feed horizon", _0004_change_feed_horizon),
+    (5, "route job route on delete set null", _0005_route_job_route_set_null),
+]
+
+
+def applied_versions(conn) -> set:
+    schema_migrations.create(bind=conn, checkfirst=True)
+    return {row.version for row in conn.execute(db.select(schema_migrations.c.version))}
+
+
+@contextmanager
+def _migration_lock(engine):
+    """
+    A connection that holds the migration lock on PostgreSQL (a plain
+    connection elsewhere). The lock is session-level, so it spans the
+    per-migration transactions made on the connection.
+    """
+    with engine.connect() as conn:
+        if conn.dialect.name != "postgresql":
+            yield conn
+            return
+        conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        conn.commit()
+        try:
+            yield conn
+        finally:
+            conn.rollback()
+            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": MIGRATION_LOCK_ID})
+            conn.commit()
+
+
+def _recorded(conn, version: int) -> bool:
+    with conn.begin():
+        return version in applied_versions(conn)
+
+
+def upgrade(engine=None) -> list:
+    """
+    Apply all pending migrations, each in its own transaction.
+
+    Returns the names of the migrations that were applied. Safe to run
+    from several workers at once: on PostgreSQL they take turns on the
+    migration lock; elsewhere a migration that fails because another
+    worker applied it first (duplicate index or version row) is skipped.
+    """
+    engine = engine or db.engine
+    applied = []
+
+    with _migration_lock(engine) as conn:
+        try:
+            with conn.begin():
+                done = applied_versions(conn)
+        except (IntegrityError, OperationalError, ProgrammingError):
+            # schema_migrations created concurrently
+            with conn.begin():
+                done = applied_versions(conn)
+
+        for version, name, func in MIGRATIONS:
+            if version in done:
+                continue
+            try:
+                with conn.begin():
+                    func(conn)
+                    conn.execute(
+                        schema_migrations.insert().values(
+                            version=version, name=name, applied_at=datetime.utcnow()
+                        )
+                    )
+            except (IntegrityError, OperationalError, ProgrammingError):
+                if _recorded(conn, version):
+                    continue  # applied concurrently by another process
+                raise
+            applied.append(name)
+
+    return applied
+
+
+def pending(engine=None) -> list:
+    """Names of migrations not yet applied."""
+    engine = engine or db.engine
+    if not inspect(engine).has_table("schema_migrations"):
+        return [name for _, name, _ in MIGRATIONS]
+    with engine.connect() as conn:
+        done = applied_versions(conn)
+    return [name for version, name, _ in MIGRATIONS if version not in done]
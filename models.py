@@ -18,6 +18,19 @@ class Bin(db.Model):
 
 class MLPrediction(db.Model):
     __tablename__ = "ml_predictions"
+    __table_args__ = (
+        # /api/predictions: WHERE source = ? ORDER BY created_at DESC
+        db.Index("ix_ml_predictions_source_created_at", "source", "created_at"),
+        # route generation: WHERE source = ? JOIN bins / ORDER BY fill
+        db.Index("ix_ml_predictions_source_bin_id", "source", "bin_id"),
+        db.Index("ix_ml_predictions_source_fill", "source", "predicted_fill_percent"),
+        # per-bin history, latest reading per bin
+        db.Index("ix_ml_predictions_bin_id_created_at", "bin_id", "created_at"),
+        # sensor retries: at most one row per idempotency key / device reading
+        db.Index("uq_ml_predictions_source_idempotency_key", "source", "idempotency_key", unique=True),
+        db.Index("uq_ml_predictions_bin_id_device_timestamp", "bin_id", "source", "device_timestamp",
+                 unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -42,6 +55,10 @@ class MLPrediction(db.Model):
         nullable=False
     )
 
+    # Deduplication of sensor retries (NULL for uploads, never conflicts)
+    idempotency_key = db.Column(db.String(64))
+    device_timestamp = db.Column(db.DateTime)
+
     # Relationship
     bin = db.relationship(
         "Bin",
@@ -49,8 +66,47 @@ class MLPrediction(db.Model):
     )
 
 
+class MLPredictionRollup(db.Model):
+    """Hourly/daily fill aggregates of raw predictions past the retention period."""
+    __tablename__ = "ml_prediction_rollups"
+    __table_args__ = (
+        db.UniqueConstraint(
+            "bin_id", "source", "period", "bucket_start",
+            name="uq_ml_prediction_rollups_bucket",
+        ),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    bin_id = db.Column(
+        db.Integer,
+        db.ForeignKey("bins.id"),
+        nullable=False
+    )
+
+    # "test" or "prototype"
+    source = db.Column(db.String(32), nullable=False)
+
+    # "hour" or "day"
+    period = db.Column(db.String(8), nullable=False)
+    bucket_start = db.Column(db.DateTime, nullable=False)
+
+    sample_count = db.Column(db.Integer, nullable=False)
+    sum_fill = db.Column(db.Float, nullable=False)
+    min_fill = db.Column(db.Float, nullable=False)
+    max_fill = db.Column(db.Float, nullable=False)
+
+    @property
+    def avg_fill(self):
+        return self.sum_fill / self.sample_count if self.sample_count else None
+
+
 class Route(db.Model):
     __tablename__ = "routes"
+    __table_args__ = (
+        # latest route / history: WHERE source = ? ORDER BY created_at DESC
+        db.Index("ix_routes_source_created_at", "source", "created_at"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120))
@@ -67,6 +123,10 @@ class Route(db.Model):
 
 class RouteStop(db.Model):
     __tablename__ = "route_stops"
+    __table_args__ = (
+        # WHERE route_id = ? ORDER BY order_index
+        db.Index("ix_route_stops_route_id_order", "route_id", "order_index"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -103,3 +163,121 @@ class RouteStop(db.Model):
         "Bin",
         backref=db.backref("route_stops", lazy=True)
     )
+
+
+class ActiveRoute(db.Model):
+    """Pointer to the currently published route version for each source."""
+    __tablename__ = "active_routes"
+
+    # "test" or "prototype"
+    source = db.Column(db.String(32), primary_key=True)
+
+    route_id = db.Column(
+        db.Integer,
+        db.ForeignKey("routes.id"),
+        nullable=False
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        nullable=False
+    )
+
+    route = db.relationship("Route")
+
+
+class RouteJob(db.Model):
+    """A background route generation request and its outcome."""
+    __tablename__ = "route_jobs"
+    __table_args__ = (
+        # dedup lookup: WHERE input_key = ? AND status IN (...)
+        db.Index("ix_route_jobs_input_key_status", "input_key", "status"),
+        # at most one running job per input, also across web workers
+        db.Index("uq_route_jobs_running_input_key", "input_key", unique=True,
+                 postgresql_where=db.text("status = 'running'"),
+                 sqlite_where=db.text("status = 'running'")),
+    )
+
+    # uuid4 hex, so ids are not guessable and any worker can mint them
+    id = db.Column(db.String(32), primary_key=True)
+
+    # Fingerprint of source, depot, threshold and the input bins
+    input_key = db.Column(db.String(64), nullable=False)
+
+    source = db.Column(db.String(32), nullable=False)
+
+    # "running", "succeeded", "failed" or "cancelled"
+    status = db.Column(db.String(16), nullable=False, default="running")
+
+    params = db.Column(db.JSON, nullable=False)
+    result = db.Column(db.JSON)
+    error = db.Column(db.Text)
+
+    # Cleared when ROUTE_HISTORY_LIMIT trims the route
+    route_id = db.Column(
+        db.Integer,
+        db.ForeignKey("routes.id", ondelete="SET NULL")
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+        nullable=False
+    )
+    finished_at = db.Column(db.DateTime)
+
+
+class BinChange(db.Model):
+    """Append-only feed of bin upserts and prediction inserts (see change_feed.py)."""
+    __tablename__ = "bin_changes"
+    __table_args__ = (
+        # /api/changes?source=: WHERE source = ? AND seq > ? ORDER BY seq
+        db.Index("ix_bin_changes_source_seq", "source", "seq"),
+        # AUTOINCREMENT on SQLite: sequence numbers are never reused
+        {"sqlite_autoincrement": True},
+    )
+
+    seq = db.Column(db.Integer, primary_key=True)
+
+    # "bin" or "prediction"
+    entity = db.Column(db.String(16), nullable=False)
+    # "insert" or "update"
+    op = db.Column(db.String(8), nullable=False)
+    # Primary key of the changed row
+    entity_id = db.Column(db.Integer, nullable=False)
+
+    # Source of the write ("test" or "prototype") and the bin's code
+    source = db.Column(db.String(32), nullable=False)
+    trash_can_id = db.Column(db.String(64), nullable=False)
+
+    # New values of the changed fields
+    data = db.Column(db.JSON, nullable=False)
+
+    # First transaction id not yet assigned at insert (PostgreSQL only;
+    # see change_feed.py)
+    horizon = db.Column(db.BigInteger)
+
+    created_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+        nullable=False
+    )
+
+
+class Depot(db.Model):
+    """A registered depot; routes can start from it by name or id."""
+    __tablename__ = "depots"
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), unique=True, nullable=False)
+
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+
+    created_at = db.Column(
+        db.DateTime,
+        default=datetime.utcnow,
+        nullable=False
+    )
@@ -0,0 +1,113 @@
+"""
+EXPLAIN checks for the hot query paths.
+
+Every query that runs on a request hot path is listed in HOT_QUERIES.
+:func:`check_hot_queries` asks the database for each plan and reports
+any table that would be read with a sequential scan, which catches a
+missing or unusable index before it reaches production.
+
+On PostgreSQL the check runs with ``enable_seqscan = off`` so the
+planner only falls back to a sequential scan when no index applies
+(tiny test tables would otherwise always be scanned).
+
+Run with:
+    flask --app app check-query-plans
+"""
+import json
+from typing import Callable, Dict, List, Tuple
+
+from extensions import db
+from models import Bin, MLPrediction, MLPredictionRollup
+
+
+def hot_queries() -> List[Tuple[str, Callable]]:
+    """(name, statement factory) for every hot-path query."""
+    from routes.api import predictions_statement
+    import change_feed
+    import dashboard_data
+    import route_store
+
+    return [
+        ("api_predictions", lambda: predictions_statement("test")),
+        ("route_candidates", lambda: route_store.route_candidates_statement("test")),
+        (
+            "route_candidates_by_fill",
+            lambda: route_store.route_candidates_statement("test").order_by(MLPrediction.predicted_fill_percent.desc()),
+        ),
+        ("active_route", lambda: route_store.active_route_statement("test")),
+        ("latest_route", lambda: route_store.latest_route_statement("test")),
+        ("route_stops", lambda: route_store.route_stops_statement(1)),
+        (
+            "prediction_history_raw",
+            lambda: db.select(MLPrediction.created_at, MLPrediction.predicted_fill_percent)
+            .where(MLPrediction.bin_id == 1, MLPrediction.source == "test")
+            .order_by(MLPrediction.created_at),
+        ),
+        (
+            "prediction_history_rollups",
+            lambda: db.select(MLPredictionRollup)
+            .where(
+                MLPredictionRollup.bin_id == 1,
+                MLPredictionRollup.source == "test",
+                MLPredictionRollup.period == "hour",
+            )
+            .order_by(MLPredictionRollup.bucket_start),
+        ),
+        ("change_feed", lambda: change_feed.changes_statement(0)),
+        ("change_feed_by_source", lambda: change_feed.changes_statement(0, "test")),
+        ("dashboard_latest", lambda: dashboard_data.latest_predictions_statement("test")),
+        ("dashboard_summary", lambda: dashboard_data.summary_statement("test")),
+        (
+            "resolve_bin_ids",
+            lambda: db.select(Bin.trash_can_id, Bin.id).where(Bin.trash_can_id.in_(["a", "b"])),
+        ),
+    ]
+
+
+def _postgres_seq_scans(conn, sql) -> List[str]:
+    plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + sql).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    scans = []
+    stack = [plan[0]["Plan"]]
+    while stack:
+        node = stack.pop()
+        if node.get("Node Type") == "Seq Scan":
+            scans.append(node.get("Relation Name"))
+        stack.extend(node.get("Plans", []))
+    return scans
+
+
+def _sqlite_seq_scans(conn, sql) -> List[str]:
+    scans = []
+    for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql):
+        detail = row[-1]
+        # "SCAN t" is a full table scan; "SCAN t USING INDEX ..." walks an index
+        if detail.startswith("SCAN ") and "USING" not in detail:
+            scans.append(detail.split()[1])
+    return scans
+
+
+def explain(statement, conn) -> List[str]:
+    """Return the tables a statement would read with a sequential scan."""
+    sql = str(statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+    if conn.dialect.name == "postgresql":
+        return _postgres_seq_scans(conn, sql)
+    if conn.dialect.name == "sqlite":
+        return _sqlite_seq_scans(conn, sql)
+    return []
+
+
+def check_hot_queries(engine=None) -> Dict[str, List[str]]:
+    """Map query name -> tables read with a sequential scan (empty = OK)."""
+    engine = engine or db.engine
+    results = {}
+    with engine.connect() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.exec_driver_sql("SET enable_seqscan = off")
+        for name, factory in hot_queries():
+            results[name] = explain(factory(), conn)
+        if conn.dialect.name == "postgresql":
+            conn.exec_driver_sql("RESET enable_seqscan")
+    return results
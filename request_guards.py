@@ -0,0 +1,279 @@
+"""
+Work budgets for heavy endpoints.
+
+One request must not be able to exhaust a worker's memory or hold it for
+longer than the gunicorn timeout. Heavy endpoints belong to a route
+class with a per-worker concurrency limit and have budgets for the rows
+they load, the bytes they build and the time a route solve may take. A
+request over budget gets a degraded response instead of an error:
+
+- /api/predictions returns the newest GUARD_MAX_ROWS rows;
+- /view/<filename> renders the first rows of the log, up to
+  GUARD_MAX_ROWS rows or GUARD_MAX_RESPONSE_BYTES of data;
+- /download_all adds log files newest first until the archive holds
+  GUARD_MAX_RESPONSE_BYTES, and spools it to disk instead of memory;
+- route generation falls back to the Hilbert-curve solver when there are
+  too many candidates for nearest neighbour, or when the solve misses
+  GUARD_SOLVE_SECONDS. A solve that has already started keeps running in
+  the route job pool and its result lands in the route cache for the
+  next request; identical requests meanwhile wait for that solve instead
+  of queueing another. At most GUARD_MAX_ABANDONED_SOLVES such solves
+  run per worker, so they cannot starve route jobs.
+
+If no slot of its class frees up within GUARD_QUEUE_SECONDS, a request
+runs in a cheaper form instead of queueing: GUARD_DEGRADED_ROWS rows, an
+uncompressed archive, or the Hilbert solver.
+
+Degraded responses carry an ``X-Degraded`` header with the budgets that
+were hit. Every hit is counted in ``app_budget_exceeded_total{endpoint,
+budget}`` on /api/metrics.
+
+Environment variables:
+    GUARD_MAX_ROWS            rows per response (default 20000)
+    GUARD_DEGRADED_ROWS       rows per response while saturated (default 1000)
+    GUARD_MAX_RESPONSE_BYTES  log data per response (default 8 MiB)
+    GUARD_MAX_SOLVE_BINS      candidates above which nearest neighbour is
+                              not attempted (default 5000)
+    GUARD_SOLVE_SECONDS       solve time before falling back (default 10)
+    GUARD_MAX_ABANDONED_SOLVES  timed-out solves left running (default 1)
+    GUARD_QUEUE_SECONDS       wait for a free slot (default 1)
+    GUARD_CONCURRENCY_READ    concurrent requests per worker, per class
+    GUARD_CONCURRENCY_LOGS    (defaults 8, 2 and 2)
+    GUARD_CONCURRENCY_SOLVE
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import CancelledError, Future, TimeoutError as FutureTimeout
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from flask import g, has_request_context, request
+
+from instrumentation import inc
+
+
+MAX_ROWS = int(os.environ.get("GUARD_MAX_ROWS", "20000"))
+DEGRADED_ROWS = int(os.environ.get("GUARD_DEGRADED_ROWS", "1000"))
+MAX_RESPONSE_BYTES = int(os.environ.get("GUARD_MAX_RESPONSE_BYTES", str(8 * 1024 * 1024)))
+MAX_SOLVE_BINS = int(os.environ.get("GUARD_MAX_SOLVE_BINS", "5000"))
+SOLVE_SECONDS = float(os.environ.get("GUARD_SOLVE_SECONDS", "10"))
+QUEUE_SECONDS = float(os.environ.get("GUARD_QUEUE_SECONDS", "1"))
+MAX_ABANDONED_SOLVES = int(os.environ.get("GUARD_MAX_ABANDONED_SOLVES", "1"))
+
+ROUTE_CLASSES = {
+    "read": int(os.environ.get("GUARD_CONCURRENCY_READ", "8")),
+    "logs": int(os.environ.get("GUARD_CONCURRENCY_LOGS", "2")),
+    "solve": int(os.environ.get("GUARD_CONCURRENCY_SOLVE", "2")),
+}
+_slots = {name: threading.BoundedSemaphore(n) for name, n in ROUTE_CLASSES.items()}
+
+# Solver modes that are superlinear in the number of candidates, and the
+# cheap one they fall back to
+EXPENSIVE_MODES = ("nearest", "partitioned")
+FALLBACK_MODE = "hilbert"
+
+# Candidates up to which an expensive solve is still quick enough to run
+# inline (handing it to the job pool costs more than the solve)
+INLINE_SOLVE_BINS = 500
+
+
+# ---------- Budgets ----------
+
+def exceeded(budget: str, endpoint: Optional[str] = None) -> None:
+    """Count a budget hit and mark the current response as degraded."""
+    if endpoint is None:
+        endpoint = request.endpoint if has_request_context() else None
+    inc("app_budget_exceeded_total",
+        help_text="Requests answered in degraded form because a work budget was hit",
+        endpoint=endpoint or "unknown", budget=budget)
+    if has_request_context():
+        g.setdefault("_degraded", set()).add(budget)
+
+
+@contextmanager
+def slot(route_class: str):
+    """
+    Hold a concurrency slot of ``route_class`` for the block.
+
+    Yields False when none frees up within GUARD_QUEUE_SECONDS; the
+    caller then does a cheaper version of its work (and calls
+    ``exceeded("concurrency")``).
+    """
+    semaphore = _slots[route_class]
+    acquired = semaphore.acquire(timeout=QUEUE_SECONDS)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            semaphore.release()
+
+
+@asynccontextmanager
+async def async_slot(route_class: str, poll_seconds: float = 0.01):
+    """
+    :func:`slot` for coroutines (the ASGI views): shares the worker's
+    slots, but polls for one instead of blocking the event loop.
+    """
+    semaphore = _slots[route_class]
+    deadline = time.monotonic() + QUEUE_SECONDS
+    acquired = semaphore.acquire(blocking=False)
+    while not acquired and time.monotonic() < deadline:
+        await asyncio.sleep(poll_seconds)
+        acquired = semaphore.acquire(blocking=False)
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            semaphore.release()
+
+
+def row_limit(acquired: bool = True) -> int:
+    return MAX_ROWS if acquired else DEGRADED_ROWS
+
+
+def truncate(rows: List, limit: int, endpoint: Optional[str] = None) -> Tuple[List, bool]:
+    """First ``limit`` rows of a query that was run with LIMIT limit + 1."""
+    if len(rows) <= limit:
+        return rows, False
+    exceeded("rows", endpoint)
+    return rows[:limit], True
+
+
+# ---------- Route solves ----------
+
+def _fallback(bins: List[Dict], depot_lat: float, depot_lon: float, threshold: float,
+              mode: str, budget: str) -> Tuple[List[Dict], Dict]:
+    from route_optimizer import solve_route
+
+    exceeded(budget)
+    route, stats = solve_route(bins, depot_lat, depot_lon, threshold, FALLBACK_MODE)
+    stats = dict(stats, degraded={"budget": budget, "requested_mode": mode, "mode": FALLBACK_MODE})
+    return route, stats
+
+
+class _Solve:
+    """A solve in the job pool and the requests waiting for it."""
+    __slots__ = ("future", "waiters", "abandoned")
+
+    def __init__(self, future: Future):
+        self.future = future
+        self.waiters = 0
+        self.abandoned = False
+
+
+# In-flight expensive solves of this worker, keyed by input fingerprint
+_inflight: Dict[str, _Solve] = {}
+_inflight_lock = threading.Lock()
+
+
+def _start_solve(key: str, bins: List[Dict], depot_lat: float, depot_lon: float,
+                 threshold: float, mode: str, budget_min: Optional[float]) -> Optional[_Solve]:
+    """
+    Join the in-flight solve of ``key`` or start one. Returns None when
+    MAX_ABANDONED_SOLVES are still running and a new one may not start.
+    """
+    import route_cache
+    import route_jobs
+
+    with _inflight_lock:
+        inflight = _inflight.get(key)
+        if inflight is None:
+            if sum(1 for s in _inflight.values() if s.abandoned) >= MAX_ABANDONED_SOLVES:
+                return None
+            inflight = _Solve(
+                route_jobs.solve_async(bins, depot_lat, depot_lon, threshold, mode, budget_min)
+            )
+            _inflight[key] = inflight
+            start = True
+        else:
+            start = False
+        inflight.waiters += 1
+
+    if start:
+        def _done(future):
+            with _inflight_lock:
+                if _inflight.get(key) is inflight:
+                    del _inflight[key]
+            if not future.cancelled() and future.exception() is None:
+                route_cache.put(key, *future.result())
+
+        inflight.future.add_done_callback(_done)
+    return inflight
+
+
+def _stop_waiting(inflight: _Solve, timed_out: bool) -> None:
+    """
+    Leave a solve. The last request to give up on it cancels it if it has
+    not started yet, and otherwise leaves it running as abandoned.
+    """
+    with _inflight_lock:
+        inflight.waiters -= 1
+        if not timed_out or inflight.waiters:
+            return
+        inflight.abandoned = True
+    # Outside the lock: cancel() runs the done callback, which removes the
+    # solve from _inflight
+    inflight.future.cancel()
+
+
+def solve(source: str, bins: List[Dict], depot_lat: float, depot_lon: float,
+          threshold: float, mode: str = "nearest",
+          budget_min: Optional[float] = None) -> Tuple[List[Dict], Dict]:
+    """
+    :func:`route_cache.solve` within the solve budgets.
+
+    Cheap modes and small inputs run inline. Expensive solves run in the
+    route job pool, shared by identical concurrent requests, and are
+    abandoned after GUARD_SOLVE_SECONDS. They are not attempted when the
+    candidates exceed GUARD_MAX_SOLVE_BINS, every solve slot is busy or
+    GUARD_MAX_ABANDONED_SOLVES abandoned solves are still running. In
+    those cases the Hilbert route is returned, with ``stats["degraded"]``
+    saying why. Degraded results are not cached.
+    """
+    import route_cache
+    from route_optimizer import input_fingerprint
+
+    candidates = sum(1 for b in bins if b.get("predicted_fill_percent", 0) >= threshold)
+    if mode not in EXPENSIVE_MODES or candidates <= INLINE_SOLVE_BINS:
+        return route_cache.solve(source, bins, depot_lat, depot_lon, threshold, mode, budget_min)
+
+    key = input_fingerprint(source, bins, depot_lat, depot_lon, threshold, mode, budget_min)
+    result = route_cache.get(key)
+    if result is not None:
+        return result
+    if mode == "nearest" and candidates > MAX_SOLVE_BINS:
+        return _fallback(bins, depot_lat, depot_lon, threshold, mode, "rows")
+
+    with slot("solve") as acquired:
+        if not acquired:
+            return _fallback(bins, depot_lat, depot_lon, threshold, mode, "concurrency")
+
+        inflight = _start_solve(key, bins, depot_lat, depot_lon, threshold, mode, budget_min)
+        if inflight is None:
+            return _fallback(bins, depot_lat, depot_lon, threshold, mode, "solve_backlog")
+        timed_out = False
+        try:
+            result = inflight.future.result(timeout=SOLVE_SECONDS)
+        except (FutureTimeout, CancelledError):
+            timed_out = True
+        finally:
+            _stop_waiting(inflight, timed_out)
+
+    if timed_out:
+        return _fallback(bins, depot_lat, depot_lon, threshold, mode, "solve_time")
+    return result
+
+
+# ---------- Flask wiring ----------
+
+def init_app(app) -> None:
+    """Add the X-Degraded header to responses that hit a budget."""
+
+    @app.after_request
+    def _mark_degraded(response):
+        degraded = g.get("_degraded")
+        if degraded:
+            response.headers["X-Degraded"] = ",".join(sorted(degraded))
+        return response
@@ -0,0 +1,239 @@
+"""
+Compact response formats for the map-heavy API endpoints.
+
+- Content negotiation between the default row-oriented JSON and a
+  columnar layout (one array per field) via ``?format=`` or the Accept
+  header.
+- Google encoded-polyline route geometry.
+- gzip / brotli compression of JSON responses based on Accept-Encoding.
+- A faster JSON encoder (orjson) when it is installed.
+"""
+import gzip
+import hashlib
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+try:  # optional, much faster than the stdlib encoder
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:  # optional, better ratio than gzip for JSON
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+COLUMNAR_MIMETYPE = "application/vnd.trash.columnar+json"
+POLYLINE_MIMETYPE = "application/vnd.trash.polyline+json"
+
+# Responses smaller than this are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/plain", "text/csv", "text/html")
+
+
+# ---------- Content negotiation ----------
+
+def negotiate_format(default: str = "json", args=None, headers=None) -> str:
+    """
+    Return the requested representation: "json", "columnar" or "polyline".
+
+    An explicit ``?format=`` wins over the Accept header. ``args`` and
+    ``headers`` default to the current Flask request's (the ASGI views
+    pass Starlette's).
+    """
+    args = request.args if args is None else args
+    headers = request.headers if headers is None else headers
+    fmt = args.get("format")
+    if fmt:
+        return fmt.lower()
+
+    accept = headers.get("Accept", "")
+    if COLUMNAR_MIMETYPE in accept:
+        return "columnar"
+    if POLYLINE_MIMETYPE in accept:
+        return "polyline"
+    return default
+
+
+def requested_fields(available: Sequence[str], args=None) -> List[str]:
+    """Return the subset of ``available`` requested with ``?fields=a,b``."""
+    raw = (request.args if args is None else args).get("fields")
+    if not raw:
+        return list(available)
+    wanted = [f.strip() for f in raw.split(",")]
+    return [f for f in wanted if f in available] or list(available)
+
+
+def representation_etag(resource: str, fmt: str, fields: Sequence[str]) -> str:
+    """
+    ETag for one representation of ``resource``.
+
+    Formats other than "columnar" and "polyline" render the full JSON, so
+    ``fields`` only counts for those two. Use it as a weak ETag: gzip and
+    brotli encodings of a representation share it (see
+    :func:`compress_response`), and Vary: Accept, Accept-Encoding keeps
+    caches from mixing them up.
+    """
+    if fmt not in ("columnar", "polyline"):
+        return f"{resource}-json"
+    digest = hashlib.sha1(",".join(fields).encode()).hexdigest()[:12]
+    return f"{resource}-{fmt}-{digest}"
+
+
+def to_columnar(rows: Iterable[Dict], fields: Sequence[str]) -> Dict:
+    """Turn a list of dicts into ``{"fields": [...], "columns": {f: [...]}}``."""
+    columns = {f: [] for f in fields}
+    count = 0
+    for row in rows:
+        for f in fields:
+            columns[f].append(row.get(f))
+        count += 1
+    return {"format": "columnar", "count": count, "fields": list(fields), "columns": columns}
+
+
+def format_route(payload: Dict, fmt: str, fields: Sequence[str]) -> Dict:
+    """
+    Apply a representation to a serialized route.
+
+    "polyline" encodes the stop coordinates as a polyline and returns the
+    remaining ``fields`` in columnar form; "columnar" returns all
+    ``fields`` in columnar form; anything else returns ``payload`` as is.
+    """
+    if fmt not in ("columnar", "polyline"):
+        return payload
+
+    compact = {k: v for k, v in payload.items() if k != "stops"}
+    if fmt == "polyline":
+        compact["polyline"] = encode_polyline(
+            (s["lat"], s["lon"]) for s in payload["stops"]
+            if s["lat"] is not None and s["lon"] is not None
+        )
+        fields = [f for f in fields if f not in ("lat", "lon")]
+
+    compact["stops"] = to_columnar(payload["stops"], fields)
+    return compact
+
+
+# ---------- Encoded polylines ----------
+
+def _encode_value(value: int, out: List[str]) -> None:
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1F)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode_polyline(coords: Iterable[Tuple[float, float]], precision: int = 5) -> str:
+    """Encode (lat, lon) pairs with the Google encoded polyline algorithm."""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lon = 0
+    for lat, lon in coords:
+        lat_i = int(round(lat * factor))
+        lon_i = int(round(lon * factor))
+        _encode_value(lat_i - prev_lat, out)
+        _encode_value(lon_i - prev_lon, out)
+        prev_lat, prev_lon = lat_i, lon_i
+    return "".join(out)
+
+
+def decode_polyline(encoded: str, precision: int = 5) -> List[Tuple[float, float]]:
+    """Inverse of :func:`encode_polyline`."""
+    factor = 10 ** precision
+    coords = []
+    index = lat = lon = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                b = ord(encoded[index]) - 63
+                index += 1
+                result |= (b & 0x1F) << shift
+                shift += 5
+                if b < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lon += deltas[1]
+        coords.append((lat / factor, lon / factor))
+    return coords
+
+
+# ---------- Fast JSON ----------
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (falls back to the default for unknown types)."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        data = orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS)
+        return self._app.response_class(data, mimetype=self.mimetype)
+
+
+# ---------- Compression ----------
+
+def _choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {
+        part.split(";")[0].strip().lower()
+        for part in accept_encoding.split(",")
+        if part.strip() and not part.strip().endswith("q=0")
+    }
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+
+def compress_body(data: bytes, accept_encoding: str) -> Tuple[bytes, Optional[str]]:
+    """``data`` encoded for an Accept-Encoding header, and the encoding used (None: unchanged)."""
+    encoding = _choose_encoding(accept_encoding)
+    if encoding is None or len(data) < MIN_COMPRESS_BYTES:
+        return data, None
+    if encoding == "br":
+        return brotli.compress(data, quality=5), encoding
+    return gzip.compress(data, compresslevel=6), encoding
+
+
+def compress_response(response):
+    """after_request hook: compress large textual responses."""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body, encoding = compress_body(response.get_data(), request.headers.get("Accept-Encoding", ""))
+    if encoding is None:
+        return response
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_app(app) -> None:
+    """Install the fast JSON provider and response compression."""
+    if orjson is not None:
+        app.json = ORJSONProvider(app)
+    app.after_request(compress_response)
@@ -0,0 +1,212 @@
+"""
+Retention and rollups for raw ML predictions.
+
+``ml_predictions`` receives one row per sensor submission. Rows older
+than PREDICTION_RETENTION_DAYS are rolled up into hourly and daily
+per-bin aggregates (count / sum / min / max fill) in
+``ml_prediction_rollups`` and then deleted, so the hot table stays
+bounded by (retention window x submission rate) no matter how long the
+service runs. The newest prediction of every bin is always kept, because
+the dashboard and the route generators read current fill from it.
+
+The cutoff is aligned to midnight UTC so a bucket is never split across
+runs; re-rolling a bucket (e.g. a bin's previously kept latest reading)
+merges into the existing aggregate.
+
+Run periodically (e.g. a Render cron job):
+    flask --app app prune-predictions
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from db_config import dialect_insert
+from extensions import db
+from models import MLPrediction, MLPredictionRollup
+
+
+RETENTION_DAYS = int(os.environ.get("PREDICTION_RETENTION_DAYS", "30"))
+
+# History requests spanning more than this use daily instead of hourly rollups
+DAILY_ROLLUP_AFTER_DAYS = 90
+
+PERIODS = ("hour", "day")
+
+
+def retention_cutoff(now: Optional[datetime] = None) -> datetime:
+    """Oldest created_at still kept in raw form (midnight UTC aligned)."""
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(days=RETENTION_DAYS)
+    return cutoff.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _bucket(period: str, column, dialect: str):
+    if dialect == "postgresql":
+        return db.func.date_trunc(period, column)
+    if dialect == "sqlite":
+        # Same text format SQLAlchemy uses for DateTime on SQLite
+        fmt = "%Y-%m-%d %H:00:00.000000" if period == "hour" else "%Y-%m-%d 00:00:00.000000"
+        return db.func.strftime(fmt, column)
+    raise ValueError(f"rollups are not supported on {dialect}")
+
+
+def _prunable(cutoff: datetime, max_id: int):
+    """
+    Predicate for raw rows to roll up and delete.
+
+    Only rows up to ``max_id`` are considered, also for finding the
+    latest row of each bin. The rollups and the delete each evaluate it,
+    so they must share one snapshot (see :func:`rollup_and_prune`) for
+    it to select the same rows every time.
+    """
+    latest_ids = (
+        db.select(db.func.max(MLPrediction.id))
+        .where(MLPrediction.id <= max_id)
+        .group_by(MLPrediction.bin_id, MLPrediction.source)
+    )
+    return db.and_(
+        MLPrediction.id <= max_id,
+        MLPrediction.created_at < cutoff,
+        MLPrediction.id.notin_(latest_ids),
+    )
+
+
+def _rollup(period: str, cutoff: datetime, max_id: int, dialect: str) -> None:
+    bucket = _bucket(period, MLPrediction.created_at, dialect)
+    aggregates = (
+        db.select(
+            MLPrediction.bin_id,
+            MLPrediction.source,
+            db.literal(period),
+            bucket,
+            db.func.count(MLPrediction.id),
+            db.func.sum(MLPrediction.predicted_fill_percent),
+            db.func.min(MLPrediction.predicted_fill_percent),
+            db.func.max(MLPrediction.predicted_fill_percent),
+        )
+        .where(_prunable(cutoff, max_id))
+        .group_by(MLPrediction.bin_id, MLPrediction.source, bucket)
+    )
+
+    insert = dialect_insert()
+    stmt = insert(MLPredictionRollup).from_select(
+        ["bin_id", "source", "period", "bucket_start",
+         "sample_count", "sum_fill", "min_fill", "max_fill"],
+        aggregates,
+    )
+    least = db.func.least if dialect == "postgresql" else db.func.min
+    greatest = db.func.greatest if dialect == "postgresql" else db.func.max
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["bin_id", "source", "period", "bucket_start"],
+        set_={
+            "sample_count": MLPredictionRollup.sample_count + stmt.excluded.sample_count,
+            "sum_fill": MLPredictionRollup.sum_fill + stmt.excluded.sum_fill,
+            "min_fill": least(MLPredictionRollup.min_fill, stmt.excluded.min_fill),
+            "max_fill": greatest(MLPredictionRollup.max_fill, stmt.excluded.max_fill),
+        },
+    )
+    db.session.execute(stmt)
+
+
+def rollup_and_prune(now: Optional[datetime] = None) -> Dict:
+    """
+    Roll raw predictions past the retention period into hourly/daily
+    aggregates and delete them, in one transaction.
+
+    On PostgreSQL the transaction runs at REPEATABLE READ. Under READ
+    COMMITTED each statement takes a new snapshot, and a prediction with
+    a lower id committing between the rollups and the delete can change
+    which row is a bin's latest: a row would then be deleted without
+    being rolled up, or rolled up twice. SQLite holds the write lock
+    from the first rollup to the commit, which gives the same guarantee.
+    Must be called outside a transaction.
+    """
+    cutoff = retention_cutoff(now)
+    dialect = db.session.get_bind().dialect.name
+
+    try:
+        if dialect == "postgresql":
+            db.session.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+        max_id = db.session.execute(db.select(db.func.max(MLPrediction.id))).scalar()
+        if max_id is None:
+            return {"cutoff": cutoff.isoformat(), "deleted": 0}
+        for period in PERIODS:
+            _rollup(period, cutoff, max_id, dialect)
+        result = db.session.execute(
+            db.delete(MLPrediction)
+            .where(_prunable(cutoff, max_id))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return {"cutoff": cutoff.isoformat(), "deleted": result.rowcount}
+
+
+# ---------- History reads ----------
+
+def bin_history(bin_pk: int, source: str, start: datetime, end: datetime,
+                session=None) -> List[Dict]:
+    """
+    Fill history for one bin between ``start`` and ``end``.
+
+    The part of the range inside the retention window comes from raw
+    predictions; anything older comes from rollups (hourly, or daily when
+    the range is longer than DAILY_ROLLUP_AFTER_DAYS). Each point carries
+    its ``resolution`` ("raw", "hour" or "day").
+    """
+    session = session or db.session
+    cutoff = retention_cutoff()
+    points = []
+
+    if start < cutoff:
+        period = "day" if (end - start).days > DAILY_ROLLUP_AFTER_DAYS else "hour"
+        rollups = (
+            session.query(MLPredictionRollup)
+            .filter(MLPredictionRollup.bin_id == bin_pk)
+            .filter(MLPredictionRollup.source == source)
+            .filter(MLPredictionRollup.period == period)
+            .filter(MLPredictionRollup.bucket_start >= start)
+            .filter(MLPredictionRollup.bucket_start < min(end, cutoff))
+            .order_by(MLPredictionRollup.bucket_start)
+            .all()
+        )
+        points.extend(
+            {
+                "time": r.bucket_start.isoformat(),
+                "resolution": period,
+                "count": r.sample_count,
+                "avg_fill": round(r.avg_fill, 2),
+                "min_fill": r.min_fill,
+                "max_fill": r.max_fill,
+            }
+            for r in rollups
+        )
+
+    # Raw rows older than the cutoff are only the kept latest readings,
+    # which are not in any rollup yet, so nothing is counted twice
+    raw = (
+        session.query(MLPrediction.created_at, MLPrediction.predicted_fill_percent)
+        .filter(MLPrediction.bin_id == bin_pk)
+        .filter(MLPrediction.source == source)
+        .filter(MLPrediction.created_at >= start)
+        .filter(MLPrediction.created_at <= end)
+        .order_by(MLPrediction.created_at)
+        .all()
+    )
+    points.extend(
+        {
+            "time": created_at.isoformat(),
+            "resolution": "raw",
+            "count": 1,
+            "avg_fill": fill,
+            "min_fill": fill,
+            "max_fill": fill,
+        }
+        for created_at, fill in raw
+    )
+
+    points.sort(key=lambda p: p["time"])
+    return points
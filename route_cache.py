@@ -0,0 +1,125 @@
+"""
+Memoized route solves.
+
+A solve depends only on the candidate bins (ids, coordinates, fill) and
+the depot, threshold and mode, so its result is cached under
+:func:`route_optimizer.input_fingerprint`. Repeated "generate" clicks
+with unchanged predictions are answered without running the optimizer.
+
+Results are kept in a per-process LRU and written to ROUTE_CACHE_DIR as
+one JSON file per fingerprint, so they survive worker restarts and are
+shared by all workers on the machine.
+
+Environment variables:
+    ROUTE_RESULT_CACHE_SIZE   results kept in memory per worker (default 128)
+    ROUTE_CACHE_DIR           directory for cached results (default route_cache/,
+                              empty disables the disk cache)
+    ROUTE_CACHE_DISK_ENTRIES  results kept on disk (default 1000)
+"""
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from instrumentation import inc
+from route_optimizer import input_fingerprint, solve_route
+
+
+ROUTE_RESULT_CACHE_SIZE = int(os.environ.get("ROUTE_RESULT_CACHE_SIZE", "128"))
+ROUTE_CACHE_DIR = os.environ.get("ROUTE_CACHE_DIR", "route_cache")
+ROUTE_CACHE_DISK_ENTRIES = int(os.environ.get("ROUTE_CACHE_DISK_ENTRIES", "1000"))
+
+_results = OrderedDict()
+_results_lock = threading.Lock()
+
+
+def _path(key: str) -> str:
+    return os.path.join(ROUTE_CACHE_DIR, f"{key}.json")
+
+
+def _read_disk(key: str) -> Optional[Tuple[List[Dict], Dict]]:
+    if not ROUTE_CACHE_DIR:
+        return None
+    path = _path(key)
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        os.utime(path)  # mtime is the disk LRU order
+    except (OSError, ValueError):
+        return None
+    return data["route"], data["stats"]
+
+
+def _write_disk(key: str, route: List[Dict], stats: Dict) -> None:
+    if not ROUTE_CACHE_DIR:
+        return
+    try:
+        os.makedirs(ROUTE_CACHE_DIR, exist_ok=True)
+        # Write then rename, so other workers never read a partial file
+        fd, tmp = tempfile.mkstemp(dir=ROUTE_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"route": route, "stats": stats}, f)
+        os.replace(tmp, _path(key))
+        _prune_disk()
+    except OSError:
+        pass  # the disk cache is best effort
+
+
+def _prune_disk() -> None:
+    entries = [e for e in os.scandir(ROUTE_CACHE_DIR) if e.name.endswith(".json")]
+    if len(entries) <= ROUTE_CACHE_DISK_ENTRIES:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for entry in entries[:len(entries) - ROUTE_CACHE_DISK_ENTRIES]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def get(key: str) -> Optional[Tuple[List[Dict], Dict]]:
+    """Cached ``(route, stats)`` for a fingerprint, or None."""
+    with _results_lock:
+        result = _results.get(key)
+        if result is not None:
+            _results.move_to_end(key)
+    if result is None:
+        result = _read_disk(key)
+        if result is not None:
+            _remember(key, result)
+    inc("app_route_cache_total", help_text="Route result cache lookups",
+        result="hit" if result is not None else "miss")
+    return result
+
+
+def _remember(key: str, result: Tuple[List[Dict], Dict]) -> None:
+    with _results_lock:
+        _results[key] = result
+        _results.move_to_end(key)
+        while len(_results) > ROUTE_RESULT_CACHE_SIZE:
+            _results.popitem(last=False)
+
+
+def put(key: str, route: List[Dict], stats: Dict) -> None:
+    _remember(key, (route, stats))
+    _write_disk(key, route, stats)
+
+
+def solve(source: str, bins: List[Dict], depot_lat: float, depot_lon: float,
+          threshold: float, mode: str = "nearest",
+          budget_min: Optional[float] = None) -> Tuple[List[Dict], Dict]:
+    """:func:`route_optimizer.solve_route`, memoized by input fingerprint."""
+    key = input_fingerprint(source, bins, depot_lat, depot_lon, threshold, mode, budget_min)
+    result = get(key)
+    if result is None:
+        result = solve_route(bins, depot_lat, depot_lon, threshold, mode, budget_min)
+        put(key, *result)
+    return result
+
+
+def clear() -> None:
+    """Drop the in-memory results (the disk cache is left alone)."""
+    with _results_lock:
+        _results.clear()
@@ -0,0 +1,319 @@
+"""
+Background route generation.
+
+Solving a route is CPU-bound and can take longer than a request may
+block a gunicorn worker, so the web process only loads the candidate
+bins (one indexed query), records a ``route_jobs`` row and hands the
+solve to a process pool. When the solve finishes, the result is
+published as the new active route version from the web process.
+
+Jobs live in the database, so any worker can report the status of a job
+that another worker started. A request whose inputs (source, depot,
+threshold, mode, budget and the candidate bins themselves) match a job
+that is still running is attached to that job instead of starting a new
+solve (a unique index on the running jobs' input key settles races
+between workers), and one whose result is already in the route cache (see
+route_cache.py) succeeds immediately without a solve. That result is only
+published as a new version when the active route came from a different
+input, so re-submitting an unchanged input does not push real versions
+out of ROUTE_HISTORY_LIMIT.
+
+Environment variables:
+    ROUTE_JOB_WORKERS   solver processes per web worker (default 2)
+    ROUTE_JOB_TIMEOUT   seconds after which a running job is considered
+                        lost, e.g. its web worker was restarted (default 600)
+"""
+import atexit
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent.futures import CancelledError, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from instrumentation import inc
+from models import Depot, RouteJob
+import depots
+import route_cache
+import route_store
+from route_optimizer import input_fingerprint, single_process_worker, solve_route
+
+
+ROUTE_JOB_WORKERS = int(os.environ.get("ROUTE_JOB_WORKERS", "2"))
+ROUTE_JOB_TIMEOUT = int(os.environ.get("ROUTE_JOB_TIMEOUT", "600"))
+
+ACTIVE = "running"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Futures of the jobs started by this process, keyed by job id
+_futures = {}
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: never fork a process that holds DB connections and threads
+            _executor = ProcessPoolExecutor(
+                max_workers=ROUTE_JOB_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                # one solve per process; no nested partition pools
+                initializer=single_process_worker,
+            )
+        return _executor
+
+
+def _submit(fn, *args) -> Future:
+    """
+    Submit to the job pool. A pool whose worker process died is unusable
+    ("broken"); it is replaced once and the call retried.
+    """
+    global _executor
+    executor = _get_executor()
+    try:
+        return executor.submit(fn, *args)
+    except BrokenProcessPool:
+        with _executor_lock:
+            if _executor is executor:
+                _executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+        return _get_executor().submit(fn, *args)
+
+
+@atexit.register
+def shutdown() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def solve_async(*args) -> Future:
+    """Run :func:`solve_route` in the job pool without recording a job."""
+    return _submit(solve_route, *args)
+
+
+def _is_stale(job: RouteJob) -> bool:
+    return (
+        job.status == ACTIVE
+        and job.created_at < datetime.utcnow() - timedelta(seconds=ROUTE_JOB_TIMEOUT)
+    )
+
+
+def _finish(job: RouteJob, status: str, error: Optional[str] = None) -> None:
+    job.status = status
+    job.error = error
+    job.finished_at = datetime.utcnow()
+    inc("app_route_jobs_total", help_text="Finished route jobs", status=status)
+
+
+# ---------- Submission ----------
+
+def _running_job(key: str) -> Optional[RouteJob]:
+    """
+    The running job for an input key. A lost one (see ROUTE_JOB_TIMEOUT)
+    is marked failed, so that it no longer holds the unique index.
+    """
+    job = db.session.execute(
+        db.select(RouteJob)
+        .where(RouteJob.input_key == key)
+        .where(RouteJob.status == ACTIVE)
+        .limit(1)
+    ).scalar()
+    if job is not None and _is_stale(job):
+        _finish(job, "failed", "Job timed out")
+        db.session.commit()
+        return None
+    return job
+
+
+def submit(source: str, depot_lat: float, depot_lon: float,
+           threshold: float, mode: str = "nearest",
+           budget_min: Optional[float] = None,
+           depot: Optional[Depot] = None) -> Tuple[RouteJob, bool]:
+    """
+    Start a route job, or join an identical running one. A result found
+    in the route cache is published right away (status "succeeded").
+    With a registered ``depot`` the solve uses its travel table.
+
+    Returns ``(job, deduplicated)``. Raises LookupError when the source
+    has no predictions with coordinates.
+    """
+    bins = route_store.load_route_candidates(source)
+    if not bins:
+        raise LookupError(f"No {source} predictions found")
+    if depot is not None:
+        depots.attach_depot_distances(bins, depot)
+
+    key = input_fingerprint(source, bins, depot_lat, depot_lon, threshold, mode, budget_min)
+    existing = _running_job(key)
+    if existing is not None:
+        return existing, True
+
+    job = RouteJob(
+        id=uuid.uuid4().hex,
+        input_key=key,
+        source=source,
+        status=ACTIVE,
+        params={
+            "depot_lat": depot_lat,
+            "depot_lon": depot_lon,
+            "threshold": threshold,
+            "mode": mode,
+            "budget_min": budget_min,
+            "depot": depot.name if depot is not None else None,
+        },
+    )
+    db.session.add(job)
+
+    cached = route_cache.get(key)
+    if cached is not None:
+        _store_result(job, *cached, route_id=_published_route_id(source, key))
+        db.session.commit()
+        return job, False
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another worker started the same job since _running_job()
+        db.session.rollback()
+        existing = _running_job(key)
+        if existing is None:
+            raise
+        return existing, True
+
+    try:
+        future = _submit(solve_route, bins, depot_lat, depot_lon, threshold, mode, budget_min)
+    except Exception as e:
+        _finish(job, "failed", str(e))
+        db.session.commit()
+        raise
+    _futures[job.id] = future
+    app = current_app._get_current_object()
+    future.add_done_callback(lambda f, job_id=job.id: _on_done(app, job_id, f))
+    return job, False
+
+
+def _on_done(app, job_id: str, future) -> None:
+    """Persist a finished solve; runs on the executor's callback thread."""
+    _futures.pop(job_id, None)
+    with app.app_context():
+        try:
+            job = db.session.get(RouteJob, job_id)
+            if job is None or job.status != ACTIVE:
+                return  # cancelled (possibly from another worker) meanwhile
+
+            try:
+                route_stops, stats = future.result()
+                route_cache.put(job.input_key, route_stops, stats)
+            except CancelledError:
+                _finish(job, "cancelled")
+                db.session.commit()
+                return
+            except Exception as e:
+                _finish(job, "failed", str(e))
+                db.session.commit()
+                return
+
+            _store_result(job, route_stops, stats)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            app.logger.exception("Failed to store result of route job %s", job_id)
+
+
+def _published_route_id(source: str, key: str) -> Optional[int]:
+    """The active route of ``source`` if a job with input ``key`` published it."""
+    active_id = route_store.get_active_route_id(source)
+    if active_id is None:
+        return None
+    published = db.session.execute(
+        db.select(RouteJob.id)
+        .where(RouteJob.input_key == key)
+        .where(RouteJob.status == "succeeded")
+        .where(RouteJob.route_id == active_id)
+        .limit(1)
+    ).first()
+    return active_id if published is not None else None
+
+
+def _store_result(job: RouteJob, route_stops, stats, route_id: Optional[int] = None) -> None:
+    """Record a solve and publish it, unless ``route_id`` (already published) is given."""
+    if not route_stops:
+        _finish(job, "failed", f"No bins above {job.params['threshold']}% threshold")
+        return
+
+    if route_id is None:
+        # Publish as the new active route version
+        route_id = route_store.publish_route(
+            job.source, f"{job.source.title()} Route - {stats['total_stops']} bins", route_stops
+        ).id
+    job.route_id = route_id
+    job.result = {"route": route_stops, "stats": stats}
+    _finish(job, "succeeded")
+
+
+# ---------- Status and cancellation ----------
+
+def get_job(job_id: str) -> Optional[RouteJob]:
+    job = db.session.get(RouteJob, job_id)
+    if job is not None and _is_stale(job):
+        _finish(job, "failed", "Job timed out")
+        db.session.commit()
+    return job
+
+
+def cancel(job_id: str) -> Optional[RouteJob]:
+    """
+    Cancel a running job. Its result is discarded even if the solve is
+    already underway in a worker process of another web worker.
+    """
+    job = get_job(job_id)
+    if job is None or job.status != ACTIVE:
+        return job
+
+    _finish(job, "cancelled")
+    db.session.commit()
+
+    future = _futures.pop(job_id, None)
+    if future is not None:
+        future.cancel()  # only stops solves that have not started yet
+    return job
+
+
+def preview(job: RouteJob) -> Tuple[List[Dict], Dict]:
+    """
+    Instant Hilbert-curve route for a job's inputs, to show while the
+    real solve runs. Not published.
+    """
+    bins = route_store.load_route_candidates(job.source)
+    return route_cache.solve(
+        job.source, bins, job.params["depot_lat"], job.params["depot_lon"],
+        job.params["threshold"], "hilbert",
+    )
+
+
+def job_to_dict(job: RouteJob) -> Dict:
+    data = {
+        "job_id": job.id,
+        "source": job.source,
+        "status": job.status,
+        "params": job.params,
+        "route_id": job.route_id,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.result is not None:
+        data["route"] = job.result["route"]
+        data["stats"] = job.result["stats"]
+    return data
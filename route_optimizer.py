@@ -2,9 +2,93 @@
 Route optimization using KNN for smart waste collection.
 This module calculates optimal routes based on bin fill predictions.
 """
+from array import array
+import atexit
+import bisect
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
+import hashlib
+import heapq
 import math
+import multiprocessing
+import os
+import random
+import threading
+
+
+EARTH_RADIUS_KM = 6371
+
+# Partitioned mode: bins per area, solver processes, k-means sample size
+# and 2-opt window (stops on each side of a seam)
+ROUTE_PARTITION_SIZE = int(os.environ.get("ROUTE_PARTITION_SIZE", "2000"))
+ROUTE_PARTITION_WORKERS = int(os.environ.get("ROUTE_PARTITION_WORKERS", str(os.cpu_count() or 1)))
+KMEANS_SAMPLE_SIZE = 5000
+SEAM_WINDOW = 25
+
+# Hilbert mode grid resolution (2**16 cells per side, ~1 m at city scale)
+HILBERT_ORDER = 16
+
+# Priority mode: route duration budget (travel plus service time per
+# stop), horizon within which a bin counts as urgent and the capacity
+# that scores as 1.0
+ROUTE_DURATION_BUDGET_MIN = float(os.environ.get("ROUTE_DURATION_BUDGET_MIN", "480"))
+ROUTE_STOP_SERVICE_MIN = float(os.environ.get("ROUTE_STOP_SERVICE_MIN", "0"))
+URGENT_HOURS = 24.0
+DEFAULT_CAPACITY_LITRES = 120
+
+# Values accepted by solve_route(mode=...)
+ROUTE_MODES = ("nearest", "partitioned", "hilbert", "priority")
+
+
+class BinArrays:
+    """
+    Struct-of-arrays view of bin coordinates for the optimizer's inner loops.
+    
+    Coordinates are stored once as float64 arrays in radians (8 bytes per
+    value instead of a boxed float in a dict per bin), together with the
+    cosine of each latitude that the haversine formula needs.
+    """
+    __slots__ = ('lat', 'lon', 'cos_lat')
+    
+    def __init__(self, lat: array, lon: array):
+        self.lat = lat
+        self.lon = lon
+        self.cos_lat = array('d', map(math.cos, lat))
+    
+    @classmethod
+    def from_bins(cls, bins: List[Dict]) -> 'BinArrays':
+        return cls(
+            array('d', (math.radians(b['lat']) for b in bins)),
+            array('d', (math.radians(b['lon']) for b in bins)),
+        )
+    
+    def __len__(self) -> int:
+        return len(self.lat)
+
+
+def neighbor_indexes(bins: List[Dict]) -> Optional[List[List[int]]]:
+    """
+    Each bin's nearest bins as indexes into ``bins``, nearest first, from
+    the ``neighbors`` pks a depot's travel table attaches (depots.py).
+
+    Only when every bin carries them: a bin the table does not cover at
+    its current coordinates may be nearer than anything listed. Other
+    candidates for the same bin (distance 0) come first.
+    """
+    if not bins or not all('neighbors' in b for b in bins):
+        return None
+    indexes: Dict[int, List[int]] = {}
+    for i, b in enumerate(bins):
+        indexes.setdefault(b['bin_pk'], []).append(i)
+    result = []
+    for i, b in enumerate(bins):
+        near = [j for j in indexes[b['bin_pk']] if j != i]
+        for pk in b['neighbors']:
+            near.extend(indexes.get(pk, ()))
+        result.append(near)
+    return result
 
 
 class RouteOptimizer:
@@ -92,8 +176,74 @@ class RouteOptimizer:
         if not priority_bins:
             return []
         
+        order = self.nearest_neighbor_order(
+            BinArrays.from_bins(priority_bins), neighbor_indexes(priority_bins)
+        )
+        return self.build_stops(priority_bins, order)
+    
+    def nearest_neighbor_order(self, arrays: 'BinArrays',
+                               neighbors: Optional[List[List[int]]] = None) -> array:
+        """
+        Visiting order (indexes into ``arrays``) of the nearest neighbor tour.
+        
+        Works on flat float arrays instead of dicts. Candidates are compared
+        by the haversine term ``a``, which grows with distance, so no
+        asin/sqrt is evaluated in the inner loop. A visited bin is removed
+        from the compact ``remaining`` index array by moving the last entry
+        into its place (O(1) instead of shifting the tail); ties go to the
+        lowest index, as with an ordered scan.
+        
+        ``neighbors`` (see neighbor_indexes) lists each bin's nearest bins,
+        nearest first. The first unvisited one is the next stop, since no
+        unvisited bin closer than it can be missing from the list; the
+        remaining bins are only scanned once the whole list is visited.
+        """
+        lat, lon, cos_lat = arrays.lat, arrays.lon, arrays.cos_lat
+        sin = math.sin
+        
+        remaining = array('l', range(len(lat)))
+        # Position of each bin in ``remaining`` and whether it is visited
+        pos = array('l', range(len(lat)))
+        visited = bytearray(len(lat))
+        order = array('l')
+        cur_lat = math.radians(self.depot_lat)
+        cur_lon = math.radians(self.depot_lon)
+        cur_cos = math.cos(cur_lat)
+        
+        while remaining:
+            best_i = -1
+            if neighbors is not None and order:
+                for i in neighbors[order[-1]]:
+                    if not visited[i]:
+                        best_i = i
+                        break
+            if best_i >= 0:
+                best_k = pos[best_i]
+            else:
+                best = float('inf')
+                best_k = best_i = 0
+                for k, i in enumerate(remaining):
+                    s_lat = sin((lat[i] - cur_lat) * 0.5)
+                    s_lon = sin((lon[i] - cur_lon) * 0.5)
+                    a = s_lat * s_lat + cur_cos * cos_lat[i] * s_lon * s_lon
+                    if a <= best and (a < best or i < best_i):
+                        best = a
+                        best_k = k
+                        best_i = i
+            
+            last = remaining.pop()
+            if best_k < len(remaining):
+                remaining[best_k] = last
+                pos[last] = best_k
+            visited[best_i] = 1
+            order.append(best_i)
+            cur_lat, cur_lon, cur_cos = lat[best_i], lon[best_i], cos_lat[best_i]
+        
+        return order
+    
+    def build_stops(self, bins: List[Dict], order) -> List[Dict]:
+        """Convert a visiting order into the public list of stop dicts."""
         route = []
-        unvisited = priority_bins.copy()
         current_pos = (self.depot_lat, self.depot_lon)
         
         # Start from depot
@@ -107,40 +257,40 @@ class RouteOptimizer:
             'est_travel_time_min': 0.0
         })
         
-        # Visit bins using nearest neighbor
-        while unvisited:
-            nearest_idx, nearest_bin = self.find_nearest_neighbor(
-                current_pos, unvisited
-            )
+        for i in order:
+            bin_data = bins[i]
             
-            # Calculate distance and time
-            distance = self.haversine_distance(
-                current_pos[0], current_pos[1],
-                nearest_bin['lat'], nearest_bin['lon']
-            )
+            # Calculate distance and time (from the depot's travel table
+            # when the bins carry it, see depots.py)
+            if len(route) == 1 and 'depot_km' in bin_data:
+                distance = bin_data['depot_km']
+            else:
+                distance = self.haversine_distance(
+                    current_pos[0], current_pos[1],
+                    bin_data['lat'], bin_data['lon']
+                )
             travel_time = (distance / self.avg_speed_kmh) * 60  # minutes
             
-            # Add stop to route
             route.append({
                 'order_index': len(route),
-                'label': f"Bin {nearest_bin['bin_id']}",
-                'bin_id': nearest_bin['bin_id'],
-                'lat': nearest_bin['lat'],
-                'lon': nearest_bin['lon'],
+                'label': f"Bin {bin_data['bin_id']}",
+                'bin_id': bin_data['bin_id'],
+                'lat': bin_data['lat'],
+                'lon': bin_data['lon'],
                 'distance_from_prev_km': round(distance, 2),
                 'est_travel_time_min': round(travel_time, 1),
-                'predicted_fill_percent': nearest_bin.get('predicted_fill_percent', 0)
+                'predicted_fill_percent': bin_data.get('predicted_fill_percent', 0)
             })
-            
-            # Update position and remove visited bin
-            current_pos = (nearest_bin['lat'], nearest_bin['lon'])
-            unvisited.pop(nearest_idx)
+            current_pos = (bin_data['lat'], bin_data['lon'])
         
         # Return to depot
-        distance = self.haversine_distance(
-            current_pos[0], current_pos[1],
-            self.depot_lat, self.depot_lon
-        )
+        if len(route) > 1 and 'depot_km' in bins[order[-1]]:
+            distance = bins[order[-1]]['depot_km']
+        else:
+            distance = self.haversine_distance(
+                current_pos[0], current_pos[1],
+                self.depot_lat, self.depot_lon
+            )
         travel_time = (distance / self.avg_speed_kmh) * 60
         
         route.append({
@@ -155,6 +305,164 @@ class RouteOptimizer:
         
         return route
     
+    def optimize_route_hilbert(self, bins: List[Dict],
+                               priority_threshold: float = 80.0) -> List[Dict]:
+        """
+        Instant O(n log n) route: visit bins in Hilbert-curve order.
+        
+        Tours are typically 10-15% longer than nearest neighbor, but the
+        order is available immediately for previews, and it can seed an
+        improvement stage such as 2-opt.
+        
+        Args:
+            bins: List of bins with coordinates and fill levels
+            priority_threshold: Minimum fill % to include in route
+            
+        Returns:
+            List of route stops in the same format as optimize_route
+        """
+        priority_bins = [
+            b for b in bins 
+            if b.get('predicted_fill_percent', 0) >= priority_threshold
+        ]
+        
+        if not priority_bins:
+            return []
+        
+        order = hilbert_order(
+            BinArrays.from_bins(priority_bins),
+            math.radians(self.depot_lat), math.radians(self.depot_lon)
+        )
+        return self.build_stops(priority_bins, order)
+    
+    def optimize_route_partitioned(self, bins: List[Dict],
+                                   priority_threshold: float = 80.0,
+                                   workers: int = None) -> List[Dict]:
+        """
+        Divide-and-conquer variant of :meth:`optimize_route` for city-scale inputs.
+        
+        Bins are split into compact areas with k-means, the areas are visited
+        in nearest-neighbor order of their centroids, and each area's sub-tour
+        is solved in its own worker process. The seams between sub-tours are
+        then repaired with 2-opt.
+        
+        Args:
+            bins: List of bins with coordinates and fill levels
+            priority_threshold: Minimum fill % to include in route
+            workers: Minimum number of areas, solved in parallel on the shared
+                partition pool (default ROUTE_PARTITION_WORKERS / CPU count);
+                1 solves them in this process
+            
+        Returns:
+            List of route stops in the same format as optimize_route
+        """
+        priority_bins = [
+            b for b in bins 
+            if b.get('predicted_fill_percent', 0) >= priority_threshold
+        ]
+        
+        if not priority_bins:
+            return []
+        
+        workers = workers or ROUTE_PARTITION_WORKERS
+        arrays = BinArrays.from_bins(priority_bins)
+        k = max(workers, math.ceil(len(arrays) / ROUTE_PARTITION_SIZE))
+        if k <= 1 or len(arrays) <= ROUTE_PARTITION_SIZE:
+            return self.build_stops(priority_bins, self.nearest_neighbor_order(arrays))
+        
+        centroids, members = kmeans_partition(arrays, k)
+        
+        # Visit areas in nearest-neighbor order of their centroids; each
+        # sub-tour starts from the point closest to where the previous area
+        # lies, so the sub-tours can be solved independently
+        area_order = RouteOptimizer(self.depot_lat, self.depot_lon).nearest_neighbor_order(
+            BinArrays(array('d', (c[0] for c in centroids)), array('d', (c[1] for c in centroids)))
+        )
+        tasks = []
+        prev = (math.radians(self.depot_lat), math.radians(self.depot_lon))
+        for a in area_order:
+            idx = members[a]
+            tasks.append((
+                array('d', (arrays.lat[i] for i in idx)),
+                array('d', (arrays.lon[i] for i in idx)),
+                math.degrees(prev[0]),
+                math.degrees(prev[1]),
+            ))
+            prev = centroids[a]
+        
+        if workers > 1 and not _single_process:
+            local_orders = _map_partitions(tasks)
+        else:
+            local_orders = [_partition_order(*t) for t in tasks]
+        
+        order = array('l')
+        seams = []
+        for a, local in zip(area_order, local_orders):
+            seams.append(len(order))
+            idx = members[a]
+            order.extend(idx[j] for j in local)
+        
+        order = repair_seams(arrays, order, seams[1:],
+                             math.radians(self.depot_lat), math.radians(self.depot_lon))
+        return self.build_stops(priority_bins, order)
+    
+    def optimize_route_priority(self, bins: List[Dict],
+                                priority_threshold: float = 80.0,
+                                budget_min: float = None,
+                                now: datetime = None) -> Tuple[List[Dict], int]:
+        """
+        Prize-collecting route: the most valuable bins that fit a duration budget.
+        
+        Every bin at or above the threshold, or predicted full within
+        URGENT_HOURS, is a candidate and is scored by :func:`score_bins`.
+        Candidates are toured (nearest neighbor, or Hilbert order above
+        ROUTE_PARTITION_SIZE bins) and, while the tour is over budget, the
+        stop with the lowest score per minute its removal saves is dropped.
+        
+        Args:
+            bins: List of bins with coordinates, fill levels and optionally
+                predicted_full_at and capacity_litres
+            priority_threshold: Fill % at which a bin is always a candidate
+            budget_min: Route duration budget (default ROUTE_DURATION_BUDGET_MIN)
+            now: Reference time for urgency (default utcnow)
+            
+        Returns:
+            (stops in the same format as optimize_route, candidates dropped
+            to meet the budget)
+        """
+        budget_min = ROUTE_DURATION_BUDGET_MIN if budget_min is None else budget_min
+        scores = score_bins(bins, now or datetime.utcnow())
+        
+        # One candidate per bin, by its most urgent prediction
+        best = {}
+        horizon = (now or datetime.utcnow()) + timedelta(hours=URGENT_HOURS)
+        for i, b in enumerate(bins):
+            full_at = b.get('predicted_full_at')
+            if (b.get('predicted_fill_percent', 0) >= priority_threshold
+                    or (full_at is not None and full_at <= horizon)):
+                j = best.get(b['bin_id'])
+                if j is None or scores[i] > scores[j]:
+                    best[b['bin_id']] = i
+        if not best:
+            return [], 0
+        
+        idx = sorted(best.values())
+        candidates = [bins[i] for i in idx]
+        prize = array('d', (scores[i] for i in idx))
+        arrays = BinArrays.from_bins(candidates)
+        depot_lat, depot_lon = math.radians(self.depot_lat), math.radians(self.depot_lon)
+        if len(arrays) > ROUTE_PARTITION_SIZE:
+            order = hilbert_order(arrays, depot_lat, depot_lon)
+        else:
+            order = self.nearest_neighbor_order(arrays)
+        
+        depot_km = None
+        if any('depot_km' in b for b in candidates):
+            depot_km = array('d', (b.get('depot_km', math.nan) for b in candidates))
+        kept = drop_to_budget(arrays, order, prize, budget_min, depot_lat, depot_lon,
+                              self.avg_speed_kmh, ROUTE_STOP_SERVICE_MIN, depot_km)
+        return self.build_stops(candidates, kept), len(order) - len(kept)
+    
     def calculate_route_stats(self, route: List[Dict]) -> Dict:
         """Calculate statistics for a route."""
         total_distance = sum(stop['distance_from_prev_km'] for stop in route)
@@ -166,3 +474,392 @@ class RouteOptimizer:
             'total_time_min': round(total_time, 1),
             'total_time_hours': round(total_time / 60, 2)
         }
+
+
+# ---------- Hilbert curve ordering ----------
+
+def hilbert_index(x: int, y: int, order: int = HILBERT_ORDER) -> int:
+    """Position of cell (x, y) along a Hilbert curve over a 2**order grid."""
+    n = 1 << order
+    d = 0
+    s = n >> 1
+    while s:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve stays continuous
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return d
+
+
+def hilbert_order(arrays: BinArrays, depot_lat: float, depot_lon: float) -> array:
+    """
+    Visiting order (indexes into ``arrays``) along a Hilbert curve.
+    
+    Points are scaled onto a 2**HILBERT_ORDER grid over their bounding
+    box (longitude shrunk by cos(latitude) so cells are square), sorted by
+    curve position and rotated to start at the first bin after the depot
+    on the curve. Coordinates are in radians.
+    """
+    n = len(arrays)
+    lat, lon = arrays.lat, arrays.lon
+    x_scale = math.cos((min(lat) + max(lat)) / 2)
+    min_y, max_y = min(min(lat), depot_lat), max(max(lat), depot_lat)
+    min_x = min(min(lon), depot_lon) * x_scale
+    max_x = max(max(lon), depot_lon) * x_scale
+    cells = (1 << HILBERT_ORDER) - 1
+    span = max(max_y - min_y, max_x - min_x) or 1.0
+    
+    def key(y, x):
+        return hilbert_index(
+            int((x * x_scale - min_x) / span * cells),
+            int((y - min_y) / span * cells),
+        )
+    
+    keys = [key(lat[i], lon[i]) for i in range(n)]
+    order = sorted(range(n), key=keys.__getitem__)
+    
+    depot_key = key(depot_lat, depot_lon)
+    start = bisect.bisect_left([keys[i] for i in order], depot_key)
+    return array('l', order[start:] + order[:start])
+
+
+# ---------- Priority scoring ----------
+
+def score_bins(bins: List[Dict], now: datetime) -> array:
+    """
+    Collection value of each bin (same order as ``bins``).
+    
+    The expected load, fill fraction times capacity relative to
+    DEFAULT_CAPACITY_LITRES, weighted up to 3x by urgency: 1.0 for a bin
+    that is full or predicted full now, 0.5 for one full in URGENT_HOURS,
+    falling off beyond that, and 0 without a predicted_full_at.
+    
+    Computed column-wise over flat arrays in one pass per column.
+    """
+    fill = array('d', (min(max(b.get('predicted_fill_percent', 0) or 0, 0), 100) / 100 for b in bins))
+    load = array('d', (
+        f * ((b.get('capacity_litres') or DEFAULT_CAPACITY_LITRES) / DEFAULT_CAPACITY_LITRES)
+        for f, b in zip(fill, bins)
+    ))
+    hours = [
+        None if b.get('predicted_full_at') is None
+        else max((b['predicted_full_at'] - now).total_seconds() / 3600, 0.0)
+        for b in bins
+    ]
+    urgency = array('d', (
+        1.0 if f >= 1.0 else 0.0 if h is None else URGENT_HOURS / (URGENT_HOURS + h)
+        for f, h in zip(fill, hours)
+    ))
+    return array('d', (l * (1.0 + 2.0 * u) for l, u in zip(load, urgency)))
+
+
+def drop_to_budget(arrays: BinArrays, order: array, prize: array, budget_min: float,
+                   depot_lat: float, depot_lon: float, speed_kmh: float,
+                   service_min: float = 0.0, depot_km: array = None) -> array:
+    """
+    Remove stops from a depot-to-depot tour until it fits ``budget_min``.
+    
+    Greedy drop heuristic for the prize-collecting TSP: the stop with the
+    lowest prize per minute saved by skipping it goes first. The tour is
+    a doubly linked list and candidates sit in a heap whose stale entries
+    (a neighbor was removed since) are skipped, so this is O(n log n).
+    Dropped stops are then re-inserted, most valuable first, wherever the
+    remaining budget still allows. Coordinates are in radians;
+    ``depot_km`` optionally gives precomputed depot distances per bin
+    (NaN where unknown).
+    """
+    n = len(order)
+    lat, lon, cos_lat = arrays.lat, arrays.lon, arrays.cos_lat
+    depot_cos = math.cos(depot_lat)
+    minutes_per_km = 60.0 / speed_kmh
+    
+    # Tour positions 1..n are stops, 0 and n + 1 the depot
+    def point(p):
+        if p == 0 or p == n + 1:
+            return depot_lat, depot_lon, depot_cos
+        i = order[p - 1]
+        return lat[i], lon[i], cos_lat[i]
+    
+    def leg(p, q):
+        if depot_km is not None and (p == 0) != (q == n + 1):
+            km = depot_km[order[q - 1] if p == 0 else order[p - 1]]
+            if km == km:
+                return km * minutes_per_km
+        return _hav_km(*point(p), *point(q)) * minutes_per_km
+    
+    prev = list(range(-1, n + 1))
+    nxt = list(range(1, n + 3))
+    version = [0] * (n + 2)
+    total = sum(leg(p, p + 1) for p in range(n + 1)) + service_min * n
+    
+    def saving(p):
+        return leg(prev[p], p) + leg(p, nxt[p]) - leg(prev[p], nxt[p]) + service_min
+    
+    def entry(p):
+        saved = saving(p)
+        ratio = prize[order[p - 1]] / saved if saved > 0 else float('inf')
+        return (ratio, p, version[p], saved)
+    
+    heap = [entry(p) for p in range(1, n + 1)]
+    heapq.heapify(heap)
+    removed = [False] * (n + 2)
+    
+    while total > budget_min and heap:
+        ratio, p, ver, saved = heapq.heappop(heap)
+        if removed[p] or ver != version[p]:
+            continue
+        removed[p] = True
+        total -= saved
+        a, b = prev[p], nxt[p]
+        nxt[a], prev[b] = b, a
+        for q in (a, b):
+            if 0 < q <= n:
+                version[q] += 1
+                heapq.heappush(heap, entry(q))
+    
+    # Refill the slack the last (possibly large) drops left behind
+    for p in sorted((p for p in range(1, n + 1) if removed[p]),
+                    key=lambda p: prize[order[p - 1]], reverse=True):
+        a = prev[p]
+        while removed[a]:
+            a = prev[a]
+        b = nxt[a]
+        cost = leg(a, p) + leg(p, b) - leg(a, b) + service_min
+        if total + cost <= budget_min:
+            removed[p] = False
+            total += cost
+            prev[p], nxt[p] = a, b
+            nxt[a], prev[b] = p, p
+    
+    kept = array('l')
+    p = nxt[0]
+    while p != n + 1:
+        kept.append(order[p - 1])
+        p = nxt[p]
+    return kept
+
+
+# ---------- Partitioned solving ----------
+
+def _hav_km(lat1: float, lon1: float, cos1: float,
+            lat2: float, lon2: float, cos2: float) -> float:
+    """Haversine distance in km between points given in radians."""
+    s_lat = math.sin((lat2 - lat1) * 0.5)
+    s_lon = math.sin((lon2 - lon1) * 0.5)
+    a = s_lat * s_lat + cos1 * cos2 * s_lon * s_lon
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def kmeans_partition(arrays: BinArrays, k: int,
+                     iterations: int = 8) -> Tuple[List[Tuple[float, float]], List[array]]:
+    """
+    Split bins into ``k`` compact areas with k-means.
+    
+    Centroids are fitted on a fixed-seed sample (at most
+    KMEANS_SAMPLE_SIZE points) on an equirectangular projection, then
+    every bin is assigned to its nearest centroid once. Returns
+    ``(centroids, members)`` with centroids as (lat, lon) in radians and
+    members as index arrays; empty areas are dropped.
+    """
+    n = len(arrays)
+    rng = random.Random(0)
+    lat, lon = arrays.lat, arrays.lon
+    x_scale = math.cos(sum(lat) / n)
+    sample = rng.sample(range(n), min(n, KMEANS_SAMPLE_SIZE))
+    centroids = [(lat[i], lon[i] * x_scale) for i in rng.sample(sample, min(k, len(sample)))]
+    
+    def nearest(y, x):
+        best, best_c = float('inf'), 0
+        for c, (cy, cx) in enumerate(centroids):
+            d = (y - cy) ** 2 + (x - cx) ** 2
+            if d < best:
+                best, best_c = d, c
+        return best_c
+    
+    for _ in range(iterations):
+        sums = [[0.0, 0.0, 0] for _ in centroids]
+        for i in sample:
+            acc = sums[nearest(lat[i], lon[i] * x_scale)]
+            acc[0] += lat[i]
+            acc[1] += lon[i] * x_scale
+            acc[2] += 1
+        centroids = [
+            (sy / cnt, sx / cnt) if cnt else old
+            for (sy, sx, cnt), old in zip(sums, centroids)
+        ]
+    
+    members = [array('l') for _ in centroids]
+    for i in range(n):
+        members[nearest(lat[i], lon[i] * x_scale)].append(i)
+    
+    areas = [
+        ((cy, cx / x_scale), idx)
+        for (cy, cx), idx in zip(centroids, members) if idx
+    ]
+    return [a[0] for a in areas], [a[1] for a in areas]
+
+
+def _partition_order(lat: array, lon: array, start_lat: float, start_lon: float) -> array:
+    """Nearest-neighbor order of one area; runs in a worker process."""
+    return RouteOptimizer(start_lat, start_lon).nearest_neighbor_order(BinArrays(lat, lon))
+
+
+# Partition solver pool shared by all partitioned solves of this process,
+# started on first use
+_partition_pool = None
+_single_process = False  # set in pool workers by single_process_worker()
+_partition_pool_lock = threading.Lock()
+
+
+def _get_partition_pool() -> ProcessPoolExecutor:
+    global _partition_pool
+    with _partition_pool_lock:
+        if _partition_pool is None:
+            # spawn: never fork a process that holds DB connections and threads
+            _partition_pool = ProcessPoolExecutor(
+                max_workers=ROUTE_PARTITION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _partition_pool
+
+
+@atexit.register
+def _shutdown_partition_pool() -> None:
+    global _partition_pool
+    with _partition_pool_lock:
+        if _partition_pool is not None:
+            _partition_pool.shutdown(wait=False, cancel_futures=True)
+            _partition_pool = None
+
+
+def _map_partitions(tasks: List[Tuple]) -> List[array]:
+    """_partition_order of every task on the shared pool (replaced once if broken)."""
+    global _partition_pool
+    pool = _get_partition_pool()
+    try:
+        return list(pool.map(_partition_order, *zip(*tasks)))
+    except BrokenProcessPool:
+        with _partition_pool_lock:
+            if _partition_pool is pool:
+                _partition_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        return list(_get_partition_pool().map(_partition_order, *zip(*tasks)))
+
+
+def single_process_worker() -> None:
+    """
+    Pool initializer for processes that run solves themselves (route jobs,
+    simulation): parallelism is already one solve per process, so
+    partitioned solves in them must not start pools of their own. The
+    areas stay the same, so the route does not depend on where it was
+    solved.
+    """
+    global _single_process
+    _single_process = True
+
+
+def repair_seams(arrays: BinArrays, order: array, seams: List[int],
+                 depot_lat: float, depot_lon: float) -> array:
+    """
+    2-opt restricted to a window of SEAM_WINDOW stops around each seam.
+    
+    ``order`` is the stitched visiting order (depot excluded) and
+    ``seams`` the positions where a new sub-tour starts. Coordinates are
+    in radians. Returns the improved order.
+    """
+    lat = array('d', arrays.lat)
+    lon = array('d', arrays.lon)
+    cos_lat = array('d', arrays.cos_lat)
+    depot = len(lat)
+    lat.append(depot_lat)
+    lon.append(depot_lon)
+    cos_lat.append(math.cos(depot_lat))
+    
+    def dist(i, j):
+        return _hav_km(lat[i], lon[i], cos_lat[i], lat[j], lon[j], cos_lat[j])
+    
+    # Depot at both ends so the first and last legs can be repaired too
+    path = array('l', [depot]) + order + array('l', [depot])
+    for seam in seams:
+        lo = max(1, seam + 1 - SEAM_WINDOW)
+        hi = min(len(path) - 2, seam + 1 + SEAM_WINDOW)
+        improved = True
+        while improved:
+            improved = False
+            for i in range(lo, hi):
+                for j in range(i + 1, hi + 1):
+                    a, b, c, d = path[i - 1], path[i], path[j], path[j + 1]
+                    if dist(a, c) + dist(b, d) < dist(a, b) + dist(c, d) - 1e-9:
+                        path[i:j + 1] = path[i:j + 1][::-1]
+                        improved = True
+    return path[1:-1]
+
+
+def solve_route(bins: List[Dict], depot_lat: float, depot_lon: float,
+                threshold: float, mode: str = "nearest",
+                budget_min: Optional[float] = None,
+                now: Optional[datetime] = None) -> Tuple[List[Dict], Dict]:
+    """
+    Optimize a route and compute its stats.
+
+    ``mode`` is one of ROUTE_MODES; ``budget_min`` and ``now`` (reference
+    time for urgency, default utcnow) only apply to "priority". Top-level
+    (and free of database access) so it can run in a worker process of
+    the route job pool.
+    """
+    optimizer = RouteOptimizer(depot_lat, depot_lon)
+    if mode == "priority":
+        route, skipped = optimizer.optimize_route_priority(
+            bins, priority_threshold=threshold, budget_min=budget_min, now=now
+        )
+        stats = optimizer.calculate_route_stats(route)
+        stats['budget_min'] = ROUTE_DURATION_BUDGET_MIN if budget_min is None else budget_min
+        stats['skipped_stops'] = skipped
+        return route, stats
+    if mode == "partitioned":
+        route = optimizer.optimize_route_partitioned(bins, priority_threshold=threshold)
+    elif mode == "hilbert":
+        route = optimizer.optimize_route_hilbert(bins, priority_threshold=threshold)
+    elif mode == "nearest":
+        route = optimizer.optimize_route(bins, priority_threshold=threshold)
+    else:
+        raise ValueError(f"mode must be one of {', '.join(ROUTE_MODES)}")
+    return route, optimizer.calculate_route_stats(route)
+
+
+def input_fingerprint(source: str, bins: List[Dict], depot_lat: float,
+                      depot_lon: float, threshold: float, mode: str = "nearest",
+                      budget_min: Optional[float] = None) -> str:
+    """
+    Stable hash of everything a solve depends on.
+
+    Two requests with the same fingerprint produce the same route, so
+    they can share one job (or one cached result). Priority routes also
+    depend on the time (urgency), so they are keyed by the hour as well.
+    The travel table values a depot attaches (``depot_km``, ``neighbors``)
+    are part of the input too: a bin the table did not cover yet solves
+    differently once it does.
+    """
+    h = hashlib.sha256()
+    h.update(f"{source}|{mode}|{depot_lat:.6f}|{depot_lon:.6f}|{threshold:.3f}".encode())
+    priority = mode == "priority"
+    if priority:
+        h.update(f"|{budget_min}|{datetime.utcnow():%Y-%m-%dT%H}".encode())
+    for b in sorted(bins, key=lambda b: (b['bin_id'], b.get('predicted_fill_percent', 0))):
+        h.update(
+            f"|{b['bin_id']},{b['lat']:.6f},{b['lon']:.6f},"
+            f"{b.get('predicted_fill_percent', 0)}".encode()
+        )
+        if priority:
+            h.update(f",{b.get('predicted_full_at')},{b.get('capacity_litres')}".encode())
+        if 'depot_km' in b:
+            h.update(f",{b['depot_km']:.6f}".encode())
+        if 'neighbors' in b:
+            h.update(f",{' '.join(map(str, b['neighbors']))}".encode())
+    return h.hexdigest()
@@ -0,0 +1,312 @@
+"""
+Set-based persistence and versioning for generated and uploaded routes.
+
+Routes are immutable once written: every generation or upload inserts a
+new version and then swaps the per-source ``active_routes`` pointer in
+the same transaction. Readers resolve the pointer and serve the version
+from an in-process cache, which never needs invalidating because a
+version id always refers to the same stops.
+
+All route writers share these helpers so that saving a route costs a
+handful of round trips regardless of its length: one query to resolve
+bin ids, one bulk INSERT for the stops and one upsert for the pointer.
+"""
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+from db_config import dialect_insert
+from extensions import db
+from models import ActiveRoute, Bin, MLPrediction, Route, RouteStop
+
+
+# Number of versions kept per source; 0 keeps the full history
+ROUTE_HISTORY_LIMIT = int(os.environ.get("ROUTE_HISTORY_LIMIT", "0"))
+
+# Serialized route versions, keyed by route id
+ROUTE_CACHE_SIZE = 256
+_route_cache = OrderedDict()
+_route_cache_lock = threading.Lock()
+
+
+# ---------- Writers ----------
+
+def resolve_bin_ids(bin_codes: Iterable[str]) -> Dict[str, int]:
+    """Map trash_can_id -> bins.id for all given codes in a single query."""
+    codes = {c for c in bin_codes if c}
+    if not codes:
+        return {}
+
+    rows = (
+        db.session.query(Bin.trash_can_id, Bin.id)
+        .filter(Bin.trash_can_id.in_(codes))
+        .all()
+    )
+    return {code: bin_pk for code, bin_pk in rows}
+
+
+def delete_routes(source: str, keep: Optional[List[int]] = None) -> None:
+    """
+    Delete routes (and their stops) for a source with two statements.
+
+    Route ids in ``keep`` and the currently active version are left alone.
+    Deleted versions are dropped from this worker's payload cache.
+    """
+    keep = set(keep or [])
+    active_id = get_active_route_id(source)
+    if active_id is not None:
+        keep.add(active_id)
+
+    route_ids = db.select(Route.id).where(Route.source == source)
+    if keep:
+        route_ids = route_ids.where(Route.id.notin_(keep))
+
+    db.session.execute(
+        db.delete(RouteStop)
+        .where(RouteStop.route_id.in_(route_ids.scalar_subquery()))
+        .execution_options(synchronize_session=False)
+    )
+    route_delete = db.delete(Route).where(Route.source == source)
+    if keep:
+        route_delete = route_delete.where(Route.id.notin_(keep))
+    deleted = db.session.execute(
+        route_delete.returning(Route.id).execution_options(synchronize_session=False)
+    ).scalars().all()
+    with _route_cache_lock:
+        for route_id in deleted:
+            _route_cache.pop(route_id, None)
+
+
+def save_route(source: str, name: str, stops: List[Dict]) -> Route:
+    """
+    Insert a route version and all of its stops without activating it.
+
+    ``stops`` use the optimizer's stop format (order_index, label, bin_id,
+    lat, lon, distance_from_prev_km, est_travel_time_min) where bin_id is
+    the public trash_can_id. The caller is responsible for committing.
+    """
+    route_obj = Route(name=name, source=source)
+    db.session.add(route_obj)
+    db.session.flush()  # populate id
+
+    bin_ids = resolve_bin_ids(s.get("bin_id") for s in stops)
+
+    rows = [
+        {
+            "route_id": route_obj.id,
+            "order_index": s["order_index"],
+            "label": s.get("label"),
+            "bin_id": bin_ids.get(s.get("bin_id")),
+            "latitude": s.get("lat"),
+            "longitude": s.get("lon"),
+            "distance_from_prev_km": s.get("distance_from_prev_km"),
+            "est_travel_time_min": s.get("est_travel_time_min"),
+        }
+        for s in stops
+    ]
+    if rows:
+        db.session.execute(db.insert(RouteStop), rows)
+
+    return route_obj
+
+
+def activate_route(source: str, route_id: int) -> None:
+    """Point ``source`` at ``route_id`` with a single upsert."""
+    insert = dialect_insert()
+    values = {"source": source, "route_id": route_id, "updated_at": datetime.utcnow()}
+
+    if insert is not db.insert:
+        stmt = insert(ActiveRoute).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ActiveRoute.source],
+            set_={"route_id": route_id, "updated_at": values["updated_at"]},
+        )
+        db.session.execute(stmt)
+    else:
+        db.session.merge(ActiveRoute(**values))
+
+
+def publish_route(source: str, name: str, stops: List[Dict]) -> Route:
+    """
+    Save a new route version and make it the active one for ``source``.
+
+    Both happen in the caller's transaction, so readers see either the
+    previous version or the complete new one. Older versions are kept as
+    history (trimmed to ROUTE_HISTORY_LIMIT when set).
+    """
+    route_obj = save_route(source, name, stops)
+    activate_route(source, route_obj.id)
+
+    if ROUTE_HISTORY_LIMIT > 0:
+        recent = (
+            db.session.query(Route.id)
+            .filter(Route.source == source)
+            .order_by(Route.id.desc())
+            .limit(ROUTE_HISTORY_LIMIT)
+            .all()
+        )
+        delete_routes(source, keep=[r.id for r in recent])
+
+    return route_obj
+
+
+# ---------- Readers ----------
+
+def route_candidates_statement(source: str):
+    """SELECT (MLPrediction, Bin) rows with coordinates, the optimizer's input."""
+    return (
+        db.select(MLPrediction, Bin)
+        .join(Bin, MLPrediction.bin_id == Bin.id)
+        .where(MLPrediction.source == source)
+        .where(Bin.latitude.isnot(None))
+        .where(Bin.longitude.isnot(None))
+    )
+
+
+def load_route_candidates(source: str, order_by_fill: bool = False, session=None) -> List[Dict]:
+    """Return predictions with coordinates as optimizer bin dicts."""
+    session = session or db.session
+    stmt = route_candidates_statement(source)
+    if order_by_fill:
+        stmt = stmt.order_by(MLPrediction.predicted_fill_percent.desc())
+
+    return [
+        {
+            'bin_id': bin_obj.trash_can_id,
+            'bin_pk': bin_obj.id,
+            'lat': bin_obj.latitude,
+            'lon': bin_obj.longitude,
+            'predicted_fill_percent': p.predicted_fill_percent,
+            'predicted_full_at': p.predicted_full_at,
+            'capacity_litres': bin_obj.capacity_litres,
+        }
+        for p, bin_obj in session.execute(stmt).all()
+    ]
+
+
+def active_route_statement(source: str):
+    """SELECT for the active route id of a source."""
+    return db.select(ActiveRoute.route_id).where(ActiveRoute.source == source)
+
+
+def latest_route_statement(source: str):
+    """SELECT for the newest route id of a source (pre-versioning fallback)."""
+    return (
+        db.select(Route.id)
+        .where(Route.source == source)
+        .order_by(Route.created_at.desc(), Route.id.desc())
+        .limit(1)
+    )
+
+
+def route_stops_statement(route_id: int):
+    """SELECT for (RouteStop, trash_can_id) rows of a route in stop order."""
+    return (
+        db.select(RouteStop, Bin.trash_can_id)
+        .outerjoin(Bin, RouteStop.bin_id == Bin.id)
+        .where(RouteStop.route_id == route_id)
+        .order_by(RouteStop.order_index)
+    )
+
+
+def get_active_route_id(source: str, session=None) -> Optional[int]:
+    """Return the active version for a source, falling back to the newest route."""
+    session = session or db.session
+    route_id = session.execute(active_route_statement(source)).scalar()
+    if route_id is None:
+        # Databases written before versioning have no pointer yet
+        route_id = session.execute(latest_route_statement(source)).scalar()
+    return route_id
+
+
+def build_route_payload(route: Route, stop_rows) -> Dict:
+    """Serialize a route and its (RouteStop, trash_can_id) rows."""
+    return {
+        "route_id": route.id,
+        "version": route.id,
+        "name": route.name,
+        "source": route.source,
+        "created_at": route.created_at.isoformat() if route.created_at else None,
+        "stops": [
+            {
+                "order_index": s.order_index,
+                "label": s.label,
+                "bin_id": trash_can_id,
+                "lat": s.latitude,
+                "lon": s.longitude,
+                "distance_from_prev_km": s.distance_from_prev_km,
+                "est_travel_time_min": s.est_travel_time_min,
+            }
+            for s, trash_can_id in stop_rows
+        ],
+    }
+
+
+def cached_route_payload(route_id: int) -> Optional[Dict]:
+    """Return a serialized route version from the process cache, if present."""
+    with _route_cache_lock:
+        payload = _route_cache.get(route_id)
+        if payload is not None:
+            _route_cache.move_to_end(route_id)
+        return payload
+
+
+def cache_route_payload(route_id: int, payload: Dict) -> None:
+    """Store a serialized route version (bounded LRU)."""
+    with _route_cache_lock:
+        _route_cache[route_id] = payload
+        while len(_route_cache) > ROUTE_CACHE_SIZE:
+            _route_cache.popitem(last=False)
+
+
+def get_route_payload(route_id: int, session=None) -> Optional[Dict]:
+    """
+    Return the serialized route version, or None if it does not exist.
+
+    Versions never change after they are written, so results are cached
+    for the life of the process.
+    """
+    payload = cached_route_payload(route_id)
+    if payload is not None:
+        return payload
+
+    session = session or db.session
+    route = session.get(Route, route_id)
+    if route is None:
+        return None
+
+    payload = build_route_payload(route, session.execute(route_stops_statement(route_id)).all())
+    cache_route_payload(route_id, payload)
+    return payload
+
+
+def list_route_versions(source: str, limit: int = 20, session=None) -> List[Dict]:
+    """Return metadata for the most recent route versions of a source."""
+    session = session or db.session
+    active_id = get_active_route_id(source, session)
+    routes = (
+        session.query(Route)
+        .filter(Route.source == source)
+        .order_by(Route.id.desc())
+        .limit(limit)
+        .all()
+    )
+    # Stops counted for the listed versions only (index on route_id)
+    counts = dict(
+        session.query(RouteStop.route_id, db.func.count(RouteStop.id))
+        .filter(RouteStop.route_id.in_([r.id for r in routes]))
+        .group_by(RouteStop.route_id)
+        .all()
+    ) if routes else {}
+    return [
+        {
+            "version": r.id,
+            "name": r.name,
+            "created_at": r.created_at.isoformat() if r.created_at else None,
+            "stop_count": counts.get(r.id, 0),
+            "active": r.id == active_id,
+        }
+        for r in routes
+    ]
@@ -1,49 +1,129 @@
-from flask import Blueprint, request, jsonify
-from datetime import datetime
-from models import Bin, MLPrediction, Route, RouteStop
+import math
+
+from flask import Blueprint, Response, request, jsonify
+from datetime import datetime, timedelta, timezone
+from models import Bin, MLPrediction
 from extensions import db
+import change_feed
+import instrumentation
+import request_guards
+import retention
+import route_store
+from db_config import dialect_insert, read_session
+from idempotency import MAX_KEY_LENGTH, insert_prediction, recent_submissions, submission_key
+from response_formats import (
+    format_route,
+    negotiate_format,
+    representation_etag,
+    requested_fields,
+    to_columnar,
+)
 
 api_bp = Blueprint("api", __name__)
 
+PREDICTION_FIELDS = (
+    "bin_id", "location_name", "lat", "lon",
+    "predicted_fill_percent", "predicted_full_at", "recorded_at",
+)
+STOP_FIELDS = (
+    "order_index", "label", "bin_id", "lat", "lon",
+    "distance_from_prev_km", "est_travel_time_min",
+)
+
 
 # ---------- Predictions API ----------
 
+def predictions_statement(source):
+    """SELECT (MLPrediction, Bin) rows for a source, latest first."""
+    return (
+        db.select(MLPrediction, Bin)
+        .join(Bin, MLPrediction.bin_id == Bin.id)
+        .where(MLPrediction.source == source)
+        .order_by(MLPrediction.created_at.desc())  # Latest first
+    )
+
+
+def serialize_prediction(p, bin_obj):
+    """JSON shape of one prediction row."""
+    return {
+        "bin_id": bin_obj.trash_can_id if bin_obj else None,
+        "location_name": bin_obj.location_name if bin_obj else None,
+        # expose latitude/longitude from DB as lat/lon in JSON
+        "lat": bin_obj.latitude if bin_obj else None,
+        "lon": bin_obj.longitude if bin_obj else None,
+        "predicted_fill_percent": p.predicted_fill_percent,
+        "predicted_full_at": (
+            p.predicted_full_at.isoformat() if p.predicted_full_at else None
+        ),
+        "recorded_at": (
+            p.created_at.isoformat() if p.created_at else None
+        ),
+    }
+
+
 @api_bp.route("/api/predictions")
 def api_predictions():
     """
     Return a list of predictions (test or prototype) ordered by
     recorded time (created_at) descending - latest first.
+
+    ``?format=columnar`` returns one array per field instead of one object
+    per row; ``?fields=lat,lon,predicted_fill_percent`` limits the fields.
+    At most GUARD_MAX_ROWS rows are returned (see request_guards.py).
     """
     source = request.args.get("source", "test")  # "test" or "prototype"
 
-    query = (
-        MLPrediction.query.join(Bin)
-        .filter(MLPrediction.source == source)
-        .order_by(MLPrediction.created_at.desc())  # Latest first
-    )
+    with request_guards.slot("read") as acquired:
+        if not acquired:
+            request_guards.exceeded("concurrency")
+        limit = request_guards.row_limit(acquired)
+        rows = read_session().execute(predictions_statement(source).limit(limit + 1)).all()
+        rows, _ = request_guards.truncate(rows, limit)
+        results = [serialize_prediction(p, bin_obj) for p, bin_obj in rows]
+
+        if negotiate_format() == "columnar":
+            return jsonify(to_columnar(results, requested_fields(PREDICTION_FIELDS)))
+
+        return jsonify(results)
+
 
-    results = []
-    for p in query.all():
-        bin_obj = p.bin
-
-        results.append(
-            {
-                "bin_id": bin_obj.trash_can_id if bin_obj else None,
-                "location_name": bin_obj.location_name if bin_obj else None,
-                # expose latitude/longitude from DB as lat/lon in JSON
-                "lat": bin_obj.latitude if bin_obj else None,
-                "lon": bin_obj.longitude if bin_obj else None,
-                "predicted_fill_percent": p.predicted_fill_percent,
-                "predicted_full_at": (
-                    p.predicted_full_at.isoformat() if p.predicted_full_at else None
-                ),
-                "recorded_at": (
-                    p.created_at.isoformat() if p.created_at else None
-                ),
-            }
+@api_bp.route("/api/predictions/history")
+def api_prediction_history():
+    """
+    Fill history for one bin: ?bin_id=<trash_can_id>&source=&start=&end=
+    (ISO timestamps, default last 7 days). Ranges past the retention
+    period are served from hourly/daily rollups automatically.
+    """
+    source = request.args.get("source", "prototype")
+    bin_code = request.args.get("bin_id")
+    if not bin_code:
+        return jsonify({"error": "bin_id is required"}), 400
+
+    try:
+        end = datetime.fromisoformat(request.args["end"]) if "end" in request.args else datetime.utcnow()
+        start = (
+            datetime.fromisoformat(request.args["start"])
+            if "start" in request.args else end - timedelta(days=7)
         )
+    except ValueError as e:
+        return jsonify({"error": f"Invalid timestamp: {e}"}), 400
 
-    return jsonify(results)
+    session = read_session()
+    bin_pk = session.execute(
+        db.select(Bin.id).where(Bin.trash_can_id == bin_code)
+    ).scalar()
+    if bin_pk is None:
+        return jsonify({"error": f"Unknown bin {bin_code}"}), 404
+
+    return jsonify(
+        {
+            "bin_id": bin_code,
+            "source": source,
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "points": retention.bin_history(bin_pk, source, start, end, session),
+        }
+    )
 
 
 # ---------- Route API ----------
@@ -51,51 +131,137 @@ def api_predictions():
 @api_bp.route("/api/route")
 def api_route():
     """
-    Return the latest route for a given source ("test" or "prototype").
+    Return the active route for a given source ("test" or "prototype"),
+    or a specific immutable version with ?version=<id>.
+
+    ``?format=polyline`` returns the geometry as an encoded polyline plus
+    the remaining stop fields in columnar form; ``?format=columnar``
+    returns all stop fields in columnar form.
     """
     source = request.args.get("source", "test")
+    version = request.args.get("version", type=int)
 
-    route = (
-        Route.query.filter_by(source=source)
-        .order_by(Route.created_at.desc())
-        .first()
-    )
-    if not route:
-        return jsonify({"route_id": None, "name": None, "source": source, "stops": []})
+    if version is not None:
+        payload = route_store.get_route_payload(version, read_session())
+        if payload is None:
+            return jsonify({"error": f"Route version {version} not found"}), 404
 
-    stops = (
-        RouteStop.query.filter_by(route_id=route.id)
-        .order_by(RouteStop.order_index)
-        .all()
-    )
+        # A version never changes, so clients and proxies may keep it forever,
+        # keyed by the representation that was negotiated
+        fmt, fields = negotiate_format(), requested_fields(STOP_FIELDS)
+        response = jsonify(format_route(payload, fmt, fields))
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        response.vary.update(("Accept", "Accept-Encoding"))
+        response.set_etag(representation_etag(f"route-{version}", fmt, fields), weak=True)
+        return response.make_conditional(request)
+
+    session = read_session()
+    route_id = route_store.get_active_route_id(source, session)
+    payload = route_store.get_route_payload(route_id, session) if route_id else None
+    if not payload:
+        return jsonify({"route_id": None, "version": None, "name": None, "source": source, "stops": []})
+
+    return jsonify(format_route(payload, negotiate_format(), requested_fields(STOP_FIELDS)))
 
-    stop_list = []
-    for s in stops:
-        bin_obj = s.bin
-        stop_list.append(
-            {
-                "order_index": s.order_index,
-                "label": s.label,
-                "bin_id": bin_obj.trash_can_id if bin_obj else None,
-                "lat": s.latitude,
-                "lon": s.longitude,
-                "distance_from_prev_km": s.distance_from_prev_km,
-                "est_travel_time_min": s.est_travel_time_min,
-            }
-        )
+
+@api_bp.route("/api/route/history")
+def api_route_history():
+    """Return metadata for past route versions of a source, newest first."""
+    source = request.args.get("source", "test")
+    limit = min(request.args.get("limit", 20, type=int), 200)
 
     return jsonify(
         {
-            "route_id": route.id,
-            "name": route.name,
-            "source": route.source,
-            "stops": stop_list,
+            "source": source,
+            "versions": route_store.list_route_versions(source, limit=limit, session=read_session()),
         }
     )
 
 
 # ---------- Raspberry Pi Prototype Data Submission ----------
 
+def _parse_timestamp(value):
+    """ISO 8601 or "YYYY-MM-DD HH:MM:SS" as a naive UTC datetime, else None."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            return datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S")
+        except ValueError:
+            return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _number(data, name, convert, default=None):
+    """``data[name]`` (a JSON number or numeric string) converted, or ``default``."""
+    value = data.get(name, default)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise TypeError(f"{name} must be a number")
+    try:
+        result = convert(value)
+    except (OverflowError, ValueError):
+        raise ValueError(f"{name} must be a number") from None
+    if not math.isfinite(result):
+        raise ValueError(f"{name} must be a finite number")
+    return result
+
+
+def parse_submission(data, idempotency_key=None):
+    """
+    Validate a Raspberry Pi submission and normalise its fields.
+
+    ``idempotency_key`` is the request's Idempotency-Key header, which
+    takes precedence over an ``idempotency_key`` field in the body.
+
+    Raises ValueError with a client-facing message when required fields
+    are missing or a number does not parse, and TypeError when a field
+    has the wrong JSON type.
+    """
+    if not isinstance(data, dict):
+        raise TypeError("body must be a JSON object")
+
+    # Required fields
+    bin_id = data.get("bin_id")
+    fill_percent = data.get("fill_percent")
+
+    if not bin_id or fill_percent is None:
+        raise ValueError("bin_id and fill_percent are required")
+    if not isinstance(bin_id, str):
+        raise TypeError("bin_id must be a string")
+    location_name = data.get("location_name", "Prototype Location")
+    if location_name is not None and not isinstance(location_name, str):
+        raise TypeError("location_name must be a string")
+
+    # Retry deduplication (see idempotency.py)
+    idempotency_key = idempotency_key or data.get("idempotency_key")
+    if idempotency_key is not None:
+        idempotency_key = str(idempotency_key)
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            raise ValueError(f"idempotency_key must be at most {MAX_KEY_LENGTH} characters")
+    device_timestamp = _parse_timestamp(data.get("timestamp"))
+    if data.get("timestamp") and device_timestamp is None:
+        raise ValueError("timestamp must be ISO 8601")
+
+    return {
+        "bin_id": bin_id,
+        "fill_percent": _number(data, "fill_percent", float),
+        # Optional fields
+        "latitude": _number(data, "latitude", float),
+        "longitude": _number(data, "longitude", float),
+        "location_name": location_name,
+        "capacity_litres": _number(data, "capacity_litres", int, default=120),
+        "predicted_full_at": _parse_timestamp(data.get("predicted_full_at")),  # None if unparseable
+        "idempotency_key": idempotency_key,
+        "device_timestamp": device_timestamp,
+    }
+
+
 @api_bp.route("/api/prototype/submit", methods=["POST"])
 def submit_prototype_data():
     """
@@ -109,8 +275,14 @@ def submit_prototype_data():
         "longitude": 12.5683,
         "location_name": "Test Location",
         "capacity_litres": 120,
-        "predicted_full_at": "2025-12-20 14:30:00"  (optional)
+        "predicted_full_at": "2025-12-20 14:30:00",  (optional)
+        "timestamp": "2025-12-19T10:00:00Z",  (optional, device time)
+        "idempotency_key": "..."  (optional, or Idempotency-Key header)
     }
+
+    Retries of a stored submission (same idempotency key, or same bin
+    and device timestamp) are acknowledged with 200 and "duplicate": true
+    instead of adding another reading.
     """
     try:
         data = request.get_json()
@@ -118,33 +290,26 @@ def submit_prototype_data():
         if not data:
             return jsonify({"error": "No JSON data provided"}), 400
         
-        # Required fields
-        bin_id = data.get("bin_id")
-        fill_percent = data.get("fill_percent")
-        
-        if not bin_id or fill_percent is None:
-            return jsonify({"error": "bin_id and fill_percent are required"}), 400
-        
-        # Optional fields
-        latitude = data.get("latitude")
-        longitude = data.get("longitude")
-        location_name = data.get("location_name", "Prototype Location")
-        capacity_litres = data.get("capacity_litres", 120)
-        predicted_full_str = data.get("predicted_full_at")
-        
-        # Parse predicted_full_at if provided
-        predicted_full_at = None
-        if predicted_full_str:
-            try:
-                predicted_full_at = datetime.fromisoformat(predicted_full_str)
-            except ValueError:
-                try:
-                    predicted_full_at = datetime.strptime(predicted_full_str, "%Y-%m-%d %H:%M:%S")
-                except ValueError:
-                    pass  # Leave as None if can't parse
+        try:
+            fields = parse_submission(data, request.headers.get("Idempotency-Key"))
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+
+        key = submission_key("prototype", fields)
+        if recent_submissions.seen(key):
+            return _submission_response(fields, duplicate=True)
+
+        bin_id = fields["bin_id"]
+        fill_percent = fields["fill_percent"]
+        latitude = fields["latitude"]
+        longitude = fields["longitude"]
+        location_name = fields["location_name"]
+        capacity_litres = fields["capacity_litres"]
+        predicted_full_at = fields["predicted_full_at"]
         
         # Get or create Bin
         bin_obj = Bin.query.filter_by(trash_can_id=bin_id).first()
+        changes = []
         
         if not bin_obj:
             bin_obj = Bin(
@@ -157,38 +322,103 @@ def submit_prototype_data():
             )
             db.session.add(bin_obj)
             db.session.flush()
+            changes.append(change_feed.bin_change(
+                "insert", bin_obj.id, bin_id, "prototype",
+                {f: getattr(bin_obj, f) for f in change_feed.BIN_FIELDS},
+            ))
         else:
             # Update location if provided
-            if latitude is not None:
-                bin_obj.latitude = latitude
-            if longitude is not None:
-                bin_obj.longitude = longitude
-            if location_name:
-                bin_obj.location_name = location_name
+            updated = change_feed.changed_fields(
+                {f: getattr(bin_obj, f) for f in change_feed.BIN_FIELDS},
+                {"latitude": latitude, "longitude": longitude, "location_name": location_name or None},
+            )
+            for field, value in updated.items():
+                setattr(bin_obj, field, value)
+            if updated:
+                changes.append(change_feed.bin_change("update", bin_obj.id, bin_id, "prototype", updated))
         
-        # Create ML Prediction
-        prediction = MLPrediction(
-            bin=bin_obj,
-            source="prototype",
-            predicted_fill_percent=float(fill_percent),
-            predicted_full_at=predicted_full_at
+        # Create ML Prediction (skipped if this is a retry)
+        result = db.session.execute(
+            insert_prediction(
+                dialect_insert(),
+                bin_id=bin_obj.id,
+                source="prototype",
+                predicted_fill_percent=fill_percent,
+                predicted_full_at=predicted_full_at,
+                idempotency_key=fields["idempotency_key"],
+                device_timestamp=fields["device_timestamp"],
+                created_at=datetime.utcnow(),
+            )
         )
-        db.session.add(prediction)
+        if result.rowcount:
+            changes.append(change_feed.prediction_change(
+                result.inserted_primary_key[0], bin_id, "prototype", fill_percent, predicted_full_at,
+            ))
+        change_feed.record(changes)
         db.session.commit()
-        
-        return jsonify({
-            "success": True,
-            "message": f"Data received for bin {bin_id}",
-            "bin_id": bin_id,
-            "fill_percent": fill_percent,
-            "timestamp": datetime.utcnow().isoformat()
-        }), 201
+        recent_submissions.add(key)
+
+        return _submission_response(fields, duplicate=result.rowcount == 0)
         
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
 
+def submission_body(fields, duplicate=False):
+    """Response body and status code for a stored (or duplicate) submission."""
+    instrumentation.inc(
+        "app_submissions_total", help_text="Sensor submissions",
+        result="duplicate" if duplicate else "stored",
+    )
+    body = {
+        "success": True,
+        "message": f"Data received for bin {fields['bin_id']}",
+        "bin_id": fields["bin_id"],
+        "fill_percent": fields["fill_percent"],
+        "timestamp": datetime.utcnow().isoformat(),
+    }
+    if duplicate:
+        body["duplicate"] = True
+        return body, 200
+    return body, 201
+
+
+def _submission_response(fields, duplicate=False):
+    body, status = submission_body(fields, duplicate)
+    return jsonify(body), status
+
+
+# ---------- Change Feed ----------
+
+@api_bp.route("/api/changes")
+def api_changes():
+    """
+    Bin and prediction changes after a sequence number, oldest first.
+
+    Query params: after (default 0), limit (default 500, max 1000) and
+    source. Keep ``next_after`` from the response and pass it as
+    ``after`` on the next poll; read again right away while
+    ``has_more`` is true.
+    """
+    after = request.args.get("after", 0, type=int)
+    limit = request.args.get("limit", 500, type=int)
+    source = request.args.get("source")
+    # Not read_session(): a replica's snapshot lags the primary's (see change_feed.py)
+    return jsonify(change_feed.read(after, limit, source))
+
+
+# ---------- Metrics ----------
+
+@api_bp.route("/api/metrics")
+def metrics():
+    """Expose instrumentation data in Prometheus text format."""
+    return Response(
+        instrumentation.render_prometheus(),
+        mimetype="text/plain; version=0.0.4",
+    )
+
+
 # ---------- Health Check ----------
 
 @api_bp.route("/api/health")
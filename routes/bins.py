@@ -0,0 +1,117 @@
+from flask import Blueprint, request, jsonify
+
+from bin_index import bin_index
+
+bins_bp = Blueprint("bins", __name__)
+
+
+def _parse_bbox():
+    """Parse ?bbox=min_lon,min_lat,max_lon,max_lat (Leaflet's toBBoxString order)."""
+    raw = request.args.get("bbox")
+    if not raw:
+        return None
+    parts = [float(p) for p in raw.split(",")]
+    if len(parts) != 4:
+        raise ValueError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    return tuple(parts)
+
+
+# ---------- Map clusters ----------
+
+@bins_bp.route("/api/bins/clusters")
+def bin_clusters():
+    """
+    Return bins aggregated into grid clusters for a map viewport.
+
+    Query params: source, zoom (map zoom level) and optional bbox. Above
+    the maximum cluster zoom the individual bins are returned in "bins".
+    """
+    source = request.args.get("source", "test")
+    zoom = request.args.get("zoom", 12, type=int)
+    try:
+        bbox = _parse_bbox()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    bin_index.refresh()
+
+    response = jsonify(bin_index.clusters(source, zoom, bbox))
+    # Unchanged index + same viewport -> 304 on dashboard refreshes
+    response.set_etag(f"{bin_index.version}-{source}-{zoom}-{request.args.get('bbox', '')}")
+    return response.make_conditional(request)
+
+
+# ---------- Geospatial queries ----------
+
+def _fill_range():
+    min_fill = request.args.get("min_fill", 0.0, type=float)
+    max_fill = request.args.get("max_fill", 100.0, type=float)
+    return min_fill, max_fill
+
+
+def _point():
+    lat = request.args.get("lat", type=float)
+    lon = request.args.get("lon", type=float)
+    if lat is None or lon is None:
+        raise ValueError("lat and lon are required")
+    return lat, lon
+
+
+def _bins_response(source, bins):
+    return jsonify({"source": source, "count": len(bins), "bins": bins})
+
+
+@bins_bp.route("/api/bins/near")
+def bins_near():
+    """
+    Bins within radius_m metres of lat/lon, nearest first.
+
+    Query params: source, lat, lon, radius_m (default 500), optional
+    min_fill / max_fill and limit. Each bin carries its distance_m.
+    """
+    source = request.args.get("source", "test")
+    radius_m = request.args.get("radius_m", 500.0, type=float)
+    limit = request.args.get("limit", type=int)
+    try:
+        lat, lon = _point()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    bin_index.refresh()
+    return _bins_response(
+        source, bin_index.within_radius(source, lat, lon, radius_m, *_fill_range(), limit=limit)
+    )
+
+
+@bins_bp.route("/api/bins/within")
+def bins_within():
+    """Bins inside bbox (min_lon,min_lat,max_lon,max_lat), with fill filters."""
+    source = request.args.get("source", "test")
+    limit = request.args.get("limit", type=int)
+    try:
+        bbox = _parse_bbox()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if bbox is None:
+        return jsonify({"error": "bbox is required"}), 400
+
+    bin_index.refresh()
+    return _bins_response(
+        source, bin_index.within_bbox(source, bbox, *_fill_range(), limit=limit)
+    )
+
+
+@bins_bp.route("/api/bins/nearest")
+def bins_nearest():
+    """The k bins nearest to lat/lon (default k=5), with fill filters."""
+    source = request.args.get("source", "test")
+    k = request.args.get("k", 5, type=int)
+    try:
+        lat, lon = _point()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if k < 1:
+        return jsonify({"error": "k must be at least 1"}), 400
+
+    bin_index.refresh()
+    return _bins_response(source, bin_index.nearest(source, lat, lon, k, *_fill_range()))
@@ -1,4 +1,7 @@
-from flask import Blueprint, render_template
+from flask import Blueprint, jsonify, render_template, request
+
+import dashboard_data
+from db_config import read_session
 
 dashboard_bp = Blueprint("dashboard", __name__)
 
@@ -6,3 +9,28 @@ dashboard_bp = Blueprint("dashboard", __name__)
 @dashboard_bp.route("/dashboard")
 def dashboard():
     return render_template("dashboard.html")
+
+
+@dashboard_bp.route("/api/dashboard")
+def api_dashboard():
+    """
+    Everything a dashboard tab shows in one response: summary stats, the
+    latest prediction per bin and the active route with its totals.
+
+    ``?source=`` (default "prototype") and ``?threshold=`` (fill percent
+    counted as "over threshold", default 80). Built from a few aggregate
+    queries and cached until a prediction, bin or active route changes.
+    """
+    source = request.args.get("source", "prototype")
+    try:
+        threshold = float(request.args.get("threshold", dashboard_data.URGENT_FILL_PERCENT))
+    except ValueError:
+        return jsonify({"success": False, "error": "threshold must be a number"}), 400
+
+    payload = dashboard_data.get(source, threshold, read_session())
+    if payload is None:
+        return jsonify({"success": False, "error": f"Unknown source {source!r}"}), 400
+    response = jsonify(payload)
+    response.headers["Cache-Control"] = "no-cache"
+    response.set_etag(f"{payload['version']}-{source}-{threshold}")
+    return response.make_conditional(request)
@@ -0,0 +1,55 @@
+from flask import Blueprint, request, jsonify
+
+from extensions import db
+import depots
+
+depots_bp = Blueprint("depots", __name__)
+
+
+# ---------- Depot registry ----------
+
+@depots_bp.route("/api/depots")
+def list_depots():
+    """
+    Registered depots with the coverage of their travel tables. Read-only:
+    tables are refreshed by route solves and by POST, never here.
+    """
+    result = []
+    for depot in depots.list_depots():
+        data = depots.depot_to_dict(depot)
+        data["travel_table"] = depots.travel_table(depot, refresh=False).stats()
+        result.append(data)
+    return jsonify({"depots": result})
+
+
+@depots_bp.route("/api/depots", methods=["POST"])
+def register_depot():
+    """
+    Register a depot, or move an existing one with the same name.
+
+    JSON body: name, lat, lon. The depot's travel table is built before
+    the response, so the first route from it starts warm.
+    """
+    data = request.get_json(silent=True) or {}
+    name = (data.get("name") or "").strip()
+    if not name:
+        return jsonify({"success": False, "error": "name is required"}), 400
+    try:
+        lat = float(data["lat"])
+        lon = float(data["lon"])
+    except (KeyError, TypeError, ValueError):
+        return jsonify({"success": False, "error": "lat and lon must be numbers"}), 400
+
+    try:
+        depot, created = depots.register_depot(name, lat, lon)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"success": False, "error": str(e)}), 500
+
+    table = depots.travel_table(depot)
+    table.refresh(force=True)
+    body = depots.depot_to_dict(depot)
+    body["success"] = True
+    body["travel_table"] = table.stats()
+    return jsonify(body), 201 if created else 200
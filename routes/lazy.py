@@ -0,0 +1,54 @@
+"""
+Lazily loaded /dev blueprints.
+
+The upload handlers and the route generation views pull in CSV parsing,
+the optimizer, the result cache and the job pool. Registering them
+through :class:`LazyView` keeps all of that out of worker start-up: a
+view's module is imported on the first request that hits it.
+
+Endpoint names are unchanged (``upload.upload_test_predictions``,
+``route_jobs.get_route_job``, ...), so ``url_for`` keeps working.
+"""
+from flask import Blueprint
+from werkzeug.utils import cached_property, import_string
+
+
+class LazyView:
+    """View function placeholder that imports the real view on first call."""
+
+    def __init__(self, import_name: str):
+        self.__module__, self.__name__ = import_name.rsplit(".", 1)
+        self.import_name = import_name
+
+    @cached_property
+    def view(self):
+        return import_string(self.import_name)
+
+    def __call__(self, *args, **kwargs):
+        return self.view(*args, **kwargs)
+
+
+def _lazy_blueprint(name: str, module: str, rules) -> Blueprint:
+    bp = Blueprint(name, __name__, url_prefix="/dev")
+    for rule, view, methods in rules:
+        bp.add_url_rule(rule, view_func=LazyView(f"{module}.{view}"), methods=methods)
+    return bp
+
+
+upload_bp = _lazy_blueprint("upload", "routes.upload", [
+    ("/upload_test_predictions", "upload_test_predictions", ["GET", "POST"]),
+    ("/upload_route_test", "upload_route_test", ["GET", "POST"]),
+])
+
+upload_route_bp = _lazy_blueprint("upload_route", "routes.upload_route", [
+    # Shadowed by upload.upload_route_test, which is registered first
+    ("/upload_route_test", "upload_route_test", ["GET", "POST"]),
+    ("/generate_route_api", "generate_route_api", ["POST"]),
+    ("/generate_prototype_route", "generate_prototype_route", ["POST"]),
+])
+
+route_jobs_bp = _lazy_blueprint("route_jobs", "routes.route_jobs", [
+    ("/route_jobs", "submit_route_job", ["POST"]),
+    ("/route_jobs/<job_id>", "get_route_job", ["GET"]),
+    ("/route_jobs/<job_id>", "cancel_route_job", ["DELETE"]),
+])
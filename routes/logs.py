@@ -2,8 +2,10 @@ from flask import Blueprint, request, jsonify, send_file, render_template_string
 import csv
 import os
 from datetime import datetime
+import tempfile
 import zipfile
-import io
+
+import request_guards
 
 logs_bp = Blueprint("logs", __name__)
 
@@ -103,11 +105,23 @@ def view_file(filename):
     if not os.path.exists(path):
         abort(404)
 
+    # Header plus at most the row / byte budget (see request_guards.py)
     rows = []
-    with open(path, newline="") as f:
-        reader = csv.reader(f)
-        for row in reader:
-            rows.append(row)
+    truncated = False
+    with request_guards.slot("logs") as acquired:
+        if not acquired:
+            request_guards.exceeded("concurrency")
+        max_rows = request_guards.row_limit(acquired)
+        size = 0
+        with open(path, newline="") as f:
+            for row in csv.reader(f):
+                size += sum(map(len, row)) + len(row)
+                if len(rows) > max_rows or size > request_guards.MAX_RESPONSE_BYTES:
+                    truncated = True
+                    break
+                rows.append(row)
+    if truncated:
+        request_guards.exceeded("rows" if len(rows) > max_rows else "bytes")
 
     html = """
     <!DOCTYPE html>
@@ -124,6 +138,12 @@ def view_file(filename):
       <div class="container py-4">
         <h2>Log file: {{ filename }}</h2>
         <a href="/" class="btn btn-secondary btn-sm mb-3">Back</a>
+        {% if truncated %}
+          <div class="alert alert-warning">
+            Showing the first {{ rows|length - 1 }} rows.
+            <a href="/download/{{ filename }}">Download</a> the file for the rest.
+          </div>
+        {% endif %}
         <div class="table-responsive">
           <table class="table table-sm table-striped table-dark">
             {% for row in rows %}
@@ -151,7 +171,7 @@ def view_file(filename):
     </body>
     </html>
     """
-    return render_template_string(html, filename=filename, rows=rows)
+    return render_template_string(html, filename=filename, rows=rows, truncated=truncated)
 
 
 @logs_bp.route("/download/<filename>")
@@ -164,9 +184,28 @@ def download_file(filename):
 
 @logs_bp.route("/download_all")
 def download_all():
-    mem_zip = io.BytesIO()
-    with zipfile.ZipFile(mem_zip, "w", zipfile.ZIP_DEFLATED) as zf:
-        for file in os.listdir(LOG_DIR):
-            zf.write(os.path.join(LOG_DIR, file), file)
-    mem_zip.seek(0)
-    return send_file(mem_zip, as_attachment=True, download_name="all_trash_logs.zip")
+    """
+    Zip of the log files, newest first, up to GUARD_MAX_RESPONSE_BYTES of
+    logs (always at least one file). Built in a temporary file that only
+    stays in memory while small.
+    """
+    entries = sorted(os.scandir(LOG_DIR), key=lambda e: e.stat().st_mtime, reverse=True)
+    archive = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+
+    with request_guards.slot("logs") as acquired:
+        # Saturated: skip compression, the expensive part
+        if not acquired:
+            request_guards.exceeded("concurrency")
+        compression = zipfile.ZIP_DEFLATED if acquired else zipfile.ZIP_STORED
+        total = 0
+        with zipfile.ZipFile(archive, "w", compression) as zf:
+            for entry in entries:
+                total += entry.stat().st_size
+                if total > request_guards.MAX_RESPONSE_BYTES and zf.filelist:
+                    request_guards.exceeded("bytes")
+                    break
+                zf.write(entry.path, entry.name)
+
+    archive.seek(0)
+    return send_file(archive, as_attachment=True, download_name="all_trash_logs.zip",
+                     mimetype="application/zip")
@@ -0,0 +1,71 @@
+from flask import request, jsonify, url_for
+
+import depots
+import route_jobs
+from route_optimizer import ROUTE_MODES
+
+# Background counterpart of /dev/generate_prototype_route (see route_jobs.py).
+# Views are mounted under /dev by route_jobs_bp in routes/lazy.py
+
+DEFAULT_DEPOT = (55.6761, 12.5683)
+
+
+def submit_route_job():
+    """
+    Queue a route generation job.
+
+    JSON body: source (default "prototype"), depot (registered depot
+    name or id) or depot_lat / depot_lon, threshold, mode (see
+    ROUTE_MODES), budget_min (priority mode) and preview. Returns 202
+    with the job id; poll the Location URL for the result. An identical
+    request joins the job already running. With "preview": true a job
+    that is still running includes an instant Hilbert-curve route in
+    "preview".
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        source = data.get("source", "prototype")
+        depot_lat, depot_lon, depot = depots.depot_from_params(data, *DEFAULT_DEPOT)
+        threshold = float(data.get("threshold", 70.0))
+        budget_min = float(data["budget_min"]) if data.get("budget_min") is not None else None
+    except (TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": f"Invalid parameter: {e}"}), 400
+    except LookupError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+    mode = data.get("mode", "nearest")
+    if mode not in ROUTE_MODES:
+        return jsonify({"success": False, "error": f"mode must be one of {', '.join(ROUTE_MODES)}"}), 400
+
+    try:
+        job, deduplicated = route_jobs.submit(
+            source, depot_lat, depot_lon, threshold, mode, budget_min, depot
+        )
+    except LookupError as e:
+        return jsonify({"success": False, "error": str(e)}), 404
+
+    body = route_jobs.job_to_dict(job)
+    body["success"] = True
+    body["deduplicated"] = deduplicated
+    if data.get("preview") and job.status == route_jobs.ACTIVE:
+        route_stops, stats = route_jobs.preview(job)
+        body["preview"] = {"route": route_stops, "stats": stats}
+    response = jsonify(body)
+    response.status_code = 202
+    response.headers["Location"] = url_for("route_jobs.get_route_job", job_id=job.id)
+    return response
+
+
+def get_route_job(job_id):
+    """Status of a job, with the route and stats once it has succeeded."""
+    job = route_jobs.get_job(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify(route_jobs.job_to_dict(job))
+
+
+def cancel_route_job(job_id):
+    """Cancel a running job; finished jobs are returned unchanged."""
+    job = route_jobs.cancel(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify(route_jobs.job_to_dict(job))
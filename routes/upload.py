@@ -1,20 +1,84 @@
-from flask import Blueprint, render_template, request
-from datetime import datetime
-import csv
-import io
+from flask import render_template, request
 
+import change_feed
+import csv_ingest
 from extensions import db
-from models import Bin, MLPrediction, Route, RouteStop
+from models import Bin, MLPrediction
+import route_store
 
-upload_bp = Blueprint("upload", __name__, url_prefix="/dev")
+# Views are mounted under /dev by upload_bp in routes/lazy.py, which
+# imports this module on the first request to one of them
 
 
 # ---------- Upload TEST PREDICTIONS CSV ----------
 
-@upload_bp.route("/upload_test_predictions", methods=["GET", "POST"])
+def _store_prediction_batch(rows):
+    """Upsert the bins of one parsed batch and insert its predictions."""
+    codes = {row["bin_id"] for row in rows}
+    bins = {b.trash_can_id: b for b in Bin.query.filter(Bin.trash_can_id.in_(codes))}
+    # Change feed: trash_can_id -> (op, bin, changed fields)
+    bin_changes = {}
+    predictions = []
+
+    for row in rows:
+        bin_code = row["bin_id"]
+        lat, lon, loc_name = row["lat"], row["lon"], row["location_name"]
+
+        # --- upsert Bin with correct model fields (latitude/longitude) ---
+        bin_obj = bins.get(bin_code)
+
+        if not bin_obj:
+            bin_obj = bins[bin_code] = Bin(
+                trash_can_id=bin_code,
+                latitude=lat,
+                longitude=lon,
+                location_name=loc_name or "Unknown",
+            )
+            db.session.add(bin_obj)
+            bin_changes[bin_code] = ("insert", bin_obj, {})
+        else:
+            updated = change_feed.changed_fields(
+                {f: getattr(bin_obj, f) for f in change_feed.BIN_FIELDS},
+                {"latitude": lat, "longitude": lon, "location_name": loc_name},
+            )
+            for field, value in updated.items():
+                setattr(bin_obj, field, value)
+            if updated:
+                op, _, fields = bin_changes.setdefault(bin_code, ("update", bin_obj, {}))
+                fields.update(updated)
+
+        pred = MLPrediction(
+            bin=bin_obj,
+            source="test",
+            predicted_fill_percent=row["current_fill_pct"],
+            predicted_full_at=row["predicted_full_at"],
+        )
+        db.session.add(pred)
+        predictions.append(pred)
+
+    # Assigns the primary keys the feed rows refer to
+    db.session.flush()
+    changes = [
+        change_feed.bin_change(
+            op, bin_obj.id, code, "test",
+            {f: getattr(bin_obj, f) for f in change_feed.BIN_FIELDS} if op == "insert" else fields,
+        )
+        for code, (op, bin_obj, fields) in bin_changes.items()
+    ]
+    changes.extend(
+        change_feed.prediction_change(
+            p.id, p.bin.trash_can_id, "test", p.predicted_fill_percent, p.predicted_full_at,
+        )
+        for p in predictions
+    )
+    change_feed.record(changes)
+    return sum(1 for op, _, _ in bin_changes.values() if op == "insert"), len(predictions)
+
+
 def upload_test_predictions():
     message = None
     error = None
+    report = None
 
     if request.method == "POST":
         file = request.files.get("file")
@@ -23,90 +87,24 @@ def upload_test_predictions():
             error = "Please choose a CSV file to upload."
         else:
             try:
-                text_stream = io.TextIOWrapper(
-                    file.stream, encoding="utf-8", newline=""
-                )
-                reader = csv.DictReader(text_stream)
-
                 max_rows = 5000  # safety limit for Render free tier
                 created_bins = 0
                 created_preds = 0
+                report = csv_ingest.IngestReport()
 
-                for i, row in enumerate(reader):
-                    if i >= max_rows:
-                        break
-
-                    bin_code = (row.get("bin_id") or "").strip()
-                    if not bin_code:
-                        continue
-
-                    # --- parse coordinates from CSV (columns: lat, lon) ---
-                    lat_raw = row.get("lat")
-                    lon_raw = row.get("lon")
-                    loc_name = row.get("location_name") or None
-
-                    try:
-                        lat = float(lat_raw) if lat_raw not in (None, "", "NaN") else None
-                    except ValueError:
-                        lat = None
-
-                    try:
-                        lon = float(lon_raw) if lon_raw not in (None, "", "NaN") else None
-                    except ValueError:
-                        lon = None
-
-                    # --- upsert Bin with correct model fields (latitude/longitude) ---
-                    bin_obj = Bin.query.filter_by(trash_can_id=bin_code).first()
-
-                    if not bin_obj:
-                        bin_obj = Bin(
-                            trash_can_id=bin_code,
-                            latitude=lat,
-                            longitude=lon,
-                            location_name=loc_name or "Unknown",
-                        )
-                        db.session.add(bin_obj)
-                        created_bins += 1
-                    else:
-                        if lat is not None:
-                            bin_obj.latitude = lat
-                        if lon is not None:
-                            bin_obj.longitude = lon
-                        if loc_name:
-                            bin_obj.location_name = loc_name
-
-                    # --- prediction values ---
-                    try:
-                        fill_pct = float(row.get("current_fill_pct") or 0)
-                    except ValueError:
-                        fill_pct = 0.0
-
-                    pf_str = (row.get("predicted_full_at") or "").strip()
-                    pf_at = None
-                    if pf_str:
-                        try:
-                            pf_at = datetime.fromisoformat(pf_str)
-                        except ValueError:
-                            for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"):
-                                try:
-                                    pf_at = datetime.strptime(pf_str, fmt)
-                                    break
-                                except ValueError:
-                                    continue
-
-                    pred = MLPrediction(
-                        bin=bin_obj,
-                        source="test",
-                        predicted_fill_percent=fill_pct,
-                        predicted_full_at=pf_at,
-                    )
-                    db.session.add(pred)
-                    created_preds += 1
+                # One bin lookup and one flush per batch; parsed rows are
+                # not kept past their batch
+                for rows in csv_ingest.read_batches(
+                    file.stream, csv_ingest.prediction_columns(), report, max_rows=max_rows
+                ):
+                    new_bins, new_preds = _store_prediction_batch(rows)
+                    created_bins += new_bins
+                    created_preds += new_preds
 
                 db.session.commit()
                 message = (
                     f"Uploaded {created_bins} bins and {created_preds} "
-                    f"test predictions (first {max_rows} rows)."
+                    f"test predictions ({report.summary()})."
                 )
 
             except Exception as e:
@@ -117,15 +115,16 @@ def upload_test_predictions():
         "upload_test_predictions.html",
         message=message,
         error=error,
+        report=report,
     )
 
 
 # ---------- Upload OPTIMAL ROUTE CSV (TEST DATASET) ----------
 
-@upload_bp.route("/upload_route_test", methods=["GET", "POST"])
 def upload_route_test():
     message = None
     error = None
+    report = None
 
     if request.method == "POST":
         file = request.files.get("file")
@@ -134,89 +133,49 @@ def upload_route_test():
             error = "Please choose a CSV file to upload."
         else:
             try:
-                text_stream = io.TextIOWrapper(
-                    file.stream, encoding="utf-8", newline=""
-                )
-                reader = csv.DictReader(text_stream)
-
                 # Expected columns:
                 # route_name, order_index, bin_id, lat, lon,
                 # distance_from_prev_km, est_travel_time_min
-
-                # Clear existing test routes + stops (keep only one for demo)
-                existing_routes = Route.query.filter_by(source="test").all()
-                for r in existing_routes:
-                    RouteStop.query.filter_by(route_id=r.id).delete()
-                    db.session.delete(r)
-                db.session.commit()
-
-                created_route = None
-                created_stops = 0
-
-                for i, row in enumerate(reader):
-                    route_name = row.get("route_name") or "Test Route"
-                    order_raw = row.get("order_index") or row.get("stop_order") or (i + 1)
-                    bin_code = (row.get("bin_id") or "").strip()
-
-                    try:
-                        order_index = int(order_raw)
-                    except ValueError:
-                        order_index = i + 1
-
-                    try:
-                        lat = float(row.get("lat") or 0)
-                    except ValueError:
-                        lat = 0.0
-
-                    try:
-                        lon = float(row.get("lon") or 0)
-                    except ValueError:
-                        lon = 0.0
-
-                    try:
-                        dist_km = float(row.get("distance_from_prev_km") or 0)
-                    except ValueError:
-                        dist_km = 0.0
-
-                    try:
-                        travel_min = float(row.get("est_travel_time_min") or 0)
-                    except ValueError:
-                        travel_min = 0.0
-
-                    if created_route is None:
-                        created_route = Route(
-                            name=route_name,
-                            source="test",
+                report = csv_ingest.IngestReport()
+
+                route_name = None
+                stops = []
+
+                for rows in csv_ingest.read_batches(file.stream, csv_ingest.route_columns(), report):
+                    for row in rows:
+                        order_index = row["order_index"]
+                        if order_index is None:
+                            order_index = len(stops) + 1
+                        bin_code = row["bin_id"]
+
+                        if route_name is None:
+                            route_name = row["route_name"] or "Test Route"
+
+                        stops.append(
+                            {
+                                "order_index": order_index,
+                                "label": f"Bin {bin_code}" if bin_code else f"Stop {order_index}",
+                                "bin_id": bin_code,
+                                "lat": row["lat"],
+                                "lon": row["lon"],
+                                "distance_from_prev_km": row["distance_from_prev_km"],
+                                "est_travel_time_min": row["est_travel_time_min"],
+                            }
                         )
-                        db.session.add(created_route)
-                        db.session.flush()  # populate id
-
-                    bin_obj = None
-                    if bin_code:
-                        bin_obj = Bin.query.filter_by(trash_can_id=bin_code).first()
-
-                    stop = RouteStop(
-                        route_id=created_route.id,
-                        order_index=order_index,
-                        label=f"Bin {bin_code}" if bin_code else f"Stop {order_index}",
-                        bin=bin_obj,
-                        latitude=lat,
-                        longitude=lon,
-                        distance_from_prev_km=dist_km,
-                        est_travel_time_min=travel_min,
-                    )
-                    db.session.add(stop)
-                    created_stops += 1
-
-                db.session.commit()
 
-                if created_route:
+                # Publish as the new active test route version, all rows
+                # or none: a route missing some of its stops is not a route
+                if report.rejected or report.truncated:
+                    error = f"Route not published: {report.summary()}."
+                elif stops:
+                    created_route = route_store.publish_route("test", route_name, stops)
+                    db.session.commit()
                     message = (
                         f"Uploaded route '{created_route.name}' with "
-                        f"{created_stops} stops (test dataset)."
+                        f"{len(stops)} stops (test dataset; {report.summary()})."
                     )
                 else:
-                    error = "No route rows found in CSV."
+                    error = "No valid route rows found in CSV."
 
             except Exception as e:
                 db.session.rollback()
@@ -226,4 +185,5 @@ def upload_route_test():
         "upload_route_test.html",
         message=message,
         error=error,
+        report=report,
     )
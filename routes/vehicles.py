@@ -0,0 +1,88 @@
+import math
+from datetime import datetime, timezone
+
+from flask import Blueprint, request, jsonify
+
+import instrumentation
+from vehicle_tracking import vehicle_tracker
+
+vehicles_bp = Blueprint("vehicles", __name__)
+
+
+def _parse_ping(data, default_source):
+    """Validate one ping; raises ValueError with a client-facing message."""
+    if not isinstance(data, dict):
+        raise ValueError("each ping must be a JSON object")
+    vehicle_id = data.get("vehicle_id")
+    if not vehicle_id or isinstance(vehicle_id, bool) or not isinstance(vehicle_id, (str, int)):
+        raise ValueError("vehicle_id is required (a string or integer)")
+    try:
+        if isinstance(data["lat"], bool) or isinstance(data["lon"], bool):
+            raise TypeError
+        lat = float(data["lat"])
+        lon = float(data["lon"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("lat and lon must be numbers")
+    if not (math.isfinite(lat) and math.isfinite(lon)) or abs(lat) > 90 or abs(lon) > 180:
+        raise ValueError("lat must be within ±90 and lon within ±180")
+    source = data.get("source", default_source)
+    if not isinstance(source, str) or not source:
+        raise ValueError("source must be a non-empty string")
+
+    reported_at = None
+    if data.get("timestamp"):
+        try:
+            reported_at = datetime.fromisoformat(str(data["timestamp"]).replace("Z", "+00:00"))
+            if reported_at.tzinfo is not None:
+                reported_at = reported_at.astimezone(timezone.utc).replace(tzinfo=None)
+        except ValueError:
+            raise ValueError("timestamp must be ISO 8601")
+
+    return str(vehicle_id), lat, lon, source, reported_at
+
+
+# ---------- Vehicle tracking ----------
+
+@vehicles_bp.route("/api/vehicles/positions", methods=["POST"])
+def report_positions():
+    """
+    Ingest GPS pings.
+
+    Body: one ping {vehicle_id, lat, lon, source, timestamp} or a list of
+    them. Each ping is snapped to the active route of its source (default
+    "prototype"); the response carries the resulting route progress.
+    """
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "No JSON data provided"}), 400
+
+    default_source = request.args.get("source", "prototype")
+    pings = data if isinstance(data, list) else [data]
+    try:
+        parsed = [_parse_ping(p, default_source) for p in pings]
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    progress = [
+        vehicle_tracker.report(vehicle_id, lat, lon, source, reported_at)
+        for vehicle_id, lat, lon, source, reported_at in parsed
+    ]
+    instrumentation.inc("app_vehicle_pings_total", len(progress), "GPS pings ingested")
+
+    if isinstance(data, list):
+        return jsonify({"accepted": len(progress), "progress": progress})
+    return jsonify(progress[0])
+
+
+@vehicles_bp.route("/api/vehicles")
+def list_vehicles():
+    """Latest position and route progress of every vehicle (optional ?source=)."""
+    return jsonify({"vehicles": vehicle_tracker.all(request.args.get("source"))})
+
+
+@vehicles_bp.route("/api/vehicles/<vehicle_id>")
+def get_vehicle(vehicle_id):
+    progress = vehicle_tracker.get(vehicle_id)
+    if progress is None:
+        return jsonify({"error": "Unknown vehicle"}), 404
+    return jsonify(progress)
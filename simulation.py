@@ -0,0 +1,265 @@
+"""
+Offline replay of stored fill history against route strategies.
+
+Answers "what would a different threshold, mode or budget have cost
+over the last month?" without touching what runs in production:
+
+1. The history of a source is read once (hourly rollups for the part
+   already past retention, then raw predictions) and reduced to the fill
+   every bin gained on each day. Drops between readings are collections
+   that really happened and are ignored, so the growth is independent of
+   the strategy that was running at the time.
+2. Every scenario (mode x threshold x budget) replays the days on its
+   own simulated fill levels: each morning a route is generated with
+   solve_route from the current levels, the bins on it are emptied, and
+   the day's growth is added. A bin reaching 100% before it was
+   collected is an overflow event.
+
+Scenarios are independent and run in parallel in a spawn process pool
+that receives the history once per worker process.
+
+Run it with:
+    flask --app app simulate --start 2026-09-01 --end 2026-10-01 \\
+        --mode nearest --mode priority --threshold 70 --threshold 80
+
+Environment variables:
+    SIMULATION_WORKERS          scenario processes (default CPU count)
+    SIMULATION_COLLECTION_HOUR  UTC hour at which each day's route runs,
+                                used as "now" for priority urgency (default 6)
+"""
+import itertools
+import multiprocessing
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from extensions import db
+from models import Bin, MLPrediction, MLPredictionRollup
+import route_optimizer
+from route_optimizer import DEFAULT_CAPACITY_LITRES, ROUTE_STOP_SERVICE_MIN, solve_route
+
+
+SIMULATION_WORKERS = int(os.environ.get("SIMULATION_WORKERS", str(os.cpu_count() or 1)))
+SIMULATION_COLLECTION_HOUR = int(os.environ.get("SIMULATION_COLLECTION_HOUR", "6"))
+
+# Weight of the latest day in the fill-rate estimate behind predicted_full_at
+RATE_SMOOTHING = 0.3
+FULL_PERCENT = 100.0
+READ_BATCH = 5000
+
+
+# ---------- History ----------
+
+def _readings(source: str, start: datetime, end: datetime, session):
+    """(bin_pk, created_at, fill) per bin in time order: rollups, then raw rows."""
+    rollups = (
+        db.select(
+            MLPredictionRollup.bin_id,
+            MLPredictionRollup.bucket_start,
+            MLPredictionRollup.sum_fill / MLPredictionRollup.sample_count,
+        )
+        .where(MLPredictionRollup.source == source)
+        .where(MLPredictionRollup.period == "hour")
+        .where(MLPredictionRollup.bucket_start >= start)
+        .where(MLPredictionRollup.bucket_start < end)
+        .order_by(MLPredictionRollup.bucket_start)
+    )
+    raw = (
+        db.select(MLPrediction.bin_id, MLPrediction.created_at, MLPrediction.predicted_fill_percent)
+        .where(MLPrediction.source == source)
+        .where(MLPrediction.created_at >= start)
+        .where(MLPrediction.created_at < end)
+        .order_by(MLPrediction.created_at)
+    )
+    for stmt in (rollups, raw):
+        yield from session.execute(stmt.execution_options(yield_per=READ_BATCH))
+
+
+def load_history(source: str, start: date, end: date, session=None) -> Dict:
+    """
+    Daily fill growth per bin of ``source`` between ``start`` (inclusive)
+    and ``end`` (exclusive).
+
+    Returns a picklable dict: ``bins`` (optimizer bin dicts without fill),
+    ``days``, ``initial_fill`` (first reading of every bin) and ``growth``
+    (one array per day, indexed like ``bins``). Bins without coordinates
+    cannot be routed and are left out.
+    """
+    session = session or db.session
+    rows = session.execute(
+        db.select(Bin.id, Bin.trash_can_id, Bin.latitude, Bin.longitude, Bin.capacity_litres)
+        .where(Bin.latitude.isnot(None))
+        .where(Bin.longitude.isnot(None))
+        .order_by(Bin.id)
+    ).all()
+    bins = [
+        {
+            "bin_id": code,
+            "bin_pk": pk,
+            "lat": lat,
+            "lon": lon,
+            "capacity_litres": capacity or DEFAULT_CAPACITY_LITRES,
+        }
+        for pk, code, lat, lon, capacity in rows
+    ]
+    index = {b["bin_pk"]: i for i, b in enumerate(bins)}
+    n = len(bins)
+
+    days = [start + timedelta(days=d) for d in range((end - start).days)]
+    initial_fill = array("d", bytes(8 * n))
+    growth = [array("d", bytes(8 * n)) for _ in days]
+    last = {}
+    start_at = datetime.combine(start, datetime.min.time())
+    end_at = datetime.combine(end, datetime.min.time())
+
+    for bin_pk, created_at, fill in _readings(source, start_at, end_at, session):
+        i = index.get(bin_pk)
+        if i is None:
+            continue
+        previous = last.get(i)
+        if previous is None:
+            initial_fill[i] = fill
+        elif fill > previous:
+            growth[(created_at.date() - start).days][i] += fill - previous
+        last[i] = fill
+
+    return {
+        "source": source,
+        "bins": bins,
+        "days": days,
+        "initial_fill": initial_fill,
+        "growth": growth,
+    }
+
+
+# ---------- Scenarios ----------
+
+def scenarios(modes: List[str], thresholds: List[float],
+              budgets: Optional[List[Optional[float]]] = None) -> List[Dict]:
+    """Every combination of mode, threshold and (priority mode only) budget."""
+    result = []
+    for mode, threshold in itertools.product(modes, thresholds):
+        for budget_min in (budgets or [None]) if mode == "priority" else [None]:
+            result.append({"mode": mode, "threshold": threshold, "budget_min": budget_min})
+    return result
+
+
+def run_scenario(history: Dict, scenario: Dict, depot_lat: float, depot_lon: float) -> Dict:
+    """Replay every day of ``history`` with one strategy and total the results."""
+    bins = history["bins"]
+    fill = array("d", history["initial_fill"])
+    rate = array("d", bytes(8 * len(bins)))  # smoothed %/day
+    index = {b["bin_id"]: i for i, b in enumerate(bins)}
+
+    totals = {
+        "distance_km": 0.0,
+        "truck_hours": 0.0,
+        "stops": 0,
+        "routes": 0,
+        "overflow_events": 0,
+        "overflow_bin_days": 0,
+    }
+    collected_fill = 0.0
+    daily = []
+
+    for day, growth in zip(history["days"], history["growth"]):
+        now = datetime.combine(day, datetime.min.time()) + timedelta(hours=SIMULATION_COLLECTION_HOUR)
+        candidates = []
+        for i, b in enumerate(bins):
+            level = min(fill[i], FULL_PERCENT)
+            full_at = None
+            if rate[i] > 0:
+                full_at = now + timedelta(days=(FULL_PERCENT - level) / rate[i])
+            candidates.append(dict(b, predicted_fill_percent=level, predicted_full_at=full_at))
+
+        route, stats = solve_route(
+            candidates, depot_lat, depot_lon, scenario["threshold"],
+            scenario["mode"], scenario["budget_min"], now=now,
+        )
+        stops = [index[s["bin_id"]] for s in route if s["bin_id"]]
+        for i in stops:
+            collected_fill += min(fill[i], FULL_PERCENT)
+            fill[i] = 0.0
+        if stops:
+            totals["routes"] += 1
+            totals["stops"] += len(stops)
+            totals["distance_km"] += stats["total_distance_km"]
+            totals["truck_hours"] += (stats["total_time_min"] + ROUTE_STOP_SERVICE_MIN * len(stops)) / 60
+
+        overflows = 0
+        for i, added in enumerate(growth):
+            rate[i] = RATE_SMOOTHING * added + (1 - RATE_SMOOTHING) * rate[i]
+            if not added:
+                if fill[i] >= FULL_PERCENT:
+                    totals["overflow_bin_days"] += 1
+                continue
+            before = fill[i]
+            fill[i] = min(before + added, FULL_PERCENT)
+            if fill[i] >= FULL_PERCENT:
+                totals["overflow_bin_days"] += 1
+                if before < FULL_PERCENT:
+                    overflows += 1
+        totals["overflow_events"] += overflows
+
+        daily.append({
+            "date": day.isoformat(),
+            "stops": len(stops),
+            "distance_km": stats["total_distance_km"] if stops else 0.0,
+            "overflow_events": overflows,
+        })
+
+    result = dict(scenario)
+    result.update({
+        "days": len(daily),
+        "routes": totals["routes"],
+        "stops": totals["stops"],
+        "total_distance_km": round(totals["distance_km"], 2),
+        "truck_hours": round(totals["truck_hours"], 2),
+        "overflow_events": totals["overflow_events"],
+        "overflow_bin_days": totals["overflow_bin_days"],
+        "avg_fill_at_collection": (
+            round(collected_fill / totals["stops"], 1) if totals["stops"] else None
+        ),
+        "km_per_stop": (
+            round(totals["distance_km"] / totals["stops"], 3) if totals["stops"] else None
+        ),
+        "daily": daily,
+    })
+    return result
+
+
+# ---------- Parallel runs ----------
+
+# History shared by the scenarios of one worker process (set by _init_worker)
+_worker_history = None
+
+
+def _init_worker(history: Dict) -> None:
+    global _worker_history
+    _worker_history = history
+    # Scenarios are the unit of parallelism; do not nest partition pools
+    route_optimizer.single_process_worker()
+
+
+def _run_in_worker(scenario: Dict, depot_lat: float, depot_lon: float) -> Dict:
+    return run_scenario(_worker_history, scenario, depot_lat, depot_lon)
+
+
+def run(history: Dict, scenario_list: List[Dict], depot_lat: float, depot_lon: float,
+        workers: Optional[int] = None) -> List[Dict]:
+    """Run scenarios, in parallel when there is more than one worker."""
+    workers = min(workers or SIMULATION_WORKERS, len(scenario_list))
+    if workers <= 1:
+        return [run_scenario(history, s, depot_lat, depot_lon) for s in scenario_list]
+
+    # spawn: never fork a process that holds DB connections and threads
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(history,),
+    ) as pool:
+        n = len(scenario_list)
+        return list(pool.map(_run_in_worker, scenario_list, [depot_lat] * n, [depot_lon] * n))
@@ -0,0 +1,269 @@
+"""
+Live vehicle positions and progress along the active route.
+
+Each GPS ping is snapped to the active route of its source, which turns
+it into a distance travelled along the route. From that the tracker
+derives which stops are done, the distance left and the remaining ETA
+(from the stops' ``est_travel_time_min``).
+
+Everything per ping is O(1):
+- route geometry, cumulative distance and cumulative travel time are
+  precomputed once per route version (versions are immutable);
+- a vehicle is only matched against a few segments around the one it
+  was last snapped to (the whole route is scanned once, on its first
+  ping or after it went off route);
+- the active route id per source is cached for ACTIVE_ROUTE_TTL seconds.
+
+Positions are kept in memory per worker and are not persisted. A
+vehicle that has not reported for VEHICLE_TTL_SECONDS is dropped, and
+at most VEHICLE_MAX_TRACKED vehicles are kept (least recently reported
+go first).
+
+Environment variables:
+    VEHICLE_OFF_ROUTE_M      pings further than this from the route do not
+                             advance progress (default 150)
+    VEHICLE_ARRIVAL_M        a stop counts as done within this distance
+                             along the route (default 30)
+    VEHICLE_TTL_SECONDS      forget vehicles silent for this long (default 3600)
+    VEHICLE_MAX_TRACKED      vehicles kept per worker (default 10000)
+"""
+import math
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from db_config import read_session
+import route_store
+
+
+OFF_ROUTE_M = float(os.environ.get("VEHICLE_OFF_ROUTE_M", "150"))
+ARRIVAL_M = float(os.environ.get("VEHICLE_ARRIVAL_M", "30"))
+VEHICLE_TTL = float(os.environ.get("VEHICLE_TTL_SECONDS", "3600"))
+MAX_VEHICLES = int(os.environ.get("VEHICLE_MAX_TRACKED", "10000"))
+SNAP_WINDOW = 3  # segments checked on each side of the last match
+ACTIVE_ROUTE_TTL = 5.0
+TRACK_CACHE_SIZE = 32
+EARTH_RADIUS_M = 6371000.0
+
+
+class RouteTrack:
+    """Precomputed geometry of one route version."""
+    __slots__ = ("route_id", "lat", "lon", "cum_m", "cum_min", "stops")
+
+    def __init__(self, payload: Dict):
+        stops = [s for s in payload["stops"] if s["lat"] is not None and s["lon"] is not None]
+        self.route_id = payload["route_id"]
+        self.stops = stops
+        self.lat = array("d", (s["lat"] for s in stops))
+        self.lon = array("d", (s["lon"] for s in stops))
+        # Distance and time from the start to each stop, from the stored legs
+        self.cum_m = array("d")
+        self.cum_min = array("d")
+        total_m = total_min = 0.0
+        for i, s in enumerate(stops):
+            if i:
+                total_m += (s["distance_from_prev_km"] or 0.0) * 1000.0
+                total_min += s["est_travel_time_min"] or 0.0
+            self.cum_m.append(total_m)
+            self.cum_min.append(total_min)
+
+    @property
+    def segments(self) -> int:
+        return max(len(self.lat) - 1, 0)
+
+    def project(self, seg: int, lat: float, lon: float):
+        """(distance to segment in m, fraction along it) for a point."""
+        lat0, lon0 = self.lat[seg], self.lon[seg]
+        k = math.radians(1.0) * EARTH_RADIUS_M
+        cos0 = math.cos(math.radians(lat0))
+        vx = (self.lon[seg + 1] - lon0) * cos0 * k
+        vy = (self.lat[seg + 1] - lat0) * k
+        px = (lon - lon0) * cos0 * k
+        py = (lat - lat0) * k
+        length2 = vx * vx + vy * vy
+        t = 0.0 if length2 == 0 else min(1.0, max(0.0, (px * vx + py * vy) / length2))
+        dx, dy = px - t * vx, py - t * vy
+        return math.sqrt(dx * dx + dy * dy), t
+
+    def snap(self, lat: float, lon: float, near: Optional[int]):
+        """Best (distance, segment, fraction), searching near ``near`` if given."""
+        if near is None:
+            candidates = range(self.segments)
+        else:
+            candidates = range(max(0, near - SNAP_WINDOW), min(self.segments, near + SNAP_WINDOW + 1))
+        best = None
+        for seg in candidates:
+            dist, t = self.project(seg, lat, lon)
+            if best is None or dist < best[0]:
+                best = (dist, seg, t)
+        return best
+
+
+class VehicleState:
+    __slots__ = ("vehicle_id", "source", "lat", "lon", "reported_at", "seen_at",
+                 "route_id", "segment", "progress_m", "off_route")
+
+    def __init__(self, vehicle_id: str, source: str):
+        self.vehicle_id = vehicle_id
+        self.source = source
+        self.route_id = None
+        self.segment = None
+        self.progress_m = 0.0
+        self.off_route = False
+
+
+class VehicleTracker:
+    """Latest position and route progress of every vehicle (per worker)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Least recently reported first (see _expire)
+        self._vehicles: "OrderedDict[str, VehicleState]" = OrderedDict()
+        self._tracks = OrderedDict()
+        self._active = {}  # source -> (route_id, fetched_at)
+
+    # ---------- Route lookups ----------
+
+    def _active_route_id(self, source: str) -> Optional[int]:
+        now = time.monotonic()
+        cached = self._active.get(source)
+        if cached is not None and now - cached[1] < ACTIVE_ROUTE_TTL:
+            return cached[0]
+        route_id = route_store.get_active_route_id(source, read_session())
+        self._active[source] = (route_id, now)
+        return route_id
+
+    def _track(self, route_id: int) -> Optional[RouteTrack]:
+        with self._lock:
+            track = self._tracks.get(route_id)
+            if track is not None:
+                self._tracks.move_to_end(route_id)
+                return track
+
+        payload = route_store.get_route_payload(route_id, read_session())
+        if payload is None:
+            return None
+        track = RouteTrack(payload)
+        with self._lock:
+            self._tracks[route_id] = track
+            while len(self._tracks) > TRACK_CACHE_SIZE:
+                self._tracks.popitem(last=False)
+        return track
+
+    # ---------- Ingest ----------
+
+    def _expire(self, now: float) -> None:
+        """Drop silent and excess vehicles (caller holds the lock)."""
+        vehicles = self._vehicles
+        while vehicles and (len(vehicles) > MAX_VEHICLES
+                            or now - next(iter(vehicles.values())).seen_at > VEHICLE_TTL):
+            vehicles.popitem(last=False)
+
+    def report(self, vehicle_id: str, lat: float, lon: float, source: str = "prototype",
+               reported_at: Optional[datetime] = None) -> Dict:
+        """Record a ping, update the vehicle's route progress and return it."""
+        route_id = self._active_route_id(source)
+        track = self._track(route_id) if route_id else None
+
+        with self._lock:
+            state = self._vehicles.get(vehicle_id)
+            if state is None or state.source != source:
+                state = self._vehicles[vehicle_id] = VehicleState(vehicle_id, source)
+            self._vehicles.move_to_end(vehicle_id)
+            state.lat, state.lon = lat, lon
+            state.reported_at = reported_at or datetime.utcnow()
+            state.seen_at = time.monotonic()
+            self._expire(state.seen_at)
+
+            if track is None or track.segments == 0:
+                state.route_id, state.segment, state.progress_m = route_id, None, 0.0
+                state.off_route = False
+                return self._progress(state, track)
+
+            if state.route_id != track.route_id:
+                # New route version: start matching from scratch
+                state.route_id, state.segment, state.progress_m = track.route_id, None, 0.0
+
+            dist, seg, t = track.snap(lat, lon, state.segment)
+            if dist > OFF_ROUTE_M and state.segment is not None:
+                # Lost the local match (e.g. a detour); try the whole route
+                dist, seg, t = track.snap(lat, lon, None)
+
+            state.off_route = dist > OFF_ROUTE_M
+            if not state.off_route:
+                progress = track.cum_m[seg] + t * (track.cum_m[seg + 1] - track.cum_m[seg])
+                # GPS jitter must not un-complete stops
+                if progress >= state.progress_m or state.segment is None:
+                    state.progress_m = progress
+                    state.segment = seg
+            return self._progress(state, track)
+
+    # ---------- Reads ----------
+
+    def _progress(self, state: VehicleState, track: Optional[RouteTrack]) -> Dict:
+        result = {
+            "vehicle_id": state.vehicle_id,
+            "source": state.source,
+            "lat": state.lat,
+            "lon": state.lon,
+            "reported_at": state.reported_at.isoformat(),
+            "route_id": state.route_id,
+            "off_route": state.off_route,
+        }
+        if track is None or track.segments == 0:
+            return result
+
+        total_m = track.cum_m[-1]
+        seg = state.segment or 0
+        seg_m = track.cum_m[seg + 1] - track.cum_m[seg]
+        t = (state.progress_m - track.cum_m[seg]) / seg_m if seg_m else 0.0
+        elapsed_min = track.cum_min[seg] + t * (track.cum_min[seg + 1] - track.cum_min[seg])
+        remaining_min = max(track.cum_min[-1] - elapsed_min, 0.0)
+
+        # Stops (including the starting depot) whose position along the
+        # route has been reached
+        done = bisect_right(track.cum_m, state.progress_m + ARRIVAL_M)
+        next_stop = track.stops[done] if done < len(track.stops) else None
+
+        result.update({
+            "progress_km": round(state.progress_m / 1000.0, 3),
+            "remaining_km": round(max(total_m - state.progress_m, 0.0) / 1000.0, 3),
+            "stops_reached": done,
+            "total_stops": len(track.stops),
+            "next_stop": next_stop,
+            "eta_min": round(remaining_min, 1),
+            "eta": (state.reported_at + timedelta(minutes=remaining_min)).isoformat(),
+        })
+        return result
+
+    def get(self, vehicle_id: str) -> Optional[Dict]:
+        with self._lock:
+            self._expire(time.monotonic())
+            state = self._vehicles.get(vehicle_id)
+            if state is None:
+                return None
+            return self._progress(state, self._tracks.get(state.route_id))
+
+    def all(self, source: Optional[str] = None) -> List[Dict]:
+        with self._lock:
+            self._expire(time.monotonic())
+            return [
+                self._progress(s, self._tracks.get(s.route_id))
+                for s in self._vehicles.values()
+                if source is None or s.source == source
+            ]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._vehicles.clear()
+            self._tracks.clear()
+            self._active.clear()
+
+
+# One tracker per worker process
+vehicle_tracker = VehicleTracker()